@@ -1,15 +1,16 @@
 import streamlit as st
-import os
-import io
-import json
-import tempfile
-import base64
-from PIL import Image
-import openai
-import requests
-from urllib.parse import quote
-import time
-from pdf_handler import prepare_document_image, is_pdf
+from pdf_handler import prepare_document_image, is_pdf, iter_pdf_pages
+from cache import ResultCache
+from document_processor import (
+    CASCADE_MODEL, acquire_document_job, fail_job, finish_job, job_heartbeat, job_validation, process_document,
+    process_document_cascade, process_document_pages, save_job_stage, validate_address
+)
+from job_store import STAGE_EXTRACTED, JobStore, stage_reached
+from memory import DEFAULT_GLOBAL_MEMORY_BYTES, DEFAULT_SESSION_MEMORY_BYTES, MemoryBudget, PageMemo
+from metrics import PIPELINE_STAGES, StageTimer
+from providers import DEFAULT_ANTHROPIC_MODEL, FAST_ANTHROPIC_MODEL, build_provider, get_provider
+from prefilter import SKIP_BLANK, SKIP_NOT_DOCUMENT, SKIP_UNREADABLE, blank_page_reason, prefilter_document
+from scheduler import PRIORITY_INTERACTIVE, request_priority
 
 # Set page configuration
 st.set_page_config(
@@ -19,349 +20,235 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
-# Set dark mode theme
-st.markdown("""
+# st.set_page_config(page_title="Document OCR with Address Validation", layout="wide")
+
+# Dark mode theme and custom styling; Streamlit needs it on every run, so
+# it goes out as a single element
+PAGE_CSS = """
 <style>
-    .reportview-container {
-        background-color: #1E1E1E;
-        color: #ffffff;
-    }
-    .sidebar .sidebar-content {
-        background-color: #252526;
-        color: #ffffff;
-    }
-    h1, h2, h3, h4, h5, h6 {
-        color: #ffffff;
-    }
-    .stButton>button {
-        background-color: #0078D7;
-        color: white;
-    }
-    .stTextInput>div>div>input {
-        color: #d6dadf;
-    }
-    .stSelectbox>div>div>div {
-        color: #d6dadf;
-    }
+.reportview-container {
+    background-color: #1E1E1E;
+    color: #ffffff;
+}
+.sidebar .sidebar-content {
+    background-color: #252526;
+    color: #ffffff;
+}
+h1, h2, h3, h4, h5, h6 {
+    color: #ffffff;
+}
+.stButton>button {
+    background-color: #0078D7;
+    color: white;
+}
+.stTextInput>div>div>input {
+    color: #d6dadf;
+}
+.stSelectbox>div>div>div {
+    color: #d6dadf;
+}
+.main-header {
+    font-size: 2.5rem;
+    color: #1E88E5;
+    font-weight: 700;
+    margin-bottom: 1rem;
+    text-align: center;
+}
+.sub-header {
+    font-size: 1.5rem;
+    color: #d6dadf;
+    font-weight: 600;
+    margin-top: 1rem;
+    margin-bottom: 0.5rem;
+}
+.card {
+    background-color: white;
+    border-radius: 10px;
+    padding: 20px;
+    box-shadow: 0 4px 8px rgba(0,0,0,0.1);
+    margin-bottom: 20px;
+    color: #333333;
+}
+.info-card {
+    background-color: #f1f8ff;
+    border-left: 5px solid #1E88E5;
+    padding: 15px;
+    border-radius: 5px;
+    margin-bottom: 15px;
+    color: #333333;
+}
+.success-card {
+    background-color: #edfaef;
+    border-left: 5px solid #4CAF50;
+    padding: 15px;
+    border-radius: 5px;
+    margin-bottom: 15px;
+    color: #333333;
+}
+.warning-card {
+    background-color: #fff8e1;
+    border-left: 5px solid #FFC107;
+    padding: 15px;
+    border-radius: 5px;
+    margin-bottom: 15px;
+    color: #333333;
+}
+.error-card {
+    background-color: #ffebee;
+    border-left: 5px solid #F44336;
+    padding: 15px;
+    border-radius: 5px;
+    margin-bottom: 15px;
+    color: #333333;
+}
+.highlight {
+    font-weight: 600;
+    color: #1E88E5;
+}
+.confidence-bar-bg {
+    width: 100%;
+    height: 20px;
+    background-color: #f0f0f0;
+    border-radius: 10px;
+    margin-top: 10px;
+}
+.confidence-bar {
+    height: 20px;
+    background-color: #4CAF50;
+    border-radius: 10px;
+    text-align: center;
+    color: white;
+    font-weight: bold;
+}
+.field-label {
+    font-weight: 600;
+    color: #333333;
+    margin-bottom: 5px;
+}
+.field-value {
+    padding: 10px;
+    background-color: #f8f9fa;
+    border-radius: 5px;
+    margin-bottom: 15px;
+    color: #333333;
+}
+.sidebar-content {
+    background-color: #f8f9fa;
+    padding: 15px;
+    border-radius: 5px;
+    margin-top: 20px;
+    color: #333333;
+}
+.footer {
+    text-align: center;
+    margin-top: 30px;
+    padding-top: 20px;
+    border-top: 1px solid #eee;
+    color: #888;
+    font-size: 0.8rem;
+}
 </style>
-""", unsafe_allow_html=True)
+"""
 
-# st.set_page_config(page_title="Document OCR with Address Validation", layout="wide")
+# How long to wait for another session analyzing the same document
+JOB_WAIT_SECONDS = 120
 
-def encode_image(image_data):
+# Why a document was not sent to the model
+SKIP_MESSAGES = {
+    SKIP_BLANK: "This page looks blank.",
+    SKIP_NOT_DOCUMENT: "This looks like a photo rather than a text document.",
+    SKIP_UNREADABLE: "This image could not be read.",
+}
+
+@st.cache_resource
+def get_result_cache():
     """
-    Encode the image file to base64 for OpenAI API
+    Shared on-disk cache of document analysis results
+    Created once per process and reused across reruns and sessions
     """
-    try:
-        # Open the image using PIL
-        if isinstance(image_data, (io.BytesIO, io.BufferedReader)):
-            img = Image.open(image_data)
-        else:
-            img = Image.open(io.BytesIO(image_data))
+    return ResultCache(table="document_results")
 
-        # Convert to RGB if necessary
-        if img.mode not in ('RGB', 'L'):
-            img = img.convert('RGB')
+@st.cache_resource
+def get_geocode_cache():
+    """
+    Shared on-disk cache of Geoapify lookups keyed by normalized address
+    """
+    return ResultCache(table="geocode_results", max_entries=50000)
 
-        # Save as JPEG
-        img_byte_array = io.BytesIO()
-        img.save(img_byte_array, format='JPEG', quality=95)
-        binary_data = img_byte_array.getvalue()
-        
-        # Encode as base64
-        base64_string = base64.b64encode(binary_data).decode('utf-8')
-        
-        return base64_string
-    except Exception as e:
-        st.error(f"Error encoding image: {str(e)}")
-        raise
+@st.cache_resource
+def get_job_store():
+    """
+    Shared job store, so identical uploads from concurrent sessions are
+    analyzed once
+    """
+    return JobStore()
 
-def process_document(document_file, api_key, model_name="gpt-4-vision-preview"):
+@st.cache_resource
+def get_memory_budget():
     """
-    Process the uploaded document using OpenAI's GPT-4 Vision API
+    Cap on rendered pages held in memory by all sessions together
     """
-    try:
-        # Configure OpenAI API key
-        openai.api_key = api_key
+    return MemoryBudget(DEFAULT_GLOBAL_MEMORY_BYTES)
 
-        # Read the image data
-        image_data = document_file.read()
-        document_file.seek(0)  # Reset file pointer
-        
-        # Encode the image
-        base64_image = encode_image(image_data)
-        
-        prompt = """Analyze this document and provide information in JSON format.
-1. First determine if this is a bank statement (look for elements like transactions, balances, bank name)
-2. Extract the following whether it's a bank statement or other document:
-   - Person's full name
-   - Complete address
-   - Document date or period
-3. Return the data in this exact JSON format:
-{
-    "is_bank_statement": true/false,
-    "name": "[full name]",
-    "address": "[complete address]",
-    "document_date": "[statement date/period]"
-}
+def get_page_memo():
+    """
+    This session's memo of rendered pages, under its own memory budget
+    """
+    if 'page_memo' not in st.session_state:
+        budget = MemoryBudget(DEFAULT_SESSION_MEMORY_BYTES, parent=get_memory_budget(), name='session')
+        st.session_state.page_memo = PageMemo(budget)
+    return st.session_state.page_memo
 
-If you cannot extract certain information, use empty strings for those fields.
-Respond ONLY with the JSON, no other text."""
-        
-        # Prepare the API request
-        with st.spinner("Analyzing document with GPT-4 Vision..."):
-            response = openai.chat.completions.create(
-                model=model_name,
-                messages=[
-                    {
-                        "role": "user",
-                        "content": [
-                            {"type": "text", "text": prompt},
-                            {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": f"data:image/jpeg;base64,{base64_image}",
-                                    "detail": "high"
-                                }
-                            }
-                        ]
-                    }
-                ],
-                max_tokens=1024,
-                temperature=0
-            )
-        
-        # Extract the response text
-        response_text = response.choices[0].message.content
-        
-        # Parse the JSON response
-        try:
-            # Strip any markdown formatting that might be present
-            cleaned_text = response_text.strip()
-            if cleaned_text.startswith("```json"):
-                cleaned_text = cleaned_text.replace("```json", "", 1)
-            if cleaned_text.endswith("```"):
-                cleaned_text = cleaned_text[:-3]
-            cleaned_text = cleaned_text.strip()
-            
-            extracted_info = json.loads(cleaned_text)
-        except json.JSONDecodeError:
-            st.error("Could not parse GPT's response as JSON")
-            st.code(response_text, language="json")
-            extracted_info = {
-                'is_bank_statement': False,
-                'name': '',
-                'address': '',
-                'document_date': '',
-                'error': 'Failed to parse response'
-            }
-        
-        # Ensure all required fields are present
-        required_fields = ['is_bank_statement', 'name', 'address', 'document_date']
-        for field in required_fields:
-            if field not in extracted_info:
-                extracted_info[field] = ''
-                
-        return extracted_info
-        
-    except Exception as e:
-        st.error(f"Error in process_document: {str(e)}")
-        return {
-            'is_bank_statement': False,
-            'name': '',
-            'address': '',
-            'document_date': '',
-            'error': str(e)
-        }
+def prepare_page(uploaded_file, content_hash, document_type, grayscale):
+    """
+    prepare_document_image, memoized per session so a rerun (e.g. after
+    switching models) doesn't render the PDF again
+    Images are sent as uploaded and returned unchanged
+    """
+    if not is_pdf(uploaded_file):
+        return uploaded_file
+    page_memo = get_page_memo()
+    key = (content_hash, document_type, grayscale)
+    page = page_memo.get(key)
+    if page is None:
+        rendered = prepare_document_image(uploaded_file, document_type=document_type, grayscale=grayscale)
+        page = page_memo.put(key, rendered.getvalue())
+    return page.open()
 
-def geocode_address(address, api_key):
+@st.cache_resource
+def get_router(openai_api_key, anthropic_api_key):
     """
-    Geocode an address using Geoapify API
-    Returns the API response or None if error
+    Latency-aware router over GPT-4o and Claude
+    Shared across reruns so its latency and error statistics accumulate
     """
-    try:
-        # URL encode the address
-        encoded_address = quote(address)
-        
-        # Make request to Geoapify
-        geoapify_api_url = "https://api.geoapify.com/v1/geocode/search"
-        response = requests.get(
-            f"{geoapify_api_url}?text={encoded_address}&apiKey={api_key}"
-        )
-        
-        # Check response status
-        if response.status_code != 200:
-            st.error(f"Geoapify API error: {response.text}")
-            return None
-            
-        # Return the full API response
-        return response.json()
-        
-    except Exception as e:
-        st.error(f"Error geocoding address: {str(e)}")
-        return None
+    return build_provider(
+        ["openai:gpt-4o", f"anthropic:{DEFAULT_ANTHROPIC_MODEL}"],
+        {'openai': openai_api_key, 'anthropic': anthropic_api_key}
+    )
 
-def validate_address(address, api_key):
+def get_vision_providers(provider_name, model_name, cascade, openai_api_key, anthropic_api_key):
     """
-    Validate an address using Geoapify API
-    Returns a dict with validation results including confidence metrics
+    Vision provider for the selected model (None means OpenAI via
+    openai_api_key) and, with cascade, the cheap first-tier provider
+    Providers are process-wide, so their clients are created once
     """
-    try:
-        # Get geocoding results for the address
-        with st.spinner("Validating address..."):
-            result = geocode_address(address, api_key)
-        
-        # Initialize response structure
-        validation_result = {
-            'is_valid': False,
-            'confidence': 0.0,
-            'details': result,
-            'error': None
-        }
-        
-        # If geocoding failed
-        if not result:
-            validation_result['error'] = 'Could not geocode address'
-            return validation_result
-            
-        # Get the best match (first result) if available
-        match = (result.get('features', []) or [{}])[0]
-        
-        # Get confidence details from the best match
-        confidence_details = match.get('properties', {}).get('rank', {})
-        
-        # Calculate overall confidence
-        if confidence_details:
-            # Get the confidence score
-            confidence_score = confidence_details.get('confidence', 0)
-            validation_result['confidence'] = confidence_score
-            
-            # Consider valid if the match has high confidence
-            validation_result['is_valid'] = confidence_score >= 0.8
-            
-            # Add the confidence details to the response
-            validation_result['confidence_details'] = confidence_details
-            
-            # Add formatted address
-            validation_result['formatted_address'] = match.get('properties', {}).get('formatted')
-        
-        return validation_result
-        
-    except Exception as e:
-        st.error(f"Error validating address: {str(e)}")
-        return {
-            'is_valid': False,
-            'confidence': 0.0,
-            'error': str(e),
-            'details': None
-        }
+    provider = None
+    if provider_name == 'anthropic':
+        provider = get_provider('anthropic', anthropic_api_key, model_name)
+    elif provider_name == 'router':
+        provider = get_router(openai_api_key, anthropic_api_key)
+
+    # First tier of the cascade: the small model of whichever vendor we have a key for
+    cheap_provider = None
+    if cascade and openai_api_key:
+        cheap_provider = get_provider('openai', openai_api_key, CASCADE_MODEL)
+    elif cascade and anthropic_api_key:
+        cheap_provider = get_provider('anthropic', anthropic_api_key, FAST_ANTHROPIC_MODEL)
+    return provider, cheap_provider
 
 def main():
     # Custom CSS for better styling
-    st.markdown("""
-    <style>
-    .main-header {
-        font-size: 2.5rem;
-        color: #1E88E5;
-        font-weight: 700;
-        margin-bottom: 1rem;
-        text-align: center;
-    }
-    .sub-header {
-        font-size: 1.5rem;
-        color: #d6dadf;
-        font-weight: 600;
-        margin-top: 1rem;
-        margin-bottom: 0.5rem;
-    }
-    .card {
-        background-color: white;
-        border-radius: 10px;
-        padding: 20px;
-        box-shadow: 0 4px 8px rgba(0,0,0,0.1);
-        margin-bottom: 20px;
-        color: #333333;
-    }
-    .info-card {
-        background-color: #f1f8ff;
-        border-left: 5px solid #1E88E5;
-        padding: 15px;
-        border-radius: 5px;
-        margin-bottom: 15px;
-        color: #333333;
-    }
-    .success-card {
-        background-color: #edfaef;
-        border-left: 5px solid #4CAF50;
-        padding: 15px;
-        border-radius: 5px;
-        margin-bottom: 15px;
-        color: #333333;
-    }
-    .warning-card {
-        background-color: #fff8e1;
-        border-left: 5px solid #FFC107;
-        padding: 15px;
-        border-radius: 5px;
-        margin-bottom: 15px;
-        color: #333333;
-    }
-    .error-card {
-        background-color: #ffebee;
-        border-left: 5px solid #F44336;
-        padding: 15px;
-        border-radius: 5px;
-        margin-bottom: 15px;
-        color: #333333;
-    }
-    .highlight {
-        font-weight: 600;
-        color: #1E88E5;
-    }
-    .confidence-bar-bg {
-        width: 100%;
-        height: 20px;
-        background-color: #f0f0f0;
-        border-radius: 10px;
-        margin-top: 10px;
-    }
-    .confidence-bar {
-        height: 20px;
-        background-color: #4CAF50;
-        border-radius: 10px;
-        text-align: center;
-        color: white;
-        font-weight: bold;
-    }
-    .field-label {
-        font-weight: 600;
-        color: #333333;
-        margin-bottom: 5px;
-    }
-    .field-value {
-        padding: 10px;
-        background-color: #f8f9fa;
-        border-radius: 5px;
-        margin-bottom: 15px;
-        color: #333333;
-    }
-    .sidebar-content {
-        background-color: #f8f9fa;
-        padding: 15px;
-        border-radius: 5px;
-        margin-top: 20px;
-        color: #333333;
-    }
-    .footer {
-        text-align: center;
-        margin-top: 30px;
-        padding-top: 20px;
-        border-top: 1px solid #eee;
-        color: #888;
-        font-size: 0.8rem;
-    }
-    </style>
-    """, unsafe_allow_html=True)
+    st.markdown(PAGE_CSS, unsafe_allow_html=True)
 
     # Header
     st.markdown("<h1 class='main-header'>📄 Smart Document Analyzer</h1>", unsafe_allow_html=True)
@@ -383,17 +270,70 @@ def main():
         # st.markdown("<div class='sidebar-content' style='color:#333333;'>", unsafe_allow_html=True)
         st.subheader("🔑 API Keys")
         openai_api_key = st.text_input("OpenAI API Key", type="password", help="Required for document analysis")
+        anthropic_api_key = st.text_input("Anthropic API Key", type="password", help="Optional, enables Claude models")
         geoapify_api_key = st.text_input("Geoapify API Key", type="password", help="Required for address validation")
         
         # Model selection with visuals
         st.subheader("🤖 AI Model")
         model_options = {
-            "GPT-4 Vision": "gpt-4-vision-preview",
-            "GPT-4o": "gpt-4o"
+            "GPT-4 Vision": ("openai", "gpt-4-vision-preview"),
+            "GPT-4o": ("openai", "gpt-4o"),
+            "Claude 3.5 Sonnet": ("anthropic", DEFAULT_ANTHROPIC_MODEL),
+            "Fastest available (GPT-4o or Claude)": ("router", None)
         }
-        selected_model = st.selectbox("Select OpenAI Model", list(model_options.keys()))
-        model_name = model_options[selected_model]
+        selected_model = st.selectbox(
+            "Select Vision Model", list(model_options.keys()),
+            help="Fastest available routes each document by recent latency and errors, and fails over on timeouts"
+        )
+        provider_name, model_name = model_options[selected_model]
+        cascade = st.checkbox(
+            "⚡ Fast model first", value=False,
+            help="A small model reads a low-detail image first; the selected model is only used when fields are missing or Geoapify finds the address only with low confidence"
+        )
         st.markdown("</div>", unsafe_allow_html=True)
+
+        # PDF rendering options
+        st.subheader("🖨️ PDF Rendering")
+        document_type_options = {
+            "Bank Statement": "statement",
+            "Utility Bill": "utility_bill",
+            "Receipt": "receipt",
+            "ID Card": "id_card"
+        }
+        selected_document_type = st.selectbox(
+            "Document Type", list(document_type_options.keys()),
+            help="Sets the resolution PDFs are rendered at; small print needs more detail"
+        )
+        document_type = document_type_options[selected_document_type]
+        all_pages = st.checkbox(
+            "Process all PDF pages", value=False,
+            help="Pages are analyzed in order until name, address and date have all been found"
+        )
+
+        # Image size sent to the model
+        st.subheader("🖼️ Image Size")
+        token_budget_options = {
+            "Maximum detail": None,
+            "Balanced (≤ 765 image tokens)": 765,
+            "Economy (≤ 425 image tokens)": 425
+        }
+        selected_token_budget = st.selectbox(
+            "Image Token Budget", list(token_budget_options.keys()),
+            help="Images are downscaled to fit the budget, never below a legible size"
+        )
+        token_budget = token_budget_options[selected_token_budget]
+        grayscale = st.checkbox("Send images in grayscale", value=True, help="Smaller uploads, same text quality")
+        crop_header = st.checkbox(
+            "✂️ Send only the header region", value=False,
+            help="Name, address and date usually sit at the top; the full page is sent if anything is missing"
+        )
+
+        # Local checks before anything is sent to the model
+        st.subheader("🧹 Pre-screening")
+        prescreen = st.checkbox(
+            "Skip blank pages and photos", value=True,
+            help="Checked locally; skipped documents are never sent to the model"
+        )
         
         # Documentation section
         with st.expander("ℹ️ How it works"):
@@ -412,11 +352,29 @@ def main():
     # File uploader with clear instructions
     st.markdown("<h3 class='sub-header' style='color:#d6dadf;'>📎 Upload Document</h3>", unsafe_allow_html=True)
     st.markdown("<p style='color:#d6dadf;'>Upload a document containing personal information such as name, address, and date. Supported formats: JPG, PNG, PDF</p>", unsafe_allow_html=True)
-    uploaded_file = st.file_uploader("", type=["jpg", "jpeg", "png", "pdf"])
+    # A hidden label rather than an empty one, which logs a warning on every rerun
+    uploaded_file = st.file_uploader("Document", type=["jpg", "jpeg", "png", "pdf"], label_visibility="collapsed")
     st.markdown("</div>", unsafe_allow_html=True)
+
+    # Upload removed: free this session's rendered pages right away
+    if uploaded_file is None:
+        get_page_memo().clear()
     
+    # Keys the selected model needs
+    vision_ready = {
+        'openai': bool(openai_api_key),
+        'anthropic': bool(anthropic_api_key),
+        'router': bool(openai_api_key and anthropic_api_key),
+    }[provider_name]
+
     # Process the document if we have all we need
-    if uploaded_file and openai_api_key and geoapify_api_key:
+    if uploaded_file and vision_ready and geoapify_api_key:
+        # Clients are only built once there is a document, so the idle page
+        # never loads the vision SDKs
+        provider, cheap_provider = get_vision_providers(
+            provider_name, model_name, cascade, openai_api_key, anthropic_api_key
+        )
+
         # Create a three-column layout for better organization
         col1, col2 = st.columns([1, 1])
         
@@ -427,27 +385,125 @@ def main():
             # Handle PDF display differently
             if is_pdf(uploaded_file):
                 st.markdown(f"<div class='info-card' style='color:#d6dadf;'><b>PDF File:</b> {uploaded_file.name}</div>", unsafe_allow_html=True)
-                st.info("The first page of this PDF will be processed")
+                if all_pages:
+                    st.info("Pages will be processed in order until name, address and date are found")
+                else:
+                    st.info("The first page of this PDF will be processed")
             else:
                 st.image(uploaded_file, use_column_width=True)
             st.markdown("</div>", unsafe_allow_html=True)
         
-        # Show a spinner during processing
-        with st.spinner("Processing document..."):
-            # Prepare document for processing (convert PDF to image if needed)
-            processed_file = prepare_document_image(uploaded_file)
-            
-            # Add artificial delay for better UX
-            progress_bar = st.progress(0)
-            for i in range(100):
-                time.sleep(0.01)
-                progress_bar.progress(i + 1)
-            
-            # Process document with OpenAI
-            extracted_info = process_document(processed_file, openai_api_key, model_name)
+        # Drive the progress bar from the real pipeline stages as they finish
+        progress_bar = st.progress(0)
+
+        def update_progress(stage_name, seconds):
+            completed = sum(1 for stage in PIPELINE_STAGES if stage in timer.durations)
+            progress_bar.progress(
+                int(100 * completed / len(PIPELINE_STAGES)),
+                text=f"{stage_name} finished in {seconds:.2f}s"
+            )
+
+        timer = StageTimer(on_stage=update_progress)
+
+        # Show fields as soon as they stream in, replaced by the full result below
+        with col2:
+            partial_placeholder = st.empty()
+
+        def show_partial(fields):
+            lines = [
+                f"**{label}:** {fields[field]}"
+                for field, label in (('name', '👤 Full Name'), ('address', '🏠 Address'), ('document_date', '📅 Document Date'))
+                if fields.get(field)
+            ]
+            if lines:
+                partial_placeholder.info("Receiving results...\n\n" + "\n\n".join(lines))
+
+        # Set when the cascade already validated the address
+        validation_result = None
+
+        # Identical uploads, from this or any other session, are analyzed once
+        job_store = get_job_store()
+        with st.spinner("Looking for an earlier analysis of this document..."):
+            job, finished = acquire_document_job(
+                job_store, uploaded_file, model_name, {'document_type': document_type, 'grayscale': grayscale},
+                all_pages, token_budget, True, provider=provider, cascade=cheap_provider is not None,
+                cheap_provider=cheap_provider, timeout=JOB_WAIT_SECONDS, crop_header=crop_header
+            )
+
+        if finished is not None:
+            extracted_info, validation_result = finished['extracted'], finished['validation']
+        elif stage_reached(job, STAGE_EXTRACTED):
+            # An earlier run got this far before failing
+            extracted_info, validation_result = job['extracted'], job_validation(job)
+        else:
+            try:
+                # Show a spinner during processing; renew the job's lease meanwhile
+                with st.spinner("Processing document..."), job_heartbeat(job_store, job):
+                    if all_pages and is_pdf(uploaded_file):
+                        # Pages are rendered in parallel and lazily, only as far as needed
+                        pages = iter_pdf_pages(uploaded_file, document_type=document_type, grayscale=grayscale)
+                        with st.spinner(f"Analyzing document pages with {selected_model}..."):
+                            extracted_info = process_document_pages(
+                                pages, openai_api_key, model_name, cache=get_result_cache(), timer=timer,
+                                token_budget=token_budget, grayscale=grayscale,
+                                page_filter=blank_page_reason if prescreen else None, on_partial=show_partial,
+                                provider=provider, crop_header=crop_header
+                            )
+                    else:
+                        # Prepare document for processing (convert PDF to image if needed)
+                        with timer.stage('rasterize'):
+                            processed_file = prepare_page(uploaded_file, job['content_hash'], document_type, grayscale)
+
+                        if prescreen:
+                            # ID cards are colourful with little text, only check them for blank scans
+                            with timer.stage('prefilter'):
+                                screening = prefilter_document(
+                                    processed_file.getvalue(), check_layout=document_type != 'id_card'
+                                )
+                            if screening['skip']:
+                                progress_bar.empty()
+                                job_store.abandon(job['job_key'], job['owner'])
+                                st.warning(
+                                    f"{SKIP_MESSAGES[screening['reason']]} It was not sent for analysis; "
+                                    "untick 'Skip blank pages and photos' in the sidebar to analyze it anyway."
+                                )
+                                st.stop()
+
+                        # Process document with the selected vision model
+                        if cheap_provider is not None:
+                            with st.spinner(f"Analyzing document with {cheap_provider.cache_id}, then {selected_model} if needed..."):
+                                extracted_info, validation_result = process_document_cascade(
+                                    processed_file, openai_api_key, model_name, geoapify_api_key,
+                                    cache=get_result_cache(), geocode_cache=get_geocode_cache(), timer=timer,
+                                    token_budget=token_budget, grayscale=grayscale, on_partial=show_partial,
+                                    provider=provider, cheap_provider=cheap_provider, crop_header=crop_header
+                                )
+                        else:
+                            with st.spinner(f"Analyzing document with {selected_model}..."):
+                                extracted_info = process_document(
+                                    processed_file, openai_api_key, model_name, cache=get_result_cache(), timer=timer,
+                                    token_budget=token_budget, grayscale=grayscale, on_partial=show_partial,
+                                    provider=provider, crop_header=crop_header
+                                )
+            except BaseException as e:
+                # Release the job right away (also when a rerun interrupts us)
+                # instead of holding it until its lease runs out
+                fail_job(job_store, job, e, 'interrupted')
+                raise
+
+            if extracted_info.get('error'):
+                fail_job(job_store, job, extracted_info['error'], 'extract')
+            else:
+                save_job_stage(job_store, job, STAGE_EXTRACTED, extracted=extracted_info, validation=validation_result)
         
-        # Clear the progress bar after processing
+        # Clear the progress bar and partial results after processing
         progress_bar.empty()
+        partial_placeholder.empty()
+
+        if extracted_info.get('error'):
+            st.error(f"Error in process_document: {extracted_info['error']}")
+            if extracted_info.get('raw_response'):
+                st.code(extracted_info['raw_response'], language="json")
         
         with col2:
             st.markdown("<div class='card' style='color:#d6dadf;'>", unsafe_allow_html=True)
@@ -457,6 +513,29 @@ def main():
             doc_type = "Bank Statement" if extracted_info.get('is_bank_statement') else "Document"
             doc_icon = "💳" if extracted_info.get('is_bank_statement') else "📃"
             st.markdown(f"<div class='info-card' style='color:#333333;'><b>{doc_icon} Document Type:</b> {doc_type}</div>", unsafe_allow_html=True)
+
+            if extracted_info.get('pages_processed'):
+                pages_label = ", ".join(str(page) for page in extracted_info['pages_processed'])
+                st.markdown(f"<div class='field-label' style='color:#d6dadf;'>📑 Pages analyzed: {pages_label}</div>", unsafe_allow_html=True)
+            if extracted_info.get('pages_skipped'):
+                skipped_label = ", ".join(str(skipped['page']) for skipped in extracted_info['pages_skipped'])
+                st.markdown(f"<div class='field-label' style='color:#d6dadf;'>🧹 Blank pages skipped: {skipped_label}</div>", unsafe_allow_html=True)
+            if extracted_info.get('cascade'):
+                cascade_info = extracted_info['cascade']
+                if cascade_info['tier'] == 'cheap':
+                    cascade_label = f"answered by {cascade_info['model']}"
+                else:
+                    reason = cascade_info['escalation_reason'].replace('_', ' ')
+                    cascade_label = f"escalated to {cascade_info['model']} ({reason})"
+                st.markdown(f"<div class='field-label' style='color:#d6dadf;'>⚡ Fast model first: {cascade_label}</div>", unsafe_allow_html=True)
+            if extracted_info.get('roi'):
+                if extracted_info['roi']['fallback']:
+                    roi_label = "header was not enough, full page sent"
+                elif extracted_info['roi']['box']:
+                    roi_label = "header region only"
+                else:
+                    roi_label = "no header region found, full page sent"
+                st.markdown(f"<div class='field-label' style='color:#d6dadf;'>✂️ Sent to the model: {roi_label}</div>", unsafe_allow_html=True)
             
             # Display extracted information in a clear, styled format
             if extracted_info.get('name'):
@@ -479,7 +558,11 @@ def main():
             st.markdown("<h3 class='sub-header' style='color:#d6dadf;'>🌎 Address Validation</h3>", unsafe_allow_html=True)
             
             # Perform address validation
-            validation_result = validate_address(extracted_info['address'], geoapify_api_key)
+            if validation_result is None:
+                with st.spinner("Validating address..."):
+                    validation_result = validate_address(
+                        extracted_info['address'], geoapify_api_key, timer=timer, cache=get_geocode_cache()
+                    )
             
             if validation_result['is_valid']:
                 st.markdown("<div class='success-card' style='color:#d6dadf;'>✅ Address validated successfully!</div>", unsafe_allow_html=True)
@@ -546,12 +629,28 @@ def main():
                             st.markdown(f"<div class='field-value' style='color:#333333;'>Lat: {properties.get('lat')}<br>Lon: {properties.get('lon')}</div>", unsafe_allow_html=True)
             
             st.markdown("</div>", unsafe_allow_html=True)
+
+        # Record the outcome so identical uploads are served from the job store
+        if job is not None and not extracted_info.get('error'):
+            finish_job(job_store, job, validation_result, timer.as_dict())
+        elif finished is not None and finished.get('job', {}).get('deduplicated'):
+            st.info("This document was analyzed before with the same settings; showing the stored result.")
+
+        # Measured duration of each pipeline stage for this document
+        with st.expander(f"⏱️ Processing Time ({timer.total():.2f}s)"):
+            for stage_name, seconds in timer.as_dict().items():
+                st.markdown(f"<div class='field-label' style='color:#d6dadf;'>{stage_name}: {seconds:.3f}s</div>", unsafe_allow_html=True)
     
-    elif not openai_api_key:
-        st.markdown("""
+    elif not vision_ready:
+        required_keys = {
+            'openai': "OpenAI API Key",
+            'anthropic': "Anthropic API Key",
+            'router': "OpenAI and Anthropic API Keys"
+        }[provider_name]
+        st.markdown(f"""
         <div class='warning-card' style='color:#d6dadf;'>
-            <b>⚠️ OpenAI API Key Required</b><br>
-            Please enter your OpenAI API Key in the sidebar to enable document analysis.
+            <b>⚠️ {required_keys} Required</b><br>
+            Please enter your {required_keys} in the sidebar to enable document analysis with {selected_model}.
         </div>
         """, unsafe_allow_html=True)
     elif not geoapify_api_key:
@@ -581,4 +680,6 @@ def main():
                 st.write("• ID cards")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    # Model calls from the UI go ahead of batch work sharing this process
+    with request_priority(PRIORITY_INTERACTIVE):
+        main()
\ No newline at end of file
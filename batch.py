@@ -0,0 +1,655 @@
+"""
+Headless batch processing for Smart Document Analyzer
+
+Runs the prepare_document_image -> process_document -> validate_address
+pipeline over a directory or manifest of files and streams one JSON line
+per document to the output file as soon as it finishes.
+
+Usage:
+    python batch.py scans/ --output results.jsonl
+    python batch.py manifest.txt --output results.jsonl --api-workers 16
+
+Re-running with the same output file resumes: documents that already have
+a successful (or deliberately skipped) record are not processed again.
+With --job-store, documents are also tracked by content hash across runs
+and file names: finished ones are never analyzed twice, and interrupted
+or failed ones resume after their last finished stage.
+"""
+import argparse
+import hashlib
+import io
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+from dotenv import load_dotenv
+
+from cache import ResultCache
+from document_processor import (
+    CASCADE_MODEL, acquire_document_job, fail_job, finish_job, job_summary, job_validation, process_document,
+    process_document_cascade, process_document_pages, process_documents_packed, save_job_stage, validate_address,
+    validate_addresses
+)
+from job_store import STAGE_EXTRACTED, STAGE_RASTERIZED, JobStore, stage_reached
+from metrics import StageTimer, registry, span, summarize_timings
+from pdf_handler import DPI_BY_DOCUMENT_TYPE, iter_pdf_pages, prepare_document_image
+from prefilter import RecentDocuments, blank_page_reason, prefilter_document
+from providers import DEFAULT_PROVIDER_TIMEOUT, ProviderRouter, build_provider
+from response_parser import parse_stats
+from scheduler import DEFAULT_RPM_LIMIT, DEFAULT_TPM_LIMIT, configure_limits, scheduler_stats
+
+logger = logging.getLogger(__name__)
+
+SUPPORTED_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.pdf')
+
+def collect_inputs(source):
+    """
+    Collect document paths from a directory (recursively) or a manifest file
+    Manifest files list one path per line; relative paths are resolved
+    against the manifest's directory and lines starting with # are ignored
+    """
+    # Absolute paths keep resume working regardless of the working directory
+    if os.path.isdir(source):
+        paths = []
+        for root, _, files in os.walk(source):
+            for name in files:
+                if name.lower().endswith(SUPPORTED_EXTENSIONS):
+                    paths.append(os.path.abspath(os.path.join(root, name)))
+        return sorted(paths)
+
+    base_dir = os.path.dirname(os.path.abspath(source))
+    paths = []
+    with open(source, encoding='utf-8') as manifest:
+        for line in manifest:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            paths.append(os.path.abspath(os.path.join(base_dir, line)))
+    return paths
+
+def load_completed(output_path):
+    """
+    Read an existing (possibly partial) JSONL output file
+    Returns the set of input paths that already finished successfully or
+    were skipped by the pre-filter
+    """
+    completed = set()
+    if not os.path.exists(output_path):
+        return completed
+
+    with open(output_path, encoding='utf-8') as output:
+        for line in output:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # A crash can leave a truncated last line behind
+                continue
+            if record.get('status') in ('ok', 'skipped'):
+                completed.add(record['path'])
+    return completed
+
+def file_sha256(path):
+    """
+    SHA-256 of a file's content, read in blocks
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as document:
+        for block in iter(lambda: document.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def ends_with_newline(path):
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return True
+    with open(path, 'rb') as output:
+        output.seek(-1, os.SEEK_END)
+        return output.read(1) == b'\n'
+
+def rasterize_document(path, render_options=None):
+    """
+    Load a document from disk and convert it to JPEG bytes if it is a PDF
+    render_options are passed through to prepare_document_image
+    Runs in a worker process, so it only takes and returns picklable values
+    """
+    with open(path, 'rb') as document:
+        document_file = io.BytesIO(document.read())
+    document_file.name = os.path.basename(path)
+
+    prepared = prepare_document_image(document_file, **(render_options or {}))
+    return prepared.getvalue()
+
+class BatchProcessor:
+    """
+    Runs the document pipeline with a separate concurrency limit per stage
+
+    - render_workers: processes used for PDF rasterization (CPU-bound)
+    - api_workers: concurrent vision model calls (I/O-bound)
+    - geocode_workers: concurrent Geoapify lookups (I/O-bound)
+
+    render_options (dpi, document_type, size, grayscale) control how PDFs
+    are rasterized; with all_pages, PDF pages are analyzed in order until
+    the required fields are found; token_budget caps image tokens per page
+
+    With bulk_validate_size, addresses are not validated one by one but
+    collected and validated together (deduplicated, through Geoapify's batch
+    geocoding endpoint) every bulk_validate_size documents
+
+    With pack_size, up to pack_size documents share one vision request
+    (PDFs analyzed with all_pages are still sent on their own)
+
+    With prefilter, blank pages and images that don't look like documents
+    are skipped locally (status 'skipped' with a skip_reason) instead of
+    being sent to the model; skip_duplicates also skips near-duplicates of
+    documents seen earlier in the run
+
+    provider (see providers.py) replaces the OpenAI model given by
+    openai_api_key and model_name, e.g. a ProviderRouter over several
+
+    With cascade, single images are read by a fast model at low detail
+    first (cheap_provider, CASCADE_MODEL by default) and only escalated to
+    the full model when fields are missing or the address geocodes with low confidence
+    (packed groups and all_pages PDFs always use the full model)
+
+    With crop_header, only the header/address block of each page is sent
+    when that yields every field (see layout.py; not for packed groups)
+
+    With a JobStore, every document not sent in a packed group is tracked
+    by content hash: finished documents are taken from the store, and
+    failed ones resume after their last finished stage. Jobs are keyed
+    like analyze_document's, so a document analyzed in the UI or over HTTP
+    with the same options isn't analyzed again
+    """
+
+    def __init__(self, openai_api_key, geoapify_api_key, model_name="gpt-4o",
+                 api_workers=8, geocode_workers=4, render_workers=None,
+                 validate=True, cache=None, render_options=None, all_pages=False, token_budget=None,
+                 geocode_cache=None, bulk_validate_size=None, pack_size=None, prefilter=False,
+                 skip_duplicates=False, provider=None, cascade=False, cheap_provider=None, job_store=None,
+                 crop_header=False):
+        self.openai_api_key = openai_api_key
+        self.geoapify_api_key = geoapify_api_key
+        self.model_name = model_name
+        self.api_workers = api_workers
+        self.geocode_workers = geocode_workers
+        self.render_workers = render_workers or os.cpu_count() or 1
+        self.validate = validate
+        self.cache = cache
+        self.render_options = render_options or {}
+        self.all_pages = all_pages
+        self.token_budget = token_budget
+        self.geocode_cache = geocode_cache
+        self.bulk_validate_size = bulk_validate_size
+        self.pack_size = pack_size
+        self.prefilter = prefilter
+        self.recent_documents = RecentDocuments() if skip_duplicates else None
+        self.provider = provider
+        self.cascade = cascade
+        self.cheap_provider = cheap_provider
+        self.job_store = job_store
+        self.crop_header = crop_header
+        self._api_slots = threading.BoundedSemaphore(api_workers)
+        self._geocode_slots = threading.BoundedSemaphore(geocode_workers)
+
+    def run(self, paths):
+        """
+        Process the given paths concurrently
+        Yields one result record per document, in completion order
+        """
+        if self.validate and self.bulk_validate_size:
+            yield from self._run_with_bulk_validation(paths)
+        else:
+            yield from self._run_pipeline(paths, validate=self.validate)
+
+    def _run_with_bulk_validation(self, paths):
+        chunk = []
+        for record in self._run_pipeline(paths, validate=False):
+            chunk.append(record)
+            if len(chunk) >= self.bulk_validate_size:
+                yield from self._validate_chunk(chunk)
+                chunk = []
+        if chunk:
+            yield from self._validate_chunk(chunk)
+
+    def _validate_chunk(self, records):
+        to_validate = [
+            record for record in records
+            if record['status'] == 'ok' and record['extracted'].get('address') and 'validation' not in record
+        ]
+        if to_validate:
+            timer = StageTimer()
+            with timer.stage('geocode'):
+                results = validate_addresses(
+                    [record['extracted']['address'] for record in to_validate],
+                    self.geoapify_api_key, cache=self.geocode_cache, max_workers=self.geocode_workers
+                )
+            # Spread the bulk lookup time evenly for per-stage statistics
+            per_record = round(timer.durations['geocode'] / len(to_validate), 4)
+            for record, validation_result in zip(to_validate, results):
+                record['validation'] = validation_result
+                record['timings']['geocode'] = per_record
+        # Their jobs were left open until now (see _finish_record)
+        for record in records:
+            job = record.pop('_job', None)
+            finish_job(self.job_store, job, record.get('validation'), record['timings'])
+        return records
+
+    def _run_pipeline(self, paths, validate):
+        # Enough threads for every stage to be saturated at once; the
+        # semaphores enforce the per-stage limits
+        thread_count = self.api_workers + self.geocode_workers
+        max_pending = thread_count * 2
+
+        with ProcessPoolExecutor(max_workers=self.render_workers) as render_pool, \
+                ThreadPoolExecutor(max_workers=thread_count) as thread_pool:
+            remaining = self._work_items(paths)
+            pending = set()
+
+            while True:
+                # Keep a bounded number of documents in flight
+                for group in remaining:
+                    pending.add(thread_pool.submit(self._process_group, group, render_pool, validate))
+                    if len(pending) >= max_pending:
+                        break
+
+                if not pending:
+                    break
+
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield from future.result()
+
+    def _work_items(self, paths):
+        # Groups of paths that are analyzed together; single paths unless packing
+        if not self.pack_size or self.pack_size < 2:
+            for path in paths:
+                yield [path]
+            return
+
+        group = []
+        for path in paths:
+            if self.all_pages and path.lower().endswith('.pdf'):
+                yield [path]
+                continue
+            group.append(path)
+            if len(group) >= self.pack_size:
+                yield group
+                group = []
+        if group:
+            yield group
+
+    def _process_group(self, paths, render_pool, validate):
+        if len(paths) == 1:
+            return [self._process_path(paths[0], render_pool, validate)]
+        return self._process_packed(paths, render_pool, validate)
+
+    def _process_path(self, path, render_pool, validate):
+        record = {'path': path, 'status': 'error'}
+        timer = StageTimer()
+        started = time.perf_counter()
+        job = None
+        try:
+            with span('process_path', path=path):
+                finished = False
+                if self.job_store is not None:
+                    job, finished = self._acquire_job(path, record)
+                if not finished and self.all_pages and path.lower().endswith('.pdf'):
+                    extracted_info = self._process_pdf_pages(path, render_pool, record, timer, job)
+                elif not finished:
+                    extracted_info = self._process_single_image(path, render_pool, record, timer, validate, job)
+                if not finished and extracted_info is not None:
+                    self._finish_record(record, extracted_info, timer, validate, job)
+        except Exception as e:
+            logger.exception("Failed to process %s", path)
+            record['error'] = str(e)
+            fail_job(self.job_store, job, e, 'error')
+
+        record['duration_seconds'] = round(time.perf_counter() - started, 3)
+        record['timings'] = timer.as_dict()
+        return record
+
+    def _process_packed(self, paths, render_pool, validate):
+        records = [{'path': path, 'status': 'error'} for path in paths]
+        timers = [StageTimer() for _ in paths]
+        started = time.perf_counter()
+
+        # Documents that fail to load are reported alone, the rest are packed
+        loaded = []
+        for record, timer in zip(records, timers):
+            try:
+                image_bytes = self._load_image(record['path'], render_pool, record, timer)
+                if not self._screen(record, image_bytes, timer):
+                    loaded.append((record, timer, image_bytes))
+            except Exception as e:
+                logger.exception("Failed to process %s", record['path'])
+                record['error'] = str(e)
+
+        if loaded:
+            try:
+                with self._api_slots:
+                    extractions = process_documents_packed(
+                        [image_bytes for _, _, image_bytes in loaded], self.openai_api_key, self.model_name,
+                        cache=self.cache, timers=[timer for _, timer, _ in loaded],
+                        token_budget=self.token_budget, grayscale=self.render_options.get('grayscale', False),
+                        provider=self.provider
+                    )
+                for (record, timer, _), extracted_info in zip(loaded, extractions):
+                    self._finish_record(record, extracted_info, timer, validate)
+            except Exception as e:
+                logger.exception("Failed to process packed group starting with %s", paths[0])
+                for record, _, _ in loaded:
+                    record['error'] = str(e)
+
+        duration = round(time.perf_counter() - started, 3)
+        for record, timer in zip(records, timers):
+            record['duration_seconds'] = duration
+            record['timings'] = timer.as_dict()
+        return records
+
+    def _acquire_job(self, path, record):
+        # Returns (job, finished); finished means record is already complete
+        with open(path, 'rb') as document:
+            job, finished = acquire_document_job(
+                self.job_store, document, self.model_name, self.render_options, self.all_pages, self.token_budget,
+                self.validate, provider=self.provider, cascade=self.cascade, cheap_provider=self.cheap_provider,
+                timeout=self.job_store.lease_seconds, crop_header=self.crop_header
+            )
+        if finished is not None:
+            record.update(extracted=finished['extracted'], job=finished['job'])
+            if finished['extracted'].get('error'):
+                record['error'] = finished['extracted']['error']
+            else:
+                record['status'] = 'ok'
+                if finished['validation'] is not None:
+                    record['validation'] = finished['validation']
+            return None, True
+
+        record['job'] = job_summary(job)
+        return job, False
+
+    def _finish_record(self, record, extracted_info, timer, validate, job=None):
+        record['extracted'] = extracted_info
+        if extracted_info.get('error'):
+            record['error'] = extracted_info['error']
+            # A failed document must not make its retry look like a duplicate
+            if self.recent_documents is not None and record.get('prefilter', {}).get('hash'):
+                self.recent_documents.forget(record['prefilter']['hash'])
+            fail_job(self.job_store, job, extracted_info['error'], 'extract')
+            return
+
+        if not stage_reached(job, STAGE_EXTRACTED):
+            save_job_stage(self.job_store, job, STAGE_EXTRACTED, extracted=extracted_info,
+                           validation=record.get('validation'))
+
+        # The cascade may already have validated the address
+        if validate and extracted_info.get('address') and 'validation' not in record:
+            with self._geocode_slots:
+                record['validation'] = validate_address(
+                    extracted_info['address'], self.geoapify_api_key, timer=timer,
+                    cache=self.geocode_cache
+                )
+        record['status'] = 'ok'
+
+        if self.validate and not validate:
+            # Bulk validation comes later; _validate_chunk finishes the job
+            if job is not None:
+                record['_job'] = job
+            return
+        finish_job(self.job_store, job, record.get('validation'), timer.as_dict())
+
+    def _load_image(self, path, render_pool, record, timer):
+        with timer.stage('rasterize'):
+            if path.lower().endswith('.pdf'):
+                image_bytes = render_pool.submit(rasterize_document, path, self.render_options).result()
+            else:
+                with open(path, 'rb') as document:
+                    image_bytes = document.read()
+        record['sha256'] = hashlib.sha256(image_bytes).hexdigest()
+        return image_bytes
+
+    def _screen(self, record, image_bytes, timer):
+        # Local checks that can spare the vision call; True if skipped
+        if not self.prefilter and self.recent_documents is None:
+            return False
+
+        with timer.stage('prefilter'):
+            screening = prefilter_document(
+                image_bytes, recent=self.recent_documents, label=record['path'], check_layout=self.prefilter
+            )
+        record['prefilter'] = screening
+        if not screening['skip']:
+            return False
+
+        record['status'] = 'skipped'
+        record['skip_reason'] = screening['reason']
+        return True
+
+    def _process_single_image(self, path, render_pool, record, timer, validate, job=None):
+        if stage_reached(job, STAGE_EXTRACTED):
+            if job_validation(job) is not None:
+                record['validation'] = job_validation(job)
+            return job['extracted']
+
+        if stage_reached(job, STAGE_RASTERIZED):
+            image_bytes = job['image']
+            record['sha256'] = hashlib.sha256(image_bytes).hexdigest()
+        else:
+            image_bytes = self._load_image(path, render_pool, record, timer)
+            # Only rendered PDF pages are worth keeping, images are on disk
+            if path.lower().endswith('.pdf'):
+                save_job_stage(self.job_store, job, STAGE_RASTERIZED, image=image_bytes)
+
+        if self._screen(record, image_bytes, timer):
+            if job is not None:
+                self.job_store.abandon(job['job_key'], job['owner'])
+            return None
+
+        if self.cascade:
+            # Geocoding decides whether to escalate, so it runs inside the
+            # API slot here (bulk validation only escalates on missing fields)
+            with self._api_slots:
+                extracted_info, validation_result = process_document_cascade(
+                    io.BytesIO(image_bytes), self.openai_api_key, self.model_name,
+                    self.geoapify_api_key if validate else None, cache=self.cache,
+                    geocode_cache=self.geocode_cache, timer=timer, token_budget=self.token_budget,
+                    grayscale=self.render_options.get('grayscale', False), provider=self.provider,
+                    cheap_provider=self.cheap_provider, crop_header=self.crop_header
+                )
+            if validation_result is not None:
+                record['validation'] = validation_result
+            return extracted_info
+
+        with self._api_slots:
+            return process_document(
+                io.BytesIO(image_bytes), self.openai_api_key, self.model_name,
+                cache=self.cache, timer=timer, token_budget=self.token_budget,
+                grayscale=self.render_options.get('grayscale', False), provider=self.provider,
+                crop_header=self.crop_header
+            )
+
+    def _process_pdf_pages(self, path, render_pool, record, timer, job=None):
+        if stage_reached(job, STAGE_EXTRACTED):
+            if job_validation(job) is not None:
+                record['validation'] = job_validation(job)
+            return job['extracted']
+
+        with open(path, 'rb') as document:
+            pdf_bytes = document.read()
+        record['sha256'] = hashlib.sha256(pdf_bytes).hexdigest()
+
+        # Render two pages ahead in the shared process pool
+        pages = iter_pdf_pages(pdf_bytes, max_workers=2, executor=render_pool, **self.render_options)
+        with self._api_slots:
+            return process_document_pages(
+                pages, self.openai_api_key, self.model_name, cache=self.cache, timer=timer,
+                token_budget=self.token_budget, grayscale=self.render_options.get('grayscale', False),
+                page_filter=blank_page_reason if self.prefilter else None, provider=self.provider,
+                crop_header=self.crop_header
+            )
+
+def write_metrics_file(path):
+    """
+    Write the metrics registry to path atomically, so a collector never
+    reads a half-written file
+    """
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, 'w', encoding='utf-8') as metrics_file:
+        metrics_file.write(registry.render())
+    os.replace(temporary_path, path)
+
+def add_pipeline_arguments(parser):
+    """
+    Add the options that configure BatchProcessor (see build_processor)
+    """
+    parser.add_argument("--model", default="gpt-4o", help="OpenAI vision model to use")
+    parser.add_argument("--providers", default=None, help="Comma-separated vision providers, e.g. openai:gpt-4o,anthropic:claude-3-5-sonnet-20241022; several are routed by observed latency and error rate (overrides --model)")
+    parser.add_argument("--provider-timeout", type=float, default=DEFAULT_PROVIDER_TIMEOUT, help="Seconds before a provider call times out (and fails over, with several providers)")
+    parser.add_argument("--rpm", type=int, default=DEFAULT_RPM_LIMIT, help="Requests per minute allowed per vision model (default VISION_RPM_LIMIT, unlimited)")
+    parser.add_argument("--tpm", type=int, default=DEFAULT_TPM_LIMIT, help="Tokens per minute allowed per vision model, with image tokens estimated from image size (default VISION_TPM_LIMIT, unlimited)")
+    parser.add_argument("--api-workers", type=int, default=8, help="Concurrent vision model calls")
+    parser.add_argument("--geocode-workers", type=int, default=4, help="Concurrent Geoapify lookups")
+    parser.add_argument("--render-workers", type=int, default=None, help="Processes used for PDF rasterization (default: CPU count)")
+    parser.add_argument("--document-type", choices=sorted(DPI_BY_DOCUMENT_TYPE), default=None, help="Pick the PDF rendering DPI for this document type")
+    parser.add_argument("--dpi", type=int, default=None, help="PDF rendering DPI (overrides --document-type)")
+    parser.add_argument("--size", type=int, default=None, help="Render PDF pages so the longest side is this many pixels (overrides --dpi)")
+    parser.add_argument("--grayscale", action="store_true", help="Render PDF pages and send images in grayscale")
+    parser.add_argument("--token-budget", type=int, default=None, help="Maximum image tokens per page; images are downscaled to fit")
+    parser.add_argument("--all-pages", action="store_true", help="Analyze PDF pages in order until name, address and date are found")
+    parser.add_argument("--bulk-validate", type=int, default=None, metavar="N", help="Validate addresses in bulk every N documents via Geoapify batch geocoding")
+    parser.add_argument("--pack", type=int, default=None, metavar="N", help="Send up to N small documents (receipts, ID cards) in one vision request")
+    parser.add_argument("--prefilter", action="store_true", help="Skip blank pages and images that don't look like documents without calling the model")
+    parser.add_argument("--skip-duplicates", action="store_true", help="Skip near-duplicates of documents already seen in this run (and blank pages)")
+    parser.add_argument("--cascade", action="store_true", help="Try a fast model at low detail first and escalate to the full model only when fields are missing or Geoapify finds the address only with low confidence")
+    parser.add_argument("--cascade-model", default=f"openai:{CASCADE_MODEL}", help="Provider spec for the first cascade tier")
+    parser.add_argument("--crop-header", action="store_true", help="Send only the header/address block of each page, falling back to the full page when fields are missing")
+    parser.add_argument("--no-validate", action="store_true", help="Skip address validation")
+    parser.add_argument("--metrics-file", default=None, help="Write pipeline metrics in the Prometheus text format to this file at the end of the run (e.g. for node_exporter's textfile collector)")
+    parser.add_argument("--job-store", action="store_true", help="Track documents by content hash in the job store (DOCUMENT_JOB_STORE_PATH): skip ones already analyzed, resume failed ones")
+    parser.add_argument("--no-cache", action="store_true", help="Do not use the on-disk result and geocoding caches")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Batch-process documents without the Streamlit UI")
+    parser.add_argument("source", help="Directory of documents or a manifest file with one path per line")
+    parser.add_argument("-o", "--output", default="results.jsonl", help="JSONL output file (appended to and used for resume)")
+    add_pipeline_arguments(parser)
+    return parser.parse_args(argv)
+
+def build_processor(args):
+    """
+    BatchProcessor configured from add_pipeline_arguments options and the
+    API keys in the environment
+    Exits with a message if a key or provider spec is missing or invalid
+    """
+    configure_limits(args.rpm, args.tpm)
+    openai_api_key = os.environ.get("OPENAI_API_KEY")
+    geoapify_api_key = os.environ.get("GEOAPIFY_API_KEY")
+    api_keys = {'openai': openai_api_key, 'anthropic': os.environ.get("ANTHROPIC_API_KEY")}
+    provider = None
+    cheap_provider = None
+    try:
+        if args.providers:
+            provider = build_provider(args.providers.split(','), api_keys, timeout=args.provider_timeout)
+        if args.cascade:
+            cheap_provider = build_provider([args.cascade_model], api_keys, timeout=args.provider_timeout)
+    except ValueError as e:
+        sys.exit(str(e))
+    if not args.providers and not openai_api_key:
+        sys.exit("OPENAI_API_KEY is not set")
+    if not geoapify_api_key and not args.no_validate:
+        sys.exit("GEOAPIFY_API_KEY is not set (or pass --no-validate)")
+
+    return BatchProcessor(
+        openai_api_key,
+        geoapify_api_key,
+        model_name=args.model,
+        api_workers=args.api_workers,
+        geocode_workers=args.geocode_workers,
+        render_workers=args.render_workers,
+        validate=not args.no_validate,
+        cache=None if args.no_cache else ResultCache(table="document_results"),
+        geocode_cache=None if args.no_cache else ResultCache(table="geocode_results", max_entries=50000),
+        render_options={
+            'dpi': args.dpi,
+            'document_type': args.document_type,
+            'size': args.size,
+            'grayscale': args.grayscale,
+        },
+        all_pages=args.all_pages,
+        token_budget=args.token_budget,
+        bulk_validate_size=args.bulk_validate,
+        pack_size=args.pack,
+        prefilter=args.prefilter,
+        skip_duplicates=args.skip_duplicates,
+        provider=provider,
+        cascade=args.cascade,
+        cheap_provider=cheap_provider,
+        job_store=JobStore() if args.job_store else None,
+        crop_header=args.crop_header,
+    )
+
+def main(argv=None):
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    args = parse_args(argv)
+    processor = build_processor(args)
+
+    paths = collect_inputs(args.source)
+    completed = load_completed(args.output)
+    todo = [path for path in paths if path not in completed]
+    logger.info("%d documents found, %d already done, %d to process", len(paths), len(paths) - len(todo), len(todo))
+
+    failures = 0
+    skip_reasons = {}
+    cascade_tiers = {}
+    crop_fallbacks = 0
+    timings = []
+    with open(args.output, 'a', encoding='utf-8') as output:
+        # Terminate a truncated last line left behind by a crash
+        if not ends_with_newline(args.output):
+            output.write('\n')
+
+        for record in processor.run(todo):
+            output.write(json.dumps(record) + '\n')
+            output.flush()
+            timings.append(record['timings'])
+            registry.inc('documents_total', status=record['status'])
+            if record['status'] == 'skipped':
+                skip_reasons[record['skip_reason']] = skip_reasons.get(record['skip_reason'], 0) + 1
+            elif record['status'] != 'ok':
+                failures += 1
+            if record.get('extracted', {}).get('cascade'):
+                tier = record['extracted']['cascade'].get('escalation_reason', 'not escalated')
+                cascade_tiers[tier] = cascade_tiers.get(tier, 0) + 1
+            if record.get('extracted', {}).get('roi', {}).get('fallback'):
+                crop_fallbacks += 1
+
+    logger.info("Finished: %d processed, %d failed, %d skipped", len(todo), failures, sum(skip_reasons.values()))
+    for reason, count in sorted(skip_reasons.items()):
+        logger.info("skipped (%s): %d", reason, count)
+    for tier, count in sorted(cascade_tiers.items()):
+        logger.info("cascade (%s): %d", tier, count)
+    if args.crop_header:
+        logger.info("header crop fell back to the full page: %d", crop_fallbacks)
+    parsing = parse_stats.snapshot()
+    logger.info("Model replies: %d clean, %d repaired, %d failed, %d retried (repair rate %.1f%%)",
+                parsing['clean'], parsing['repaired'], parsing['failed'], parsing['retried'],
+                100 * parsing['repair_rate'])
+    for stage_name, stats in summarize_timings(timings).items():
+        logger.info("%-10s n=%d p50=%.3fs p95=%.3fs max=%.3fs", stage_name,
+                    stats['count'], stats['p50'], stats['p95'], stats['max'])
+    for model_id, stats in scheduler_stats().items():
+        batch_stats = stats['priorities']['batch']
+        logger.info("rate limits %s: %d requests, wait p50=%.2fs max=%.2fs, %d rate limited", model_id,
+                    batch_stats['admitted'], batch_stats['wait_p50'], batch_stats['wait_max'], stats['rate_limited'])
+    if isinstance(processor.provider, ProviderRouter):
+        for provider_id, stats in processor.provider.stats().items():
+            logger.info("provider %s: %s", provider_id, stats)
+    if args.metrics_file:
+        write_metrics_file(args.metrics_file)
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,117 @@
+"""
+Before/after benchmark for the image preparation + encoding stage
+
+Compares the old double JPEG round-trip (decode, save at quality 95, decode
+again, save again) with the current single-encode path in encode_image,
+reporting CPU time and peak RSS per page.
+
+Each measurement runs in a fresh process so peak RSS is not polluted by
+earlier runs.
+
+Usage:
+    python benchmarks/encode_benchmark.py [--repeat 5]
+"""
+import argparse
+import base64
+import io
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from PIL import Image
+
+from document_processor import encode_image
+from pdf_handler import JPEG_QUALITY
+
+# scan_2.jpg is a real JPEG (scan_1.jpg is WebP despite its extension)
+SAMPLE_DOCUMENT = os.path.join(ROOT, 'documents', 'scan_2.jpg')
+
+# A 300 DPI letter page, what convert_from_path used to produce
+RENDERED_PAGE_SIZE = (2550, 3300)
+
+def legacy_encode_image(image_data):
+    # encode_image before the single-encode change: always decode + re-save
+    img = Image.open(io.BytesIO(image_data))
+    if img.mode not in ('RGB', 'L'):
+        img = img.convert('RGB')
+    img_byte_array = io.BytesIO()
+    img.save(img_byte_array, format='JPEG', quality=95)
+    return base64.b64encode(img_byte_array.getvalue()).decode('utf-8')
+
+def legacy_rendered_page(page_image):
+    # Old PDF path: PIL page -> JPEG 95 in prepare_document_image -> encode_image
+    img_byte_array = io.BytesIO()
+    page_image.save(img_byte_array, format='JPEG', quality=95)
+    return legacy_encode_image(img_byte_array.getvalue())
+
+def current_rendered_page(page_image):
+    # New PDF path: pdftoppm writes the JPEG once, encode_image passes it through.
+    # The pdftoppm encode is simulated here so both sides pay for one encode.
+    img_byte_array = io.BytesIO()
+    page_image.save(img_byte_array, format='JPEG', quality=JPEG_QUALITY)
+    return encode_image(img_byte_array.getvalue())
+
+def load_input(case):
+    with open(SAMPLE_DOCUMENT, 'rb') as document:
+        jpeg_bytes = document.read()
+    if case == 'jpeg upload':
+        return jpeg_bytes
+
+    sample = Image.open(io.BytesIO(jpeg_bytes)).convert('RGB')
+    if case == 'png upload':
+        png_buffer = io.BytesIO()
+        sample.save(png_buffer, format='PNG')
+        return png_buffer.getvalue()
+    return sample.resize(RENDERED_PAGE_SIZE)
+
+CASES = {
+    'jpeg upload': (legacy_encode_image, encode_image),
+    'png upload': (legacy_encode_image, encode_image),
+    'rendered pdf page': (legacy_rendered_page, current_rendered_page),
+}
+
+def _measure(case, variant, repeat, queue):
+    inputs = load_input(case)
+    function = CASES[case][0 if variant == 'before' else 1]
+
+    baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    cpu_started = time.process_time()
+    for _ in range(repeat):
+        payload = function(inputs)
+    cpu_seconds = (time.process_time() - cpu_started) / repeat
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    queue.put({
+        'cpu_ms': cpu_seconds * 1000,
+        # ru_maxrss is in KiB on Linux
+        'peak_rss_mib': (peak_rss - baseline_rss) / 1024,
+        'payload_kib': len(payload) / 1024,
+    })
+
+def measure(case, variant, repeat):
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=_measure, args=(case, variant, repeat, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark image preparation before/after single-encode")
+    parser.add_argument("--repeat", type=int, default=5, help="Encodes per measurement")
+    args = parser.parse_args(argv)
+
+    print(f"{'case':<20}{'variant':<9}{'cpu ms/page':>13}{'peak rss MiB':>14}{'payload KiB':>13}")
+    for case in CASES:
+        for variant in ('before', 'after'):
+            result = measure(case, variant, args.repeat)
+            print(f"{case:<20}{variant:<9}{result['cpu_ms']:>13.1f}{result['peak_rss_mib']:>14.1f}{result['payload_kib']:>13.1f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,274 @@
+"""
+End-to-end pipeline benchmark with local stand-ins for OpenAI and Geoapify
+
+Runs prepare_document_image -> process_document -> validate_address over
+the sample documents, with a FakeProvider in place of the vision model and
+a local HTTP stub in place of Geoapify, both with configurable latency, so
+results are reproducible and cost nothing. Cases cover image sizes, PDF
+page counts (all pages analyzed) and concurrency levels; each case reports
+throughput, p50/p95 per pipeline stage and peak RSS.
+
+Each case runs in a fresh process so peak RSS is not polluted by earlier
+cases. PDF cases need pdftoppm and are skipped without it.
+
+Usage:
+    python benchmarks/pipeline_benchmark.py
+    python benchmarks/pipeline_benchmark.py --model-latency 0.5 --concurrency 1,8,32 --json after.json
+    python benchmarks/pipeline_benchmark.py --compare before.json   # exit 1 on regressions
+"""
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from PIL import Image
+
+from document_processor import process_document, process_document_pages, validate_address
+from geoapify import GEOCODE_PATH, GeoapifyClient
+from metrics import StageTimer, percentile, summarize_timings
+from pdf_handler import iter_pdf_pages, prepare_document_image
+from providers import FakeProvider
+
+SAMPLE_DOCUMENTS = [os.path.join(ROOT, 'documents', name) for name in ('scan_1.jpg', 'scan_2.jpg')]
+
+# Longest side of the uploaded images, from phone photo to 300 DPI scan
+IMAGE_SIZES = (1024, 2048, 3300)
+
+# Pages in the generated PDFs; the fake model never finds a date, so every
+# page is rendered and analyzed
+PDF_PAGE_COUNTS = (1, 5, 20)
+
+FAKE_ANSWER = {
+    'is_bank_statement': True,
+    'name': 'Jane Doe',
+    'address': '1600 Amphitheatre Parkway, Mountain View, CA 94043',
+    'document_date': '2024-01-31',
+}
+
+# Throughput may drop and p95 latency grow by this fraction before
+# --compare reports a regression
+DEFAULT_TOLERANCE = 0.2
+
+def make_geocode_response(address):
+    return {
+        'type': 'FeatureCollection',
+        'features': [{
+            'type': 'Feature',
+            'properties': {
+                'formatted': address,
+                'country': 'United States',
+                'rank': {'confidence': 0.95, 'match_type': 'full_match'},
+            },
+        }],
+    }
+
+def start_geoapify_stub(latency):
+    """
+    Local Geoapify geocoding endpoint answering every address with a
+    confident match after latency seconds
+    Returns the running server; its base URL is http://127.0.0.1:<port>
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path != GEOCODE_PATH:
+                self.send_error(404)
+                return
+            if latency:
+                time.sleep(latency)
+            address = parse_qs(url.query).get('text', [''])[0]
+            body = json.dumps(make_geocode_response(address)).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def load_sample(size):
+    # Sample scan resized so its longest side is size pixels, as an upload
+    with open(SAMPLE_DOCUMENTS[1], 'rb') as document:
+        sample = Image.open(io.BytesIO(document.read())).convert('RGB')
+    scale = size / max(sample.size)
+    resized = sample.resize((round(sample.width * scale), round(sample.height * scale)))
+    buffer = io.BytesIO()
+    resized.save(buffer, format='JPEG', quality=90)
+    return buffer.getvalue()
+
+def make_pdf(page_count):
+    # Multi-page PDF of the sample scans at letter size
+    pages = []
+    for index in range(page_count):
+        with Image.open(SAMPLE_DOCUMENTS[index % len(SAMPLE_DOCUMENTS)]) as sample:
+            pages.append(sample.convert('RGB').resize((1275, 1650)))
+    buffer = io.BytesIO()
+    pages[0].save(buffer, format='PDF', save_all=True, append_images=pages[1:], resolution=150)
+    return buffer.getvalue()
+
+def build_cases(concurrency_levels):
+    cases = [{'kind': 'image', 'size': size, 'concurrency': workers}
+             for size in IMAGE_SIZES for workers in concurrency_levels]
+    if shutil.which('pdftoppm'):
+        cases += [{'kind': 'pdf', 'pages': pages, 'concurrency': workers}
+                  for pages in PDF_PAGE_COUNTS for workers in concurrency_levels]
+    else:
+        print("pdftoppm not found, skipping PDF cases", file=sys.stderr)
+    return cases
+
+def case_name(case):
+    if case['kind'] == 'image':
+        return f"image {case['size']}px x{case['concurrency']}"
+    return f"pdf {case['pages']}p x{case['concurrency']}"
+
+def _analyze(document_bytes, case, provider, client):
+    # One document through the same stages analyze_document runs
+    timer = StageTimer()
+    started = time.perf_counter()
+    document_file = io.BytesIO(document_bytes)
+    if case['kind'] == 'pdf':
+        document_file.name = 'benchmark.pdf'
+        extracted_info = process_document_pages(
+            iter_pdf_pages(document_file), None, timer=timer, provider=provider
+        )
+    else:
+        document_file.name = 'benchmark.jpg'
+        with timer.stage('rasterize'):
+            processed_file = prepare_document_image(document_file)
+        extracted_info = process_document(processed_file, None, timer=timer, provider=provider)
+    if extracted_info.get('error'):
+        raise RuntimeError(extracted_info['error'])
+
+    validate_address(extracted_info['address'], 'benchmark', timer=timer, client=client)
+    return time.perf_counter() - started, timer.as_dict()
+
+def _run_case(case, options, queue):
+    try:
+        queue.put(_measure_case(case, options))
+    except Exception as e:
+        # Report instead of leaving the parent waiting on the queue
+        queue.put({'case': case_name(case), 'error': f"{type(e).__name__}: {e}"})
+
+def _measure_case(case, options):
+    geoapify_stub = start_geoapify_stub(options['geocode_latency'])
+    client = GeoapifyClient('benchmark', base_url=f"http://127.0.0.1:{geoapify_stub.server_address[1]}",
+                            rate_limit=None, pool_size=max(10, case['concurrency']))
+
+    answer = FAKE_ANSWER if case['kind'] == 'image' else dict(FAKE_ANSWER, document_date='')
+    provider = FakeProvider(response=answer, latency=options['model_latency'])
+    document_bytes = load_sample(case['size']) if case['kind'] == 'image' else make_pdf(case['pages'])
+    documents = options['documents']
+
+    baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=case['concurrency']) as executor:
+        results = list(executor.map(lambda _: _analyze(document_bytes, case, provider, client), range(documents)))
+    elapsed = time.perf_counter() - started
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    geoapify_stub.shutdown()
+
+    latencies = [latency for latency, _ in results]
+    return {
+        'case': case_name(case),
+        'documents': documents,
+        'throughput': documents / elapsed,
+        'p50': percentile(latencies, 50),
+        'p95': percentile(latencies, 95),
+        'stages': {name: {'p50': stats['p50'], 'p95': stats['p95']}
+                   for name, stats in summarize_timings([timings for _, timings in results]).items()},
+        # ru_maxrss is in KiB on Linux
+        'peak_rss_mib': peak_rss / 1024,
+        'rss_growth_mib': (peak_rss - baseline_rss) / 1024,
+        'model_calls': provider.calls,
+    }
+
+def run_case(case, options):
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=_run_case, args=(case, options, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+def compare(results, baseline, tolerance):
+    """
+    Cases whose throughput dropped or p95 latency grew by more than
+    tolerance against the baseline results
+    Returns a list of human-readable regression descriptions
+    """
+    previous = {result['case']: result for result in baseline}
+    regressions = []
+    for result in results:
+        before = previous.get(result['case'])
+        if before is None:
+            continue
+        if result['throughput'] < before['throughput'] * (1 - tolerance):
+            regressions.append(f"{result['case']}: throughput {before['throughput']:.1f} -> {result['throughput']:.1f} docs/s")
+        if result['p95'] > before['p95'] * (1 + tolerance):
+            regressions.append(f"{result['case']}: p95 {before['p95']:.3f} -> {result['p95']:.3f}s")
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the full pipeline against a fake model and geocoder")
+    parser.add_argument("--documents", type=int, default=32, help="Documents per case")
+    parser.add_argument("--concurrency", default="1,8", help="Comma-separated worker counts")
+    parser.add_argument("--model-latency", type=float, default=0.2, help="Seconds the fake vision model takes per request")
+    parser.add_argument("--geocode-latency", type=float, default=0.05, help="Seconds the Geoapify stub takes per lookup")
+    parser.add_argument("--json", default=None, help="Also write the results to this file")
+    parser.add_argument("--compare", default=None, help="Results file from an earlier run; exit 1 if any case regressed")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE, help="Allowed relative regression for --compare")
+    args = parser.parse_args(argv)
+
+    options = {
+        'documents': args.documents,
+        'model_latency': args.model_latency,
+        'geocode_latency': args.geocode_latency,
+    }
+    concurrency_levels = [int(level) for level in args.concurrency.split(',')]
+
+    cases = build_cases(concurrency_levels)
+    print(f"{'case':<22}{'docs/s':>9}{'p50 s':>9}{'p95 s':>9}{'rss MiB':>10}  stage p95 (s)")
+    results = []
+    for case in cases:
+        result = run_case(case, options)
+        if 'error' in result:
+            sys.exit(f"{result['case']} failed: {result['error']}")
+        results.append(result)
+        stages = ' '.join(f"{name}={stats['p95']:.3f}" for name, stats in result['stages'].items())
+        print(f"{result['case']:<22}{result['throughput']:>9.1f}{result['p50']:>9.3f}{result['p95']:>9.3f}"
+              f"{result['peak_rss_mib']:>10.1f}  {stages}")
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as output:
+            json.dump({'options': options, 'results': results}, output, indent=2)
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as baseline_file:
+            baseline = json.load(baseline_file)['results']
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
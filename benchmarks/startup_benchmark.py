@@ -0,0 +1,201 @@
+"""
+Startup and rerun benchmark for the Streamlit app
+
+Measures what a user waits for before the page appears and on every
+interaction: importing the modules app.py needs, the first script run, and
+reruns of the landing page with no API keys and with keys entered (no
+document uploaded, so nothing should be analyzed or loaded). It also lists
+which heavy libraries (vision SDKs, OpenCV, HTTP clients) have been
+imported by then.
+
+The app is driven by Streamlit's AppTest, so no browser, server or API is
+involved. Every measurement runs in a fresh process so imports are cold;
+cold measurements are repeated and the median is reported.
+
+Usage:
+    python benchmarks/startup_benchmark.py
+    python benchmarks/startup_benchmark.py --reruns 50 --json after.json
+    python benchmarks/startup_benchmark.py --compare before.json   # exit 1 on regressions
+"""
+import argparse
+import ast
+import json
+import logging
+import multiprocessing
+import os
+import statistics
+import sys
+import time
+from queue import Empty
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+APP_PATH = os.path.join(ROOT, 'app.py')
+
+# Libraries the landing page should not need
+HEAVY_MODULES = ('openai', 'anthropic', 'cv2', 'numpy', 'PIL', 'requests', 'httpx')
+
+# A timing may grow by this fraction before --compare reports a regression
+DEFAULT_TOLERANCE = 0.25
+
+# Seconds to wait for a measurement process before giving up on it
+MEASURE_TIMEOUT = 600
+
+def app_modules():
+    # Project modules app.py imports at the top level
+    with open(APP_PATH, encoding='utf-8') as source:
+        tree = ast.parse(source.read())
+    modules = []
+    for node in tree.body:
+        if isinstance(node, ast.Import):
+            modules += [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.module:
+            modules.append(node.module)
+    return [module for module in modules if os.path.exists(os.path.join(ROOT, f"{module}.py"))]
+
+def loaded_heavy_modules():
+    return [module for module in HEAVY_MODULES if module in sys.modules]
+
+def _report(measurement, *args):
+    queue = args[-1]
+    try:
+        measurement(*args)
+    except Exception as e:
+        # Report instead of leaving the parent waiting on the queue
+        queue.put({'error': f"{type(e).__name__}: {e}"})
+
+def _measure_imports(queue):
+    started = time.perf_counter()
+    import streamlit  # noqa: F401
+    streamlit_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for module in app_modules():
+        __import__(module)
+    queue.put({
+        'streamlit_import': streamlit_seconds,
+        'app_import': time.perf_counter() - started,
+        'loaded': loaded_heavy_modules(),
+    })
+
+def _timed_reruns(app, count):
+    durations = []
+    for _ in range(count):
+        started = time.perf_counter()
+        app.run()
+        durations.append(time.perf_counter() - started)
+    return statistics.median(durations)
+
+def _measure_runs(reruns, queue):
+    import streamlit.logger
+    try:
+        from streamlit.testing.v1 import AppTest
+    except ImportError:
+        queue.put({'error': f"Streamlit {streamlit.__version__} has no AppTest (streamlit>=1.28 needed)"})
+        return
+    # AppTest runs without a server; silence the warnings that causes
+    streamlit.logger.set_log_level(logging.ERROR)
+
+    started = time.perf_counter()
+    app = AppTest.from_file(APP_PATH, default_timeout=120)
+    app.run()
+    first_run = time.perf_counter() - started
+    if app.exception:
+        queue.put({'error': app.exception[0].value})
+        return
+
+    idle_rerun = _timed_reruns(app, reruns)
+    app.text_input[0].input('sk-benchmark')
+    app.text_input[2].input('geoapify-benchmark')
+    app.run()
+    keys_rerun = _timed_reruns(app, reruns)
+    queue.put({
+        'first_run': first_run,
+        'idle_rerun': idle_rerun,
+        'keys_rerun': keys_rerun,
+        'loaded': loaded_heavy_modules(),
+    })
+
+def run_fresh(target, *args):
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=_report, args=(target,) + args + (queue,))
+    process.start()
+    deadline = time.monotonic() + MEASURE_TIMEOUT
+    while True:
+        try:
+            result = queue.get(timeout=1)
+            break
+        except Empty:
+            # The child died without reporting, or hung
+            if not process.is_alive():
+                result = {'error': f"measurement process exited with code {process.exitcode}"}
+                break
+            if time.monotonic() > deadline:
+                result = {'error': f"no result after {MEASURE_TIMEOUT}s"}
+                process.terminate()
+                break
+    process.join()
+    return result
+
+def measure(reruns, repeat):
+    """
+    Median of each timing over repeat cold processes
+    Returns {'timings': {name: seconds}, 'loaded': [...]}
+    """
+    samples = {}
+    loaded = set()
+    for _ in range(repeat):
+        for result in (run_fresh(_measure_imports), run_fresh(_measure_runs, reruns)):
+            if 'error' in result:
+                sys.exit(f"benchmark failed: {result['error']}")
+            loaded.update(result.pop('loaded'))
+            for name, seconds in result.items():
+                samples.setdefault(name, []).append(seconds)
+    return {
+        'timings': {name: statistics.median(values) for name, values in samples.items()},
+        'loaded': sorted(loaded),
+    }
+
+def compare(result, baseline, tolerance):
+    regressions = []
+    for name, seconds in result['timings'].items():
+        # Streamlit's own import time doesn't depend on this project
+        if name == 'streamlit_import':
+            continue
+        before = baseline['timings'].get(name)
+        if before and seconds > before * (1 + tolerance):
+            regressions.append(f"{name}: {before * 1000:.1f}ms -> {seconds * 1000:.1f}ms")
+    for module in sorted(set(result['loaded']) - set(baseline['loaded'])):
+        regressions.append(f"{module} is now imported before a document is analyzed")
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the Streamlit app's startup and rerun time")
+    parser.add_argument("--reruns", type=int, default=20, help="Reruns timed per page state")
+    parser.add_argument("--repeat", type=int, default=3, help="Cold processes per measurement")
+    parser.add_argument("--json", default=None, help="Also write the results to this file")
+    parser.add_argument("--compare", default=None, help="Results file from an earlier run; exit 1 if anything regressed")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE, help="Allowed relative regression for --compare")
+    args = parser.parse_args(argv)
+
+    result = measure(args.reruns, args.repeat)
+    for name, seconds in result['timings'].items():
+        print(f"{name:<18}{seconds * 1000:>9.1f} ms")
+    print(f"{'heavy modules':<18} {', '.join(result['loaded']) or 'none'}")
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as output:
+            json.dump(result, output, indent=2)
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as baseline_file:
+            regressions = compare(result, json.load(baseline_file), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
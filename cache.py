@@ -0,0 +1,142 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from metrics import registry
+
+DEFAULT_CACHE_PATH = os.environ.get(
+    "DOCUMENT_CACHE_PATH",
+    os.path.join(os.path.expanduser("~"), ".cache", "smart-document-analyzer", "cache.sqlite3")
+)
+
+def make_cache_key(*parts):
+    """
+    Build a stable cache key from a sequence of bytes/str parts
+    Returns a hex SHA-256 digest
+    """
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode('utf-8')
+        # Length-prefix every part so ("ab", "c") and ("a", "bc") differ
+        digest.update(len(part).to_bytes(8, 'big'))
+        digest.update(part)
+    return digest.hexdigest()
+
+class ResultCache:
+    """
+    Persistent key/value cache backed by SQLite
+    Values are stored as JSON, entries expire after ttl_seconds and the
+    least recently used entries are evicted once max_entries is exceeded
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, table="results", max_entries=1000, ttl_seconds=7 * 24 * 3600):
+        if not table.isidentifier():
+            raise ValueError(f"Invalid cache table name: {table}")
+
+        self.path = path
+        self.table = table
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+        # One shared connection, serialized by our own lock
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        with self._lock, self._conn:
+            if path != ":memory:":
+                self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                f"""CREATE TABLE IF NOT EXISTS {table} (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    expires_at REAL,
+                    last_accessed REAL NOT NULL
+                )"""
+            )
+            self._conn.execute(
+                f"CREATE INDEX IF NOT EXISTS {table}_last_accessed ON {table} (last_accessed)"
+            )
+
+    def get(self, key, default=None):
+        """
+        Look up a cached value
+        Returns the stored value, or default if missing or expired
+        """
+        now = time.time()
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                f"SELECT value, expires_at FROM {self.table} WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                registry.inc('cache_lookups_total', table=self.table, result='miss')
+                return default
+
+            value, expires_at = row
+            if expires_at is not None and expires_at <= now:
+                self._conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+                registry.inc('cache_lookups_total', table=self.table, result='expired')
+                return default
+
+            # Touch the entry so LRU eviction keeps it
+            self._conn.execute(
+                f"UPDATE {self.table} SET last_accessed = ? WHERE key = ?", (now, key)
+            )
+        registry.inc('cache_lookups_total', table=self.table, result='hit')
+        return json.loads(value)
+
+    def set(self, key, value, ttl_seconds=None):
+        """
+        Store a JSON-serializable value, evicting old entries if needed
+        """
+        now = time.time()
+        ttl = self.ttl_seconds if ttl_seconds is None else ttl_seconds
+        expires_at = now + ttl if ttl else None
+        payload = json.dumps(value)
+
+        with self._lock, self._conn:
+            self._conn.execute(
+                f"""INSERT OR REPLACE INTO {self.table}
+                    (key, value, created_at, expires_at, last_accessed)
+                    VALUES (?, ?, ?, ?, ?)""",
+                (key, payload, now, expires_at, now)
+            )
+            self._evict(now)
+
+    def delete(self, key):
+        """
+        Remove a single entry from the cache
+        """
+        with self._lock, self._conn:
+            self._conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+
+    def clear(self):
+        """
+        Remove every entry from the cache
+        """
+        with self._lock, self._conn:
+            self._conn.execute(f"DELETE FROM {self.table}")
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+
+    def _evict(self, now):
+        # Drop expired entries first, then trim to max_entries by last access
+        self._conn.execute(
+            f"DELETE FROM {self.table} WHERE expires_at IS NOT NULL AND expires_at <= ?", (now,)
+        )
+        if self.max_entries:
+            self._conn.execute(
+                f"""DELETE FROM {self.table} WHERE key IN (
+                    SELECT key FROM {self.table}
+                    ORDER BY last_accessed DESC
+                    LIMIT -1 OFFSET ?
+                )""",
+                (self.max_entries,)
+            )
@@ -0,0 +1,946 @@
+import io
+import asyncio
+import contextlib
+import contextvars
+import functools
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from cache import make_cache_key
+from geoapify import (
+    BATCH_MAX_SIZE, GEOCODE_CACHE_TTL, GEOCODE_NEGATIVE_TTL, BatchGeocodingUnavailable,
+    get_geoapify_client, is_negative_result, normalize_address
+)
+from image_handler import BASE_TOKENS, prepare_image_payload
+from job_store import (
+    ALREADY_DONE, BUSY, STAGE_EXTRACTED, STAGE_RASTERIZED, STAGE_VALIDATED, document_job_key, job_result, stage_reached
+)
+import layout
+from metrics import StageTimer, registry, span
+from pdf_handler import is_pdf, iter_pdf_pages, prepare_document_image, resolve_dpi
+from providers import get_provider
+from response_parser import (
+    PARSE_FAILED, PARSE_RETRIED, IncrementalJSONParser, TruncatedReplyError, parse_json_response, parse_stats
+)
+
+logger = logging.getLogger(__name__)
+
+REQUIRED_FIELDS = ['is_bank_statement', 'name', 'address', 'document_date']
+
+# Text fields that must be filled before a multi-page document is complete
+TEXT_FIELDS = ['name', 'address', 'document_date']
+
+# Bump whenever DOCUMENT_PROMPT changes so cached results are not reused
+PROMPT_VERSION = "1"
+
+DOCUMENT_PROMPT = """Analyze this document and provide information in JSON format.
+1. First determine if this is a bank statement (look for elements like transactions, balances, bank name)
+2. Extract the following whether it's a bank statement or other document:
+   - Person's full name
+   - Complete address
+   - Document date or period
+3. Return the data in this exact JSON format:
+{
+    "is_bank_statement": true/false,
+    "name": "[full name]",
+    "address": "[complete address]",
+    "document_date": "[statement date/period]"
+}
+
+If you cannot extract certain information, use empty strings for those fields.
+Respond ONLY with the JSON, no other text."""
+
+PACKED_DOCUMENT_PROMPT = """You are given {count} separate documents, each image is preceded by its label "Document <index>:".
+Analyze each document on its own; never combine information from different documents.
+1. Determine if the document is a bank statement (look for elements like transactions, balances, bank name)
+2. Extract the person's full name, complete address and the document date or period
+3. Return a JSON array with exactly one object per document, in this exact format:
+[
+    {{
+        "document_index": 0,
+        "is_bank_statement": true/false,
+        "name": "[full name]",
+        "address": "[complete address]",
+        "document_date": "[statement date/period]"
+    }}
+]
+
+Document indexes go from 0 to {last_index}.
+If you cannot extract certain information, use empty strings for those fields.
+Respond ONLY with the JSON array, no other text."""
+
+# JSON schema of DOCUMENT_PROMPT's answer, enforced where the model allows it
+DOCUMENT_SCHEMA = {
+    "name": "document_fields",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {
+            "is_bank_statement": {"type": "boolean"},
+            "name": {"type": "string"},
+            "address": {"type": "string"},
+            "document_date": {"type": "string"}
+        },
+        "required": REQUIRED_FIELDS,
+        "additionalProperties": False
+    }
+}
+
+# Extra model calls made when a reply can't be parsed even after repair
+MAX_PARSE_RETRIES = 1
+
+# Cascade mode: the first tier is a fast model looking at a low-detail image
+CASCADE_MODEL = "gpt-4o-mini"
+CASCADE_TOKEN_BUDGET = BASE_TOKENS
+
+# Completion tokens reserved per document in a packed request
+PACKED_MAX_TOKENS_PER_DOCUMENT = 256
+
+def encode_image(image_data, token_budget=None, grayscale=False):
+    """
+    Encode the image file to base64 for OpenAI API
+    See image_handler.prepare_image_payload for sizing and pass-through rules
+    """
+    try:
+        base64_string, _, _ = prepare_image_payload(image_data, token_budget=token_budget, grayscale=grayscale)
+        return base64_string
+    except Exception as e:
+        logger.error("Error encoding image: %s", e)
+        raise
+
+def empty_extraction(error):
+    """
+    Extraction result used when a document could not be analyzed
+    """
+    return {
+        'is_bank_statement': False,
+        'name': '',
+        'address': '',
+        'document_date': '',
+        'error': error
+    }
+
+def parse_response(response_text):
+    """
+    Parse the model's reply into the extracted information dict
+    Fences, surrounding prose and trailing commas are repaired (see
+    response_parser.repair_json); a reply cut off before its JSON was
+    complete counts as failed, so it is asked for again and never cached.
+    Every outcome is counted in response_parser.parse_stats
+    Returns a dict with all required fields, plus 'error' and
+    'raw_response' if nothing could be recovered
+    """
+    response_text = response_text or ''
+    try:
+        extracted_info, outcome = parse_json_response(response_text)
+        if not isinstance(extracted_info, dict):
+            raise ValueError("Response is not a JSON object")
+    except ValueError as e:
+        logger.warning("Could not parse GPT's response as JSON (%s): %s", e, response_text)
+        truncated = isinstance(e, TruncatedReplyError)
+        extracted_info = empty_extraction('Response was truncated' if truncated else 'Failed to parse response')
+        extracted_info['raw_response'] = response_text
+        outcome = PARSE_FAILED
+    parse_stats.record(outcome)
+
+    # Ensure all required fields are present
+    for field in REQUIRED_FIELDS:
+        if field not in extracted_info:
+            extracted_info[field] = ''
+
+    return extracted_info
+
+def parse_packed_response(response_text, count):
+    """
+    Split the model's reply to a packed request into one extraction per
+    document, ordered by document index
+    Returns None unless the reply is a JSON array covering every index
+    exactly once, so the caller can retry with smaller requests
+    """
+    try:
+        items, outcome = parse_json_response(response_text or '')
+    except ValueError:
+        logger.warning("Could not parse packed response as JSON: %s", response_text)
+        parse_stats.record(PARSE_FAILED)
+        return None
+    parse_stats.record(outcome)
+
+    if not isinstance(items, list) or len(items) != count:
+        logger.warning("Packed response has %s entries, expected %d",
+                       len(items) if isinstance(items, list) else 'no', count)
+        return None
+
+    by_index = {}
+    for item in items:
+        index = item.get('document_index') if isinstance(item, dict) else None
+        if not isinstance(index, int) or not 0 <= index < count or index in by_index:
+            logger.warning("Packed response has an invalid document_index: %s", index)
+            return None
+        by_index[index] = item
+
+    extractions = []
+    for index in range(count):
+        extracted_info = {key: value for key, value in by_index[index].items() if key != 'document_index'}
+        for field in REQUIRED_FIELDS:
+            if field not in extracted_info:
+                extracted_info[field] = ''
+        extractions.append(extracted_info)
+    return extractions
+
+def build_validation_result(result):
+    """
+    Turn a Geoapify geocoding response (or None) into a validation result
+    Returns a dict with validation results including confidence metrics
+    """
+    # Initialize response structure
+    validation_result = {
+        'is_valid': False,
+        'confidence': 0.0,
+        'details': result,
+        'error': None
+    }
+
+    # If geocoding failed
+    if not result:
+        validation_result['error'] = 'Could not geocode address'
+        return validation_result
+
+    # Get the best match (first result) if available
+    match = (result.get('features', []) or [{}])[0]
+
+    # Get confidence details from the best match
+    confidence_details = match.get('properties', {}).get('rank', {})
+
+    # Calculate overall confidence
+    if confidence_details:
+        # Get the confidence score
+        confidence_score = confidence_details.get('confidence', 0)
+        validation_result['confidence'] = confidence_score
+
+        # Consider valid if the match has high confidence
+        validation_result['is_valid'] = confidence_score >= 0.8
+
+        # Add the confidence details to the response
+        validation_result['confidence_details'] = confidence_details
+
+        # Add formatted address
+        validation_result['formatted_address'] = match.get('properties', {}).get('formatted')
+
+    return validation_result
+
+def _request_extraction(images, provider, timer, on_partial=None):
+    # Call the model and parse its reply; a reply that can't be recovered
+    # even by repair is asked for again, up to MAX_PARSE_RETRIES times
+    parser = IncrementalJSONParser()
+
+    def on_text(chunk):
+        # Hand over the fields parsed so far whenever one appears or grows
+        if parser.feed(chunk):
+            on_partial(dict(parser.value))
+
+    stream = {} if on_partial is None else {'on_text': on_text, 'on_retry': parser.reset}
+    for attempt in range(MAX_PARSE_RETRIES + 1):
+        if attempt:
+            parse_stats.record(PARSE_RETRIED)
+            logger.info("Model reply could not be parsed, asking again (attempt %d)", attempt + 1)
+
+        # Every request streams into an empty parser, so a preview never
+        # mixes a failed reply (or another provider's) with the next one
+        parser.reset()
+        with timer.stage('model_call'):
+            response_text = provider.complete(
+                DOCUMENT_PROMPT, images, max_tokens=1024, json_schema=DOCUMENT_SCHEMA, **stream
+            )
+
+        with timer.stage('parse'):
+            extracted_info = parse_response(response_text)
+        if 'error' not in extracted_info:
+            break
+    return extracted_info
+
+def _extract_image(image_data, provider, cache, timer, token_budget, grayscale, on_partial):
+    # Encode one page image and extract its fields, through the cache
+    with timer.stage('encode'):
+        base64_image, detail, _ = prepare_image_payload(image_data, token_budget=token_budget, grayscale=grayscale)
+    registry.observe('image_payload_bytes', len(base64_image))
+
+    # Serve repeated analyses of the same document from the cache
+    cache_key = make_cache_key(base64_image, detail, provider.cache_id, PROMPT_VERSION)
+    if cache is not None:
+        cached_info = cache.get(cache_key)
+        if cached_info is not None:
+            return cached_info
+
+    extracted_info = _request_extraction([(None, base64_image, detail)], provider, timer, on_partial=on_partial)
+
+    # Only cache successful analyses so failures get retried
+    if cache is not None and 'error' not in extracted_info:
+        cache.set(cache_key, extracted_info)
+    return extracted_info
+
+def process_document(document_file, api_key, model_name="gpt-4-vision-preview", cache=None, timer=None,
+                     token_budget=None, grayscale=False, on_partial=None, provider=None, crop_header=False):
+    """
+    Process the uploaded document using OpenAI's GPT-4 Vision API
+    Errors are reported in the 'error' field instead of being raised
+    If a ResultCache is given, identical documents are only analyzed once
+    per model and prompt version; pass a StageTimer to record stage durations
+    The image is downscaled to the API's tile grid, or further to fit
+    token_budget image tokens
+    With on_partial, the reply is streamed and on_partial(fields) is called
+    with the fields parsed so far each time one appears or changes
+    provider (see providers.py, e.g. a ProviderRouter) replaces the OpenAI
+    model given by api_key and model_name
+    With crop_header, only the header/address block found by layout.py is
+    sent; if that leaves a field empty, the full page is sent as well.
+    'roi' in the result records the crop box and whether it fell back
+    """
+    timer = timer or StageTimer()
+    try:
+        provider = provider or get_provider('openai', api_key, model_name)
+
+        # Read the image data
+        image_data = document_file.read()
+        document_file.seek(0)  # Reset file pointer
+
+        if not crop_header:
+            return _extract_image(image_data, provider, cache, timer, token_budget, grayscale, on_partial)
+
+        header_data, box = None, None
+        with timer.stage('layout'):
+            try:
+                header_data, box = layout.crop_header(image_data)
+            except Exception as e:
+                logger.warning("Layout analysis failed, sending the full page: %s", e)
+
+        if header_data is not None:
+            extracted_info = _extract_image(header_data, provider, cache, timer, token_budget, grayscale, on_partial)
+            if not extracted_info.get('error') and not missing_fields(extracted_info):
+                extracted_info['roi'] = {'box': list(box), 'fallback': False}
+                return extracted_info
+            logger.info("Header crop left fields empty, sending the full page")
+
+        extracted_info = _extract_image(image_data, provider, cache, timer, token_budget, grayscale, on_partial)
+        extracted_info['roi'] = {'box': list(box) if box else None, 'fallback': header_data is not None}
+        return extracted_info
+
+    except Exception as e:
+        logger.error("Error in process_document: %s", e)
+        return empty_extraction(str(e))
+
+def _extract_packed(payloads, provider, timers):
+    # One request for all payloads; a reply that can't be split back per
+    # document is retried as two smaller requests, down to single documents
+    if len(payloads) == 1:
+        base64_image, detail = payloads[0]
+        return [_request_extraction([(None, base64_image, detail)], provider, timers[0])]
+
+    # The shared request time is split evenly across its documents
+    shared_timer = StageTimer()
+    with shared_timer.stage('model_call'):
+        # Each image is labelled with its index so the reply can be split back
+        response_text = provider.complete(
+            PACKED_DOCUMENT_PROMPT.format(count=len(payloads), last_index=len(payloads) - 1),
+            [(f"Document {index}:", base64_image, detail) for index, (base64_image, detail) in enumerate(payloads)],
+            max_tokens=PACKED_MAX_TOKENS_PER_DOCUMENT * len(payloads)
+        )
+    with shared_timer.stage('parse'):
+        extractions = parse_packed_response(response_text, len(payloads))
+    for timer in timers:
+        for stage_name, seconds in shared_timer.durations.items():
+            timer.add(stage_name, seconds / len(payloads))
+
+    if extractions is not None:
+        return extractions
+
+    middle = len(payloads) // 2
+    logger.info("Re-splitting packed request of %d documents", len(payloads))
+    return (_extract_packed(payloads[:middle], provider, timers[:middle])
+            + _extract_packed(payloads[middle:], provider, timers[middle:]))
+
+def process_documents_packed(documents, api_key, model_name="gpt-4o", cache=None, timers=None,
+                             token_budget=None, grayscale=False, provider=None):
+    """
+    Process several small documents (receipts, ID cards, ...) with a single
+    vision request, sharing the prompt and request overhead between them
+    documents is a list of raw image bytes; pass one StageTimer per document
+    to record its stages (the shared model call is split evenly)
+    The reply is split back per document by index; if it can't be, the
+    documents are re-sent in smaller groups until every one has a result
+    Results are cached under the same key process_document uses; provider
+    replaces the OpenAI model as in process_document
+    Returns one extraction dict per document, in input order
+    """
+    timers = timers or [StageTimer() for _ in documents]
+    results = [None] * len(documents)
+    payloads = []
+    pending = []
+
+    provider = provider or get_provider('openai', api_key, model_name)
+
+    for index, image_data in enumerate(documents):
+        try:
+            with timers[index].stage('encode'):
+                base64_image, detail, _ = prepare_image_payload(
+                    image_data, token_budget=token_budget, grayscale=grayscale
+                )
+            registry.observe('image_payload_bytes', len(base64_image))
+        except Exception as e:
+            logger.error("Error encoding image: %s", e)
+            results[index] = empty_extraction(str(e))
+            continue
+
+        cache_key = make_cache_key(base64_image, detail, provider.cache_id, PROMPT_VERSION)
+        cached_info = cache.get(cache_key) if cache is not None else None
+        if cached_info is not None:
+            results[index] = cached_info
+            continue
+
+        payloads.append((base64_image, detail))
+        pending.append((index, cache_key))
+
+    if pending:
+        try:
+            extractions = _extract_packed(payloads, provider, [timers[index] for index, _ in pending])
+        except Exception as e:
+            logger.error("Error in process_documents_packed: %s", e)
+            extractions = [empty_extraction(str(e)) for _ in pending]
+
+        for (index, cache_key), extracted_info in zip(pending, extractions):
+            # Only cache successful analyses so failures get retried
+            if cache is not None and 'error' not in extracted_info:
+                cache.set(cache_key, extracted_info)
+            results[index] = extracted_info
+
+    return results
+
+def missing_fields(extracted_info):
+    """
+    Text fields that are still empty in an extraction result
+    """
+    return [field for field in TEXT_FIELDS if not extracted_info.get(field)]
+
+def merge_extractions(merged, page_info):
+    """
+    Fill the empty fields of merged from a later page's extraction
+    The first page that provides a value wins
+    """
+    for field in TEXT_FIELDS:
+        if not merged.get(field) and page_info.get(field):
+            merged[field] = page_info[field]
+    merged['is_bank_statement'] = bool(merged.get('is_bank_statement') or page_info.get('is_bank_statement'))
+    return merged
+
+def process_document_pages(pages, api_key, model_name="gpt-4-vision-preview", cache=None, timer=None,
+                           token_budget=None, grayscale=False, page_filter=None, on_partial=None, provider=None,
+                           crop_header=False):
+    """
+    Process a multi-page document page by page
+    pages is an iterable of (page_number, image_bytes), e.g. from
+    pdf_handler.iter_pdf_pages; it is closed as soon as name, address and
+    document_date are all filled so later pages are never rendered or sent
+    page_filter(image_bytes) may return a reason to skip a page without
+    sending it (e.g. prefilter.blank_page_reason); on_partial, provider
+    and crop_header are passed to process_document for every page
+    Returns the merged extraction with 'pages_processed' listing page numbers
+    and 'pages_skipped' listing {'page', 'reason'} for filtered pages
+    """
+    timer = timer or StageTimer()
+    merged = {'is_bank_statement': False, 'name': '', 'address': '', 'document_date': ''}
+    pages_processed = []
+    pages_skipped = []
+    errors = []
+
+    page_iterator = iter(pages)
+    try:
+        while missing_fields(merged):
+            try:
+                with timer.stage('rasterize'):
+                    page_number, image_bytes = next(page_iterator)
+            except StopIteration:
+                break
+
+            if page_filter is not None:
+                with timer.stage('prefilter'):
+                    skip_reason = page_filter(image_bytes)
+                if skip_reason:
+                    pages_skipped.append({'page': page_number, 'reason': skip_reason})
+                    continue
+
+            page_info = process_document(
+                io.BytesIO(image_bytes), api_key, model_name, cache=cache, timer=timer,
+                token_budget=token_budget, grayscale=grayscale, on_partial=on_partial, provider=provider,
+                crop_header=crop_header
+            )
+            pages_processed.append(page_number)
+            if page_info.get('error'):
+                errors.append(f"page {page_number}: {page_info['error']}")
+                continue
+            merge_extractions(merged, page_info)
+    except Exception as e:
+        logger.error("Error in process_document_pages: %s", e)
+        errors.append(str(e))
+    finally:
+        # Stop rendering pages we no longer need
+        if hasattr(page_iterator, 'close'):
+            page_iterator.close()
+
+    merged['pages_processed'] = pages_processed
+    if pages_skipped:
+        merged['pages_skipped'] = pages_skipped
+
+    # Only report an error if no page produced anything useful
+    if errors and len(missing_fields(merged)) == len(TEXT_FIELDS):
+        merged['error'] = '; '.join(errors)
+
+    return merged
+
+def _cache_geocode_result(cache, cache_key, status_code, result):
+    # Cache hits and "nothing found" answers; transient errors (429, 5xx,
+    # network) are never cached. A 400 means Geoapify couldn't parse the text
+    if cache is None:
+        return
+    if status_code == 200:
+        ttl = GEOCODE_NEGATIVE_TTL if is_negative_result(result) else GEOCODE_CACHE_TTL
+        cache.set(cache_key, {'response': result}, ttl_seconds=ttl)
+    elif status_code == 400:
+        cache.set(cache_key, {'response': None}, ttl_seconds=GEOCODE_NEGATIVE_TTL)
+
+def geocode_address(address, api_key, cache=None, client=None):
+    """
+    Geocode an address using Geoapify API
+    Requests go through a pooled, rate-limited GeoapifyClient with retries
+    (the process-wide one for api_key unless client is given)
+    With a ResultCache, lookups are keyed by the normalized address and
+    repeated addresses (including unresolvable ones) skip the network
+    Returns the API response or None if error
+    """
+    cache_key = make_cache_key(normalize_address(address))
+    if cache is not None:
+        cached = cache.get(cache_key)
+        if cached is not None:
+            registry.inc('geocode_requests_total', result='cached')
+            return cached['response']
+
+    try:
+        # Make request to Geoapify
+        client = client or get_geoapify_client(api_key)
+        response = client.geocode(address)
+        registry.inc('geocode_requests_total', result=str(response.status_code))
+
+        # Check response status
+        if response.status_code != 200:
+            logger.error("Geoapify API error: %s", response.text)
+            _cache_geocode_result(cache, cache_key, response.status_code, None)
+            return None
+
+        # Return the full API response
+        result = response.json()
+        _cache_geocode_result(cache, cache_key, response.status_code, result)
+        return result
+
+    except Exception as e:
+        registry.inc('geocode_requests_total', result='error')
+        logger.error("Error geocoding address: %s", e)
+        return None
+
+def validate_address(address, api_key, timer=None, cache=None, client=None):
+    """
+    Validate an address using Geoapify API
+    Returns a dict with validation results including confidence metrics
+    """
+    timer = timer or StageTimer()
+    try:
+        # Get geocoding results for the address
+        with timer.stage('geocode'):
+            result = geocode_address(address, api_key, cache=cache, client=client)
+        return build_validation_result(result)
+
+    except Exception as e:
+        logger.error("Error validating address: %s", e)
+        return {
+            'is_valid': False,
+            'confidence': 0.0,
+            'error': str(e),
+            'details': None
+        }
+
+def process_document_cascade(document_file, api_key, model_name="gpt-4o", geoapify_api_key=None, cache=None,
+                             geocode_cache=None, timer=None, token_budget=None, grayscale=False, on_partial=None,
+                             provider=None, cheap_provider=None, crop_header=False):
+    """
+    Two-tier extraction: a fast, cheap model (CASCADE_MODEL unless
+    cheap_provider is given) reads a low-detail image first, and the
+    document is only escalated to the full model (model_name or provider,
+    at token_budget) when a text field is missing or, with a Geoapify key,
+    the extracted address geocodes with low confidence (a failed lookup
+    keeps the cheap tier's answer and its validation error)
+    Returns (extracted_info, validation_result); extracted_info['cascade']
+    records the tier that answered and why it escalated. validation_result
+    is None without a Geoapify key or an address
+    crop_header is passed to process_document for both tiers
+    """
+    timer = timer or StageTimer()
+    cheap_provider = cheap_provider or get_provider('openai', api_key, CASCADE_MODEL)
+    image_data = document_file.read()
+    document_file.seek(0)
+
+    extracted_info = process_document(
+        io.BytesIO(image_data), api_key, cache=cache, timer=timer, token_budget=CASCADE_TOKEN_BUDGET,
+        grayscale=grayscale, on_partial=on_partial, provider=cheap_provider, crop_header=crop_header
+    )
+
+    validation_result = None
+    reason = None
+    if extracted_info.get('error'):
+        reason = 'error'
+    elif missing_fields(extracted_info):
+        reason = 'missing_fields'
+    elif geoapify_api_key:
+        validation_result = validate_address(
+            extracted_info['address'], geoapify_api_key, timer=timer, cache=geocode_cache
+        )
+        # A geocoding outage is no reason to pay for the full model, which
+        # couldn't fix it; the cheap tier's answer stands with the error
+        if not validation_result.get('error') and not validation_result['is_valid']:
+            reason = 'low_address_confidence'
+
+    if reason is None:
+        extracted_info['cascade'] = {'tier': 'cheap', 'model': cheap_provider.cache_id}
+        return extracted_info, validation_result
+
+    cheap_info = extracted_info
+    extracted_info = process_document(
+        document_file, api_key, model_name, cache=cache, timer=timer, token_budget=token_budget,
+        grayscale=grayscale, on_partial=on_partial, provider=provider, crop_header=crop_header
+    )
+    extracted_info['cascade'] = {
+        'tier': 'full',
+        'model': (provider.cache_id if provider is not None else model_name),
+        'escalation_reason': reason,
+    }
+
+    if geoapify_api_key and extracted_info.get('address') and not extracted_info.get('error'):
+        same_address = (validation_result is not None
+                        and normalize_address(extracted_info['address']) == normalize_address(cheap_info['address']))
+        if not same_address:
+            validation_result = validate_address(
+                extracted_info['address'], geoapify_api_key, timer=timer, cache=geocode_cache
+            )
+    else:
+        validation_result = None
+
+    return extracted_info, validation_result
+
+def analyze_document(document_file, openai_api_key, geoapify_api_key, model_name="gpt-4o", cache=None,
+                     geocode_cache=None, all_pages=False, render_options=None, token_budget=None, validate=True,
+                     provider=None, cascade=False, cheap_provider=None, job_store=None, job_wait_timeout=None,
+                     crop_header=False):
+    """
+    Run the whole pipeline for one uploaded document: rasterize (PDFs),
+    extract, then validate the address
+    document_file needs a name so PDFs can be recognized
+    render_options (dpi, document_type, size, grayscale) go to the PDF
+    renderer; grayscale also applies to the image sent to the model
+    provider replaces the OpenAI model as in process_document; with
+    cascade, single images go through process_document_cascade first
+    (multi-page PDFs always use the full model); crop_header sends only the
+    header/address block where that is enough (see process_document)
+    With a JobStore, each stage is recorded as it finishes: a document
+    already analyzed with the same options is served from the store, one
+    being analyzed elsewhere is waited for (up to job_wait_timeout
+    seconds), and a failed one resumes after its last finished stage
+    Returns {'extracted': {...}, 'validation': {...} or None, 'timings': {stage: seconds}},
+    plus 'job' (key, attempt, resumed stage, deduplicated) with a JobStore
+    """
+    with span('analyze_document', filename=getattr(document_file, 'name', None)):
+        render_options = render_options or {}
+        grayscale = render_options.get('grayscale', False)
+        timer = StageTimer()
+
+        job = None
+        if job_store is not None:
+            job, finished = acquire_document_job(
+                job_store, document_file, model_name, render_options, all_pages, token_budget, validate,
+                provider=provider, cascade=cascade, cheap_provider=cheap_provider, timeout=job_wait_timeout,
+                crop_header=crop_header
+            )
+            if finished is not None:
+                return finished
+
+        # Keep the job's lease alive through slow model calls
+        with job_heartbeat(job_store, job):
+            validation_result = None
+            if stage_reached(job, STAGE_EXTRACTED):
+                extracted_info = job['extracted']
+                validation_result = job_validation(job)
+            elif all_pages and is_pdf(document_file):
+                pages = iter_pdf_pages(document_file, **render_options)
+                extracted_info = process_document_pages(
+                    pages, openai_api_key, model_name, cache=cache, timer=timer,
+                    token_budget=token_budget, grayscale=grayscale, provider=provider, crop_header=crop_header
+                )
+            else:
+                if stage_reached(job, STAGE_RASTERIZED):
+                    processed_file = io.BytesIO(job['image'])
+                else:
+                    try:
+                        with timer.stage('rasterize'):
+                            processed_file = prepare_document_image(document_file, **render_options)
+                    except Exception as e:
+                        logger.error("Error preparing document: %s", e)
+                        fail_job(job_store, job, e, 'rasterize')
+                        return _job_result({'extracted': empty_extraction(str(e)), 'validation': None,
+                                            'timings': timer.as_dict()}, job)
+                    save_job_stage(job_store, job, STAGE_RASTERIZED, image=processed_file.getvalue())
+
+                if cascade:
+                    extracted_info, validation_result = process_document_cascade(
+                        processed_file, openai_api_key, model_name, geoapify_api_key if validate else None,
+                        cache=cache, geocode_cache=geocode_cache, timer=timer, token_budget=token_budget,
+                        grayscale=grayscale, provider=provider, cheap_provider=cheap_provider, crop_header=crop_header
+                    )
+                else:
+                    extracted_info = process_document(
+                        processed_file, openai_api_key, model_name, cache=cache, timer=timer,
+                        token_budget=token_budget, grayscale=grayscale, provider=provider, crop_header=crop_header
+                    )
+
+            if extracted_info.get('error'):
+                fail_job(job_store, job, extracted_info['error'], 'extract')
+                return _job_result({'extracted': extracted_info, 'validation': None, 'timings': timer.as_dict()}, job)
+            if not stage_reached(job, STAGE_EXTRACTED):
+                save_job_stage(job_store, job, STAGE_EXTRACTED, extracted=extracted_info, validation=validation_result)
+
+            if validate and validation_result is None and extracted_info.get('address'):
+                validation_result = validate_address(
+                    extracted_info['address'], geoapify_api_key, timer=timer, cache=geocode_cache
+                )
+
+            result = {'extracted': extracted_info, 'validation': validation_result, 'timings': timer.as_dict()}
+            finish_job(job_store, job, validation_result, result['timings'])
+            return _job_result(result, job)
+
+def analysis_job_key(content_hash, pdf, model_name, render_options=None, all_pages=False, token_budget=None,
+                     validate=True, provider=None, cascade=False, cheap_provider=None, crop_header=False):
+    """
+    JobStore key for a document (by content hash) and the options that
+    change its result, the same for every entry point (UI, batch, HTTP)
+    Options are reduced to what the model actually gets: render options
+    only matter for PDFs, and the cascade's first tier defaults to
+    CASCADE_MODEL as in process_document_cascade
+    """
+    render_options = render_options or {}
+    rendering = {'grayscale': bool(render_options.get('grayscale'))}
+    if pdf and render_options.get('size'):
+        rendering['size'] = render_options['size']
+    elif pdf:
+        rendering['dpi'] = resolve_dpi(render_options.get('dpi'), render_options.get('document_type'))
+    cheap_tier = None
+    if cascade:
+        cheap_tier = cheap_provider.cache_id if cheap_provider is not None else CASCADE_MODEL
+    return document_job_key(
+        content_hash, provider.cache_id if provider is not None else model_name, cheap_tier,
+        rendering, bool(all_pages and pdf), token_budget, bool(validate), bool(crop_header), PROMPT_VERSION
+    )
+
+def acquire_document_job(job_store, document_file, model_name, render_options=None, all_pages=False,
+                         token_budget=None, validate=True, provider=None, cascade=False, cheap_provider=None,
+                         timeout=None, crop_header=False):
+    """
+    Find or claim the JobStore job for a document and its processing options
+    (see analysis_job_key; document_file needs a name so PDFs are recognized)
+    Returns (job, None) with a claimed job to work on (its stage says what
+    can be skipped), or (None, result) when the result is already known:
+    the stored analyze_document result, or an error if another worker
+    still holds the job after timeout seconds
+    """
+    digest = hashlib.sha256()
+    for block in iter(lambda: document_file.read(1024 * 1024), b''):
+        digest.update(block)
+    document_file.seek(0)
+    content_hash = digest.hexdigest()
+    job_key = analysis_job_key(
+        content_hash, is_pdf(document_file), model_name, render_options, all_pages, token_budget, validate,
+        provider=provider, cascade=cascade, cheap_provider=cheap_provider, crop_header=crop_header
+    )
+
+    outcome, job = job_store.acquire(job_key, content_hash, getattr(document_file, 'name', None), timeout=timeout)
+    if outcome == ALREADY_DONE:
+        result = job_result(job)
+        result['job'] = {'key': job_key, 'attempt': job['attempts'], 'deduplicated': True}
+        return None, result
+    if outcome == BUSY:
+        error = "Timed out waiting for the same document to finish processing elsewhere"
+        return None, {'extracted': empty_extraction(error), 'validation': None, 'timings': {},
+                      'job': {'key': job_key, 'deduplicated': False}}
+    return job, None
+
+def job_validation(job):
+    """
+    The validation stored with a claimed job's extraction (by the cascade),
+    or None if there is none or it failed, so a resumed job geocodes again
+    """
+    validation_result = job['validation']
+    if validation_result is not None and validation_result.get('error'):
+        return None
+    return validation_result
+
+def save_job_stage(job_store, job, stage, **outputs):
+    """
+    Record a finished stage of a claimed job (no-op without one)
+    A failed validation is not stored, so a retry geocodes again
+    """
+    if job is None:
+        return
+    if outputs.get('validation') is not None and outputs['validation'].get('error'):
+        outputs['validation'] = None
+    job_store.save_stage(job['job_key'], job['owner'], stage, **outputs)
+
+def finish_job(job_store, job, validation_result, timings=None):
+    """
+    Complete a claimed job once its address is validated (no-op without
+    one); if geocoding failed the job fails at 'validate' instead, and a
+    retry only redoes the validation
+    """
+    if job is None:
+        return
+    if validation_result is not None and validation_result.get('error'):
+        fail_job(job_store, job, validation_result['error'], 'validate')
+    else:
+        save_job_stage(job_store, job, STAGE_VALIDATED, validation=validation_result)
+        job_store.complete(job['job_key'], job['owner'], timings=timings)
+
+def job_heartbeat(job_store, job):
+    """
+    Keep renewing a claimed job's lease while a block runs (no-op without one)
+    """
+    if job is None:
+        return contextlib.nullcontext()
+    return job_store.heartbeat(job['job_key'], job['owner'])
+
+def fail_job(job_store, job, error, stage):
+    """
+    Mark a claimed job failed at stage (no-op without one)
+    """
+    if job is not None:
+        job_store.fail(job['job_key'], job['owner'], error, stage)
+
+def job_summary(job):
+    """
+    What a result reports about the claimed job it came from
+    """
+    return {'key': job['job_key'], 'attempt': job['attempts'], 'resumed_from': job['stage'], 'deduplicated': False}
+
+def _job_result(result, job):
+    if job is not None:
+        result['job'] = job_summary(job)
+    return result
+
+def validate_addresses(addresses, api_key, cache=None, client=None, use_batch=True, max_workers=8):
+    """
+    Validate many addresses at once
+    Addresses are deduplicated by their normalized form and served from the
+    cache where possible; the rest go through Geoapify's batch geocoding
+    endpoint, falling back to concurrent single lookups if batch jobs are
+    not available
+    Returns validation results in the same order as addresses
+    """
+    client = client or get_geoapify_client(api_key)
+
+    # One lookup per distinct normalized address
+    keys = [make_cache_key(normalize_address(address)) for address in addresses]
+    responses = {}
+    to_lookup = {}
+    for key, address in zip(keys, addresses):
+        if key in responses or key in to_lookup:
+            continue
+        cached = cache.get(key) if cache is not None else None
+        if cached is not None:
+            registry.inc('geocode_requests_total', result='cached')
+            responses[key] = cached['response']
+        else:
+            to_lookup[key] = address
+
+    pending = list(to_lookup.items())
+    if use_batch and len(pending) > 1:
+        try:
+            for start in range(0, len(pending), BATCH_MAX_SIZE):
+                chunk = pending[start:start + BATCH_MAX_SIZE]
+                results = client.batch_geocode([address for _, address in chunk])
+                registry.inc('geocode_requests_total', len(chunk), result='batch')
+                for (key, _), result in zip(chunk, results):
+                    responses[key] = result
+                    _cache_geocode_result(cache, key, 200, result)
+        except BatchGeocodingUnavailable as e:
+            logger.warning("Batch geocoding unavailable, falling back to single lookups: %s", e)
+        except Exception as e:
+            logger.error("Error in batch geocoding, falling back to single lookups: %s", e)
+        pending = [(key, address) for key, address in pending if key not in responses]
+
+    if pending:
+        # geocode_address writes the cache itself
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = executor.map(lambda item: geocode_address(item[1], api_key, cache=cache, client=client), pending)
+            for (key, _), result in zip(pending, results):
+                responses[key] = result
+
+    return [build_validation_result(responses.get(key)) for key in keys]
+
+def _run_in_executor(executor, function, *args, **kwargs):
+    # Run a blocking pipeline step off the event loop, keeping context
+    # variables such as the request priority (see scheduler.py)
+    context = contextvars.copy_context()
+    return asyncio.get_running_loop().run_in_executor(
+        executor, functools.partial(context.run, function, *args, **kwargs)
+    )
+
+async def process_document_async(image_data, api_key, model_name="gpt-4-vision-preview", executor=None, **options):
+    """
+    Async version of process_document for raw image bytes
+    The shared pipeline runs in executor (the loop's default one if None),
+    so providers, caching, header crops, streaming and metrics behave as
+    in process_document; options (cache, timer, provider, on_partial, ...)
+    are passed on to it, and on_partial is called from the worker thread
+    """
+    return await _run_in_executor(executor, process_document, io.BytesIO(image_data), api_key, model_name, **options)
+
+async def analyze_document_async(document_data, openai_api_key, geoapify_api_key, model_name="gpt-4o",
+                                 filename=None, executor=None, **options):
+    """
+    Async version of analyze_document for raw document bytes (filename
+    lets PDFs be recognized)
+    Runs the shared pipeline in executor like process_document_async;
+    options (cache, provider, cascade, job_store, ...) are passed on to
+    analyze_document
+    Returns {'extracted': {...}, 'validation': {...} or None, 'timings': {stage: seconds}}
+    """
+    document_file = io.BytesIO(document_data)
+    if filename is not None:
+        document_file.name = filename
+    return await _run_in_executor(
+        executor, analyze_document, document_file, openai_api_key, geoapify_api_key, model_name, **options
+    )
+
+async def analyze_documents_async(documents, openai_api_key, geoapify_api_key, model_name="gpt-4o",
+                                  filenames=None, max_concurrency=20, **options):
+    """
+    Analyze many documents concurrently
+    documents is a list of raw document bytes, with their filenames (so
+    PDFs are recognized) in the matching positions of filenames; at most
+    max_concurrency documents are in flight at once, each on a worker
+    thread of a pool shared with the providers' connection pools (see
+    get_provider)
+    options are passed on to analyze_document
+    Returns a list of analyze_document_async results in input order
+    """
+    documents = list(documents)
+    filenames = list(filenames) if filenames is not None else [None] * len(documents)
+    if len(filenames) != len(documents):
+        raise ValueError("filenames must match documents")
+    with ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="analyze-async") as executor:
+        return await asyncio.gather(*(
+            analyze_document_async(document_data, openai_api_key, geoapify_api_key, model_name,
+                                   filename=filename, executor=executor, **options)
+            for document_data, filename in zip(documents, filenames)
+        ))
@@ -0,0 +1,233 @@
+import os
+import re
+import time
+import logging
+import threading
+import unicodedata
+from rate_limit import TokenBucket, backoff_delay, parse_retry_after
+
+logger = logging.getLogger(__name__)
+
+# Overridable so tests and benchmarks can point at a local stub server
+GEOAPIFY_BASE_URL = os.environ.get("GEOAPIFY_BASE_URL", "https://api.geoapify.com")
+GEOCODE_PATH = "/v1/geocode/search"
+BATCH_GEOCODE_PATH = "/v1/batch/geocode/search"
+
+# Batch jobs: addresses per job, seconds between polls, give up after
+BATCH_MAX_SIZE = 1000
+BATCH_POLL_INTERVAL = 2.0
+BATCH_TIMEOUT = 15 * 60
+
+# Seconds to wait for Geoapify to connect / respond
+DEFAULT_TIMEOUT = float(os.environ.get("GEOAPIFY_TIMEOUT", "10"))
+
+# Requests per second allowed by our plan (the free tier allows 5)
+DEFAULT_RATE_LIMIT = float(os.environ.get("GEOAPIFY_RATE_LIMIT", "5"))
+
+DEFAULT_MAX_RETRIES = 3
+
+# Statuses worth retrying with backoff
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+DEFAULT_POOL_SIZE = 20
+
+# Successful lookups change rarely; unresolvable addresses are retried sooner
+GEOCODE_CACHE_TTL = 30 * 24 * 3600
+GEOCODE_NEGATIVE_TTL = 6 * 3600
+
+# Long and short spellings collapse to one canonical token
+ADDRESS_ABBREVIATIONS = {
+    'street': 'st', 'str': 'st',
+    'avenue': 'ave', 'av': 'ave',
+    'road': 'rd',
+    'boulevard': 'blvd',
+    'drive': 'dr',
+    'lane': 'ln',
+    'court': 'ct',
+    'place': 'pl',
+    'square': 'sq',
+    'terrace': 'ter',
+    'highway': 'hwy',
+    'parkway': 'pkwy',
+    'circle': 'cir',
+    'apartment': 'apt',
+    'suite': 'ste',
+    'floor': 'fl',
+    'building': 'bldg',
+    'number': 'no',
+    'north': 'n', 'south': 's', 'east': 'e', 'west': 'w',
+    'northeast': 'ne', 'northwest': 'nw', 'southeast': 'se', 'southwest': 'sw',
+    'saint': 'st',
+    'mount': 'mt',
+    'post office box': 'po box', 'p o box': 'po box',
+}
+
+_ABBREVIATION_PATTERN = re.compile(
+    r'\b(' + '|'.join(sorted((re.escape(key) for key in ADDRESS_ABBREVIATIONS), key=len, reverse=True)) + r')\b'
+)
+
+def normalize_address(address):
+    """
+    Normalize an address for use as a cache key
+    Case, accents, punctuation, whitespace and common abbreviations are
+    folded so "123 Main Street, Apt. 4" and "123 main st apt 4" match
+    """
+    text = unicodedata.normalize('NFKD', address or '')
+    text = ''.join(char for char in text if not unicodedata.combining(char)).lower()
+
+    # Punctuation becomes whitespace, then runs of whitespace collapse
+    text = re.sub(r'[^\w\s]', ' ', text)
+    text = re.sub(r'\s+', ' ', text).strip()
+
+    return _ABBREVIATION_PATTERN.sub(lambda match: ADDRESS_ABBREVIATIONS[match.group(1)], text)
+
+class BatchGeocodingUnavailable(Exception):
+    """
+    The batch endpoint can't be used (plan, permissions or outage)
+    Callers should fall back to single lookups
+    """
+
+def batch_item_to_feature_collection(item):
+    """
+    Convert one batch geocoding result (flat JSON) to the GeoJSON shape the
+    single-address endpoint returns, so both can be validated the same way
+    """
+    if not item or item.get('error') or 'formatted' not in item:
+        return {'type': 'FeatureCollection', 'features': []}
+    return {'type': 'FeatureCollection', 'features': [{'type': 'Feature', 'properties': item}]}
+
+def is_negative_result(response_json):
+    """
+    True if Geoapify answered but found nothing, which is worth caching
+    """
+    return not (response_json or {}).get('features')
+
+def _not_sent(error):
+    # Connect timeouts and refused or unresolvable connections fail before
+    # the request is written; anything later may have reached Geoapify
+    import requests
+    from urllib3.exceptions import NewConnectionError
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, NewConnectionError)
+
+class GeoapifyClient:
+    """
+    Connection-pooled Geoapify client
+    Applies a timeout to every request, retries 429/5xx and connection
+    errors with exponential backoff (honouring Retry-After), and shares a
+    token-bucket rate limiter across all threads using the client
+    """
+
+    def __init__(self, api_key, base_url=GEOAPIFY_BASE_URL, timeout=DEFAULT_TIMEOUT,
+                 max_retries=DEFAULT_MAX_RETRIES, rate_limit=DEFAULT_RATE_LIMIT, pool_size=DEFAULT_POOL_SIZE):
+        self.api_key = api_key
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.rate_limiter = TokenBucket(rate_limit) if rate_limit else None
+
+        # HTTP libraries are imported with the first client, not at startup
+        import requests
+        from requests.adapters import HTTPAdapter
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def request(self, method, path, params=None, idempotent=True, **kwargs):
+        """
+        Send a request with rate limiting and retries
+        Requests that must not run twice (idempotent=False) are only
+        retried when Geoapify never saw them: a failed connect or a 429
+        Returns the final requests.Response; raises if the last attempt
+        failed at the connection level
+        """
+        import requests
+        params = dict(params or {}, apiKey=self.api_key)
+        url = f"{self.base_url}{path}"
+        retry_statuses = RETRY_STATUSES if idempotent else {429}
+
+        for attempt in range(self.max_retries + 1):
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+
+            try:
+                response = self.session.request(method, url, params=params, timeout=self.timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt == self.max_retries or not (idempotent or _not_sent(e)):
+                    raise
+                delay = backoff_delay(attempt)
+                logger.warning("Geoapify request failed (%s), retrying in %.1fs", e, delay)
+                time.sleep(delay)
+                continue
+
+            if response.status_code in retry_statuses and attempt < self.max_retries:
+                delay = backoff_delay(attempt, retry_after=parse_retry_after(response.headers.get('Retry-After')))
+                logger.warning("Geoapify returned %s, retrying in %.1fs", response.status_code, delay)
+                time.sleep(delay)
+                continue
+
+            return response
+
+    def geocode(self, address):
+        """
+        Forward-geocode a free-text address
+        Returns the requests.Response
+        """
+        return self.request('GET', GEOCODE_PATH, params={'text': address})
+
+    def batch_geocode(self, addresses, poll_interval=BATCH_POLL_INTERVAL, timeout=BATCH_TIMEOUT):
+        """
+        Geocode up to BATCH_MAX_SIZE addresses with one batch job
+        Submits the job, then polls until Geoapify has finished it
+        Returns one GeoJSON FeatureCollection per address, in input order;
+        raises BatchGeocodingUnavailable if the batch API can't be used
+        """
+        if len(addresses) > BATCH_MAX_SIZE:
+            raise ValueError(f"At most {BATCH_MAX_SIZE} addresses per batch job")
+
+        # Every job created is billed, so a create that may have reached
+        # Geoapify is not sent again
+        response = self.request('POST', BATCH_GEOCODE_PATH, idempotent=False, json=list(addresses))
+        if response.status_code not in (200, 202):
+            raise BatchGeocodingUnavailable(f"Batch job rejected ({response.status_code}): {response.text}")
+        job_id = response.json().get('id')
+        if not job_id:
+            raise BatchGeocodingUnavailable("Batch job response did not include an id")
+
+        deadline = time.monotonic() + timeout
+        while True:
+            # The job answers 202 while it is still running
+            response = self.request('GET', BATCH_GEOCODE_PATH, params={'id': job_id, 'format': 'json'})
+            if response.status_code == 200:
+                break
+            if response.status_code != 202:
+                raise BatchGeocodingUnavailable(f"Batch job {job_id} failed ({response.status_code}): {response.text}")
+            if time.monotonic() > deadline:
+                raise BatchGeocodingUnavailable(f"Batch job {job_id} did not finish within {timeout}s")
+            time.sleep(poll_interval)
+
+        results = response.json()
+        if not isinstance(results, list) or len(results) != len(addresses):
+            raise BatchGeocodingUnavailable(f"Batch job {job_id} returned an unexpected result")
+        return [batch_item_to_feature_collection(item) for item in results]
+
+    def close(self):
+        self.session.close()
+
+_shared_clients = {}
+_shared_clients_lock = threading.Lock()
+
+def get_geoapify_client(api_key):
+    """
+    Process-wide GeoapifyClient for an API key
+    Sharing one client keeps connections warm and makes the rate limit
+    apply across every caller in the process
+    """
+    with _shared_clients_lock:
+        client = _shared_clients.get(api_key)
+        if client is None:
+            client = _shared_clients[api_key] = GeoapifyClient(api_key)
+        return client
@@ -0,0 +1,179 @@
+import io
+import math
+import base64
+import logging
+from pdf_handler import JPEG_QUALITY
+
+logger = logging.getLogger(__name__)
+
+# How the vision API sizes "high" detail images: fit inside 2048x2048, then
+# shrink so the shortest side is at most 768, then bill per 512px tile
+MAX_IMAGE_SIDE = 2048
+MAX_SHORT_SIDE = 768
+TILE_SIZE = 512
+BASE_TOKENS = 85
+TOKENS_PER_TILE = 170
+
+# Below this the smallest print on statements stops being legible
+MIN_OCR_SHORT_SIDE = 512
+
+# JPEGs in these modes are sent to the model exactly as uploaded
+JPEG_PASSTHROUGH_MODES = ('RGB', 'L')
+
+# Formats the vision APIs accept as they are, by the start of their
+# base64 encoding; anything else is re-encoded as JPEG
+PASSTHROUGH_FORMATS = {'JPEG': '/9j/', 'PNG': 'iVBORw0KGgo', 'WEBP': 'UklGR'}
+MEDIA_TYPES = {'JPEG': 'image/jpeg', 'PNG': 'image/png', 'WEBP': 'image/webp'}
+
+# When a resized image has to be re-encoded, its JPEG quality is lowered
+# in these steps (down to the minimum) until it is no bigger than the upload
+MIN_JPEG_QUALITY = 70
+JPEG_QUALITY_STEP = 5
+
+# Base64 characters decoded to find an image's size; enough for the JPEG
+# header and a typical EXIF block (a multiple of 4)
+HEADER_PROBE_CHARS = 64 * 1024
+
+def fit_to_tile_grid(width, height):
+    """
+    Size the API would downscale a "high" detail image to anyway
+    Anything larger only costs upload bytes
+    Returns (width, height)
+    """
+    scale = min(1.0, MAX_IMAGE_SIDE / max(width, height))
+    short_side = min(width, height) * scale
+    if short_side > MAX_SHORT_SIDE:
+        scale *= MAX_SHORT_SIDE / short_side
+    return max(1, int(width * scale)), max(1, int(height * scale))
+
+def estimate_image_tokens(width, height, detail="high"):
+    """
+    Estimate the prompt tokens an image costs at the given detail level
+    """
+    if detail == "low":
+        return BASE_TOKENS
+    width, height = fit_to_tile_grid(width, height)
+    tiles = math.ceil(width / TILE_SIZE) * math.ceil(height / TILE_SIZE)
+    return BASE_TOKENS + TOKENS_PER_TILE * tiles
+
+def image_media_type(base64_image):
+    """
+    MIME type of a base64-encoded payload from prepare_image_payload
+    """
+    for image_format, prefix in PASSTHROUGH_FORMATS.items():
+        if base64_image.startswith(prefix):
+            return MEDIA_TYPES[image_format]
+    return MEDIA_TYPES['JPEG']
+
+def image_dimensions(base64_image):
+    """
+    (width, height) of a base64-encoded image, decoding only its header
+    where possible
+    """
+    from PIL import Image
+    for probe in (base64_image[:HEADER_PROBE_CHARS], base64_image):
+        try:
+            with Image.open(io.BytesIO(base64.b64decode(probe))) as img:
+                return img.size
+        except Exception:
+            if len(probe) == len(base64_image):
+                raise
+
+def plan_image_size(width, height, token_budget=None, min_short_side=MIN_OCR_SHORT_SIDE):
+    """
+    Pick the largest size that fits the token budget without going below
+    min_short_side, snapping to whole tiles so no tile is paid for half-empty
+    A budget too small for even one high-detail tile falls back to "low"
+    Returns (width, height, detail)
+    """
+    width, height = fit_to_tile_grid(width, height)
+    if token_budget is None or estimate_image_tokens(width, height) <= token_budget:
+        return width, height, "high"
+
+    if token_budget < BASE_TOKENS + TOKENS_PER_TILE:
+        # Low detail is a fixed 512x512 view, don't send more than that
+        scale = min(1.0, TILE_SIZE / max(width, height))
+        return max(1, int(width * scale)), max(1, int(height * scale)), "low"
+
+    # Try every smaller tile grid; keep the largest image that fits the budget
+    best = None
+    columns, rows = math.ceil(width / TILE_SIZE), math.ceil(height / TILE_SIZE)
+    for grid_columns in range(1, columns + 1):
+        for grid_rows in range(1, rows + 1):
+            if BASE_TOKENS + TOKENS_PER_TILE * grid_columns * grid_rows > token_budget:
+                continue
+            scale = min(1.0, grid_columns * TILE_SIZE / width, grid_rows * TILE_SIZE / height)
+            if min(width, height) * scale < min_short_side:
+                continue
+            if best is None or scale > best:
+                best = scale
+
+    if best is None:
+        # Legibility wins over the budget
+        logger.warning("Token budget %s too small for a legible image, using the minimum OCR size", token_budget)
+        best = min(1.0, min_short_side / min(width, height))
+
+    return max(1, int(width * best)), max(1, int(height * best)), "high"
+
+def prepare_image_payload(image_data, token_budget=None, grayscale=False, min_short_side=MIN_OCR_SHORT_SIDE):
+    """
+    Size and encode an image for the vision model in a single pass
+    JPEGs that are already small enough (and in the right colour mode) are
+    passed through byte for byte; everything else is decoded at most once,
+    with JPEG draft mode doing most of the downscaling inside the decoder
+    A JPEG, PNG or WebP upload the API would downscale itself within the
+    token budget is also kept when re-encoding it isn't smaller; a resize
+    that is needed is re-encoded at the highest quality (from JPEG_QUALITY
+    down to MIN_JPEG_QUALITY) that is no bigger than the upload
+    Returns (base64_string, detail, (width, height)); see image_media_type
+    """
+    # Work on the raw bytes so a pass-through needs no extra copy
+    if isinstance(image_data, (io.BytesIO, io.BufferedReader)):
+        image_data = image_data.read()
+
+    # Image.open only parses the header, pixels are decoded lazily
+    from PIL import Image
+    img = Image.open(io.BytesIO(image_data))
+    target_width, target_height, detail = plan_image_size(
+        img.width, img.height, token_budget=token_budget, min_short_side=min_short_side
+    )
+    target_mode = 'L' if grayscale else None
+    needs_resize = (target_width, target_height) != img.size
+    original_size = img.size
+    sendable = (img.format in PASSTHROUGH_FORMATS and img.mode in JPEG_PASSTHROUGH_MODES
+                and (target_mode is None or img.mode == target_mode))
+
+    if sendable and img.format == 'JPEG' and not needs_resize:
+        return base64.b64encode(image_data).decode('ascii'), detail, img.size
+
+    # The API shrinks an oversized image itself, billing it like the
+    # resized one, so the original only has to fit the token budget
+    original_fits = sendable and (detail == 'low' or token_budget is None
+                                  or estimate_image_tokens(*original_size) <= token_budget)
+
+    if img.format == 'JPEG' and needs_resize:
+        # Let libjpeg decode at 1/2, 1/4 or 1/8 scale instead of full size
+        img.draft(target_mode or 'RGB', (target_width, target_height))
+
+    if target_mode:
+        img = img.convert(target_mode)
+    elif img.mode not in JPEG_PASSTHROUGH_MODES:
+        img = img.convert('RGB')
+
+    if img.size != (target_width, target_height):
+        img = img.resize((target_width, target_height), Image.LANCZOS)
+
+    encoded = _encode_jpeg(img, JPEG_QUALITY)
+    if original_fits and len(encoded) >= len(image_data):
+        return base64.b64encode(image_data).decode('ascii'), detail, original_size
+
+    quality = JPEG_QUALITY
+    while len(encoded) > len(image_data) and quality > MIN_JPEG_QUALITY:
+        quality = max(MIN_JPEG_QUALITY, quality - JPEG_QUALITY_STEP)
+        encoded = _encode_jpeg(img, quality)
+    return base64.b64encode(encoded).decode('ascii'), detail, img.size
+
+def _encode_jpeg(img, quality):
+    img_byte_array = io.BytesIO()
+    img.save(img_byte_array, format='JPEG', quality=quality)
+    return img_byte_array.getvalue()
@@ -0,0 +1,320 @@
+import contextlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from cache import make_cache_key
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_JOB_STORE_PATH = os.environ.get(
+    "DOCUMENT_JOB_STORE_PATH",
+    os.path.join(os.path.expanduser("~"), ".cache", "smart-document-analyzer", "jobs.sqlite3")
+)
+
+# Stages a document goes through, in order; a job records the last one it
+# finished so a retry can pick up after it
+STAGE_NEW = 'new'
+STAGE_RASTERIZED = 'rasterized'
+STAGE_EXTRACTED = 'extracted'
+STAGE_VALIDATED = 'validated'
+STAGES = (STAGE_NEW, STAGE_RASTERIZED, STAGE_EXTRACTED, STAGE_VALIDATED)
+
+# Job status
+STATUS_RUNNING = 'running'
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+
+# claim() outcomes
+CLAIMED = 'claimed'
+ALREADY_DONE = 'done'
+BUSY = 'busy'
+
+# A running job whose worker hasn't reported for this long is taken over;
+# workers renew it while they run (see JobStore.heartbeat)
+DEFAULT_LEASE_SECONDS = int(os.environ.get("DOCUMENT_JOB_LEASE_SECONDS", 300))
+
+# Finished jobs are kept this long
+DEFAULT_RETENTION_SECONDS = 30 * 24 * 3600
+
+def document_job_key(content_hash, *options):
+    """
+    Job key for a document: its content hash plus everything that changes
+    the result (model, render options, prompt version, ...)
+    """
+    return make_cache_key(content_hash, *(json.dumps(option, sort_keys=True) for option in options))
+
+def stage_reached(job, stage):
+    """
+    True if the job has finished stage (or a later one)
+    """
+    return job is not None and STAGES.index(job['stage']) >= STAGES.index(stage)
+
+def job_result(job):
+    """
+    The analyze_document-style result of a finished job
+    """
+    return {'extracted': job['extracted'], 'validation': job['validation'], 'timings': job['timings'] or {}}
+
+class JobStore:
+    """
+    Durable, SQLite-backed record of documents being and having been
+    processed, keyed by content hash and processing options
+    Each job tracks the last finished stage with its output (the rasterized
+    image until extraction, then the extraction, then the validation) so
+    a crashed or failed document resumes where it stopped, and a finished
+    one is never processed again. claim() is atomic across threads and
+    processes, so concurrent uploads of the same document are processed
+    once: the first caller works, the others wait() for its result
+    """
+
+    def __init__(self, path=DEFAULT_JOB_STORE_PATH, lease_seconds=DEFAULT_LEASE_SECONDS,
+                 retention_seconds=DEFAULT_RETENTION_SECONDS):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.retention_seconds = retention_seconds
+        self._lock = threading.Lock()
+
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+        # One shared connection, serialized by our own lock
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock:
+            if path != ":memory:":
+                self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                """CREATE TABLE IF NOT EXISTS jobs (
+                    job_key TEXT PRIMARY KEY,
+                    content_hash TEXT NOT NULL,
+                    filename TEXT,
+                    stage TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    owner TEXT,
+                    lease_until REAL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    image BLOB,
+                    extracted TEXT,
+                    validation TEXT,
+                    timings TEXT,
+                    error TEXT,
+                    error_stage TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )"""
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_content_hash ON jobs (content_hash)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_updated_at ON jobs (updated_at)")
+        self.purge()
+
+    def claim(self, job_key, content_hash, filename=None):
+        """
+        Take ownership of a job, creating it if it is new
+        Returns (outcome, job): CLAIMED with the job to work on (its stage
+        says what can be skipped; pass job['owner'] to the update calls),
+        ALREADY_DONE with the finished job, or BUSY if another worker holds
+        a live lease on it (see wait)
+        """
+        now = time.time()
+        owner = uuid.uuid4().hex
+        with self._lock:
+            # BEGIN IMMEDIATE takes the write lock up front, so two
+            # processes can't both see the job as free
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute("SELECT * FROM jobs WHERE job_key = ?", (job_key,)).fetchone()
+                if row is None:
+                    self._conn.execute(
+                        """INSERT INTO jobs (job_key, content_hash, filename, stage, status, owner, lease_until,
+                                             attempts, created_at, updated_at)
+                           VALUES (?, ?, ?, ?, ?, ?, ?, 1, ?, ?)""",
+                        (job_key, content_hash, filename, STAGE_NEW, STATUS_RUNNING, owner,
+                         now + self.lease_seconds, now, now)
+                    )
+                    outcome = CLAIMED
+                elif row['status'] == STATUS_DONE:
+                    outcome = ALREADY_DONE
+                elif row['status'] == STATUS_RUNNING and row['lease_until'] > now:
+                    outcome = BUSY
+                else:
+                    # Failed, or its worker died: resume from the last stage
+                    self._conn.execute(
+                        """UPDATE jobs SET status = ?, owner = ?, lease_until = ?, attempts = attempts + 1,
+                                           updated_at = ?
+                           WHERE job_key = ?""",
+                        (STATUS_RUNNING, owner, now + self.lease_seconds, now, job_key)
+                    )
+                    outcome = CLAIMED
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return outcome, self.get(job_key)
+
+    def acquire(self, job_key, content_hash, filename=None, timeout=None):
+        """
+        claim(), waiting out other workers holding the job
+        Returns (CLAIMED, job), (ALREADY_DONE, job), or (BUSY, None) if the
+        job is still held after timeout seconds
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            outcome, job = self.claim(job_key, content_hash, filename)
+            if outcome != BUSY:
+                return outcome, job
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return BUSY, None
+            job = self.wait(job_key, timeout=remaining)
+            if job is not None and job['status'] == STATUS_DONE:
+                return ALREADY_DONE, job
+            # Failed or abandoned by its worker (or timed out): try again
+
+    def save_stage(self, job_key, owner, stage, image=None, extracted=None, validation=None):
+        """
+        Record a finished stage and its output, and renew the lease
+        The rasterized image is dropped once the extraction is stored
+        Returns False if the job has been taken over by another worker
+        """
+        now = time.time()
+        assignments = ["stage = ?", "lease_until = ?", "updated_at = ?"]
+        values = [stage, now + self.lease_seconds, now]
+        if image is not None:
+            assignments.append("image = ?")
+            values.append(sqlite3.Binary(image))
+        if extracted is not None:
+            assignments += ["extracted = ?", "image = NULL"]
+            values.append(json.dumps(extracted))
+        if validation is not None:
+            assignments.append("validation = ?")
+            values.append(json.dumps(validation))
+        return self._update_owned(job_key, owner, assignments, values)
+
+    def renew(self, job_key, owner):
+        """
+        Extend the lease of a job this owner still holds
+        Returns False if the job has been taken over or is no longer running
+        """
+        now = time.time()
+        return self._update_owned(
+            job_key, owner, ["lease_until = ?", "updated_at = ?"], [now + self.lease_seconds, now]
+        )
+
+    @contextlib.contextmanager
+    def heartbeat(self, job_key, owner, interval=None):
+        """
+        Renew the lease every interval seconds (a third of the lease by
+        default) while the block runs, so a model call slower than the lease
+        doesn't let another worker claim the job
+        """
+        interval = interval or self.lease_seconds / 3
+        stop = threading.Event()
+
+        def beat():
+            while not stop.wait(interval):
+                if not self.renew(job_key, owner):
+                    logger.info("Job %s is no longer held by this worker", job_key)
+                    return
+
+        thread = threading.Thread(target=beat, name=f"job-heartbeat-{job_key[:8]}", daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    def complete(self, job_key, owner, timings=None):
+        """
+        Mark the job done; later claims get ALREADY_DONE
+        """
+        return self._update_owned(
+            job_key, owner,
+            ["status = ?", "lease_until = NULL", "timings = ?", "error = NULL", "error_stage = NULL",
+             "updated_at = ?"],
+            [STATUS_DONE, json.dumps(timings or {}), time.time()]
+        )
+
+    def fail(self, job_key, owner, error, stage):
+        """
+        Mark the job failed at stage; the next claim resumes it from the
+        last finished stage
+        """
+        return self._update_owned(
+            job_key, owner,
+            ["status = ?", "lease_until = NULL", "error = ?", "error_stage = ?", "updated_at = ?"],
+            [STATUS_FAILED, str(error), stage, time.time()]
+        )
+
+    def abandon(self, job_key, owner):
+        """
+        Forget a job that produced nothing worth keeping (e.g. a document
+        the pre-filter skipped)
+        """
+        with self._lock:
+            self._conn.execute("DELETE FROM jobs WHERE job_key = ? AND owner = ?", (job_key, owner))
+
+    def _update_owned(self, job_key, owner, assignments, values):
+        with self._lock:
+            cursor = self._conn.execute(
+                f"UPDATE jobs SET {', '.join(assignments)} WHERE job_key = ? AND owner = ? AND status = ?",
+                (*values, job_key, owner, STATUS_RUNNING)
+            )
+            return cursor.rowcount == 1
+
+    def get(self, job_key):
+        """
+        The job as a dict (JSON columns decoded), or None
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM jobs WHERE job_key = ?", (job_key,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        for column in ('extracted', 'validation', 'timings'):
+            job[column] = json.loads(job[column]) if job[column] else None
+        return job
+
+    def wait(self, job_key, timeout=None, poll_interval=0.25):
+        """
+        Wait while another worker holds the job
+        Returns the job once it is done, failed or its lease has expired,
+        or None if timeout seconds pass first
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            job = self.get(job_key)
+            if job is None or job['status'] != STATUS_RUNNING or job['lease_until'] <= time.time():
+                return job
+            if deadline is not None and time.monotonic() >= deadline:
+                return None
+            time.sleep(poll_interval)
+
+    def purge(self):
+        """
+        Drop finished and failed jobs older than retention_seconds
+        """
+        cutoff = time.time() - self.retention_seconds
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM jobs WHERE status != ? AND updated_at < ?", (STATUS_RUNNING, cutoff)
+            )
+
+    def stats(self):
+        """
+        Job counts per status and per stage
+        """
+        with self._lock:
+            by_status = dict(self._conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+            by_stage = dict(self._conn.execute(
+                "SELECT stage, COUNT(*) FROM jobs WHERE status != ? GROUP BY stage", (STATUS_DONE,)
+            ).fetchall())
+        return {'status': by_status, 'unfinished_by_stage': by_stage}
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM jobs").fetchone()[0]
@@ -0,0 +1,98 @@
+import io
+from pdf_handler import JPEG_QUALITY
+from prefilter import load_screen_image
+
+# Name, address and date sit in the top part of statements and bills
+HEADER_FRACTION = 0.4
+
+# Text blocks are found at screening size: characters are merged into
+# lines by a wide closing kernel, lines into blocks by a taller one
+LINE_KERNEL = (25, 3)
+BLOCK_KERNEL = (15, 15)
+
+# Blocks smaller than this fraction of the page are specks and noise
+MIN_BLOCK_AREA = 0.0005
+
+# Padding around the cropped region, as a fraction of the page size
+CROP_MARGIN = 0.02
+
+# Not worth cropping if the region covers most of the page anyway
+MAX_CROP_AREA = 0.75
+
+def find_text_blocks(gray):
+    """
+    Bounding boxes (x, y, width, height) of text blocks in a grayscale page,
+    top to bottom
+    """
+    import cv2
+    ink = cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY_INV, 25, 15)
+    lines = cv2.morphologyEx(ink, cv2.MORPH_CLOSE, cv2.getStructuringElement(cv2.MORPH_RECT, LINE_KERNEL))
+    blocks = cv2.dilate(lines, cv2.getStructuringElement(cv2.MORPH_RECT, BLOCK_KERNEL))
+    contours, _ = cv2.findContours(blocks, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+    height, width = gray.shape
+    min_area = MIN_BLOCK_AREA * width * height
+    boxes = []
+    for contour in contours:
+        x, y, block_width, block_height = cv2.boundingRect(contour)
+        if block_width * block_height < min_area:
+            continue
+        # Page borders and scan edges span (nearly) the whole page
+        if block_width > 0.95 * width and block_height > 0.95 * height:
+            continue
+        boxes.append((x, y, block_width, block_height))
+    return sorted(boxes, key=lambda box: (box[1], box[0]))
+
+def header_region(boxes, width, height, header_fraction=HEADER_FRACTION):
+    """
+    Region (left, top, right, bottom) around the text blocks that start in
+    the top header_fraction of the page, padded by CROP_MARGIN
+    Returns None if there are none, or if the region is most of the page
+    """
+    header = [box for box in boxes if box[1] < header_fraction * height]
+    if not header:
+        return None
+
+    margin_x, margin_y = CROP_MARGIN * width, CROP_MARGIN * height
+    left = max(0, min(x for x, _, _, _ in header) - margin_x)
+    top = max(0, min(y for _, y, _, _ in header) - margin_y)
+    right = min(width, max(x + block_width for x, _, block_width, _ in header) + margin_x)
+    bottom = min(height, max(y + block_height for _, y, _, block_height in header) + margin_y)
+
+    if (right - left) * (bottom - top) > MAX_CROP_AREA * width * height:
+        return None
+    return left, top, right, bottom
+
+def crop_header(image_data, header_fraction=HEADER_FRACTION):
+    """
+    Crop a page image to its header/address block
+    Blocks are located on a small copy of the page, the crop is cut from
+    the full-resolution image so no detail is lost
+    Returns (jpeg_bytes, (left, top, right, bottom)) in original pixels,
+    or (None, None) if no useful region was found
+    """
+    screen = load_screen_image(image_data)
+    if screen is None:
+        return None, None
+
+    import cv2
+    from PIL import Image
+    gray = cv2.cvtColor(screen, cv2.COLOR_BGR2GRAY)
+    screen_height, screen_width = gray.shape
+    region = header_region(find_text_blocks(gray), screen_width, screen_height, header_fraction)
+    if region is None:
+        return None, None
+
+    img = Image.open(io.BytesIO(image_data))
+    scale_x, scale_y = img.width / screen_width, img.height / screen_height
+    box = (
+        int(region[0] * scale_x), int(region[1] * scale_y),
+        min(img.width, round(region[2] * scale_x)), min(img.height, round(region[3] * scale_y)),
+    )
+
+    cropped = img.crop(box)
+    if cropped.mode not in ('RGB', 'L'):
+        cropped = cropped.convert('RGB')
+    buffer = io.BytesIO()
+    cropped.save(buffer, format='JPEG', quality=JPEG_QUALITY)
+    return buffer.getvalue(), box
@@ -0,0 +1,225 @@
+import io
+import os
+import tempfile
+import threading
+import weakref
+from collections import OrderedDict
+from metrics import registry
+
+# Rendered pages one UI session may keep in memory; beyond that the least
+# recently used are dropped, and a page too large on its own is spilled
+DEFAULT_SESSION_MEMORY_BYTES = int(float(os.environ.get("DOCUMENT_SESSION_MEMORY_MB", 128)) * 1024 * 1024)
+
+# Document bytes the whole process may keep in memory across sessions (or
+# queued HTTP uploads); beyond that new buffers go to temporary files
+DEFAULT_GLOBAL_MEMORY_BYTES = int(float(os.environ.get("DOCUMENT_MEMORY_LIMIT_MB", 1024)) * 1024 * 1024)
+
+# Where spilled buffers go (default: the system temporary directory)
+SPILL_DIR = os.environ.get("DOCUMENT_SPILL_DIR") or None
+
+# Read size when copying streams into a buffer
+COPY_CHUNK_SIZE = 1024 * 1024
+
+class MemoryBudget:
+    """
+    Thread-safe count of bytes held in memory against a limit
+    A budget with a parent (e.g. a session under the process-wide budget)
+    only grants a reservation that both can afford
+    """
+
+    def __init__(self, limit_bytes, parent=None, name='global'):
+        self.limit_bytes = limit_bytes
+        self.parent = parent
+        self.name = name
+        self.used_bytes = 0
+        self.spills = 0
+        self._lock = threading.Lock()
+
+    def reserve(self, size):
+        """
+        Account for size more bytes if they fit
+        Returns False (reserving nothing) if this budget or a parent is full
+        """
+        with self._lock:
+            if self.used_bytes + size > self.limit_bytes:
+                return False
+            self.used_bytes += size
+        if self.parent is not None and not self.parent.reserve(size):
+            with self._lock:
+                self.used_bytes -= size
+            return False
+        self._update_gauge()
+        return True
+
+    def release(self, size):
+        """
+        Give back bytes taken with reserve()
+        """
+        with self._lock:
+            self.used_bytes = max(0, self.used_bytes - size)
+        if self.parent is not None:
+            self.parent.release(size)
+        self._update_gauge()
+
+    def record_spill(self):
+        with self._lock:
+            self.spills += 1
+        registry.inc('buffer_spills_total', budget=self.name)
+
+    def stats(self):
+        with self._lock:
+            return {'used_bytes': self.used_bytes, 'limit_bytes': self.limit_bytes, 'spills': self.spills}
+
+    def _update_gauge(self):
+        # Per-session budgets would make one series per session
+        if self.parent is None:
+            registry.set_gauge('buffer_memory_bytes', self.used_bytes, budget=self.name)
+
+class DocumentBuffer:
+    """
+    The bytes of one document or rendered page, held in memory while the
+    budget allows and spilled to an anonymous temporary file otherwise
+    release() frees the memory (or file) at once; a buffer that is dropped
+    without release() gives its reservation back when garbage collected
+    """
+
+    def __init__(self, data, budget=None):
+        self.size = len(data)
+        self._data = None
+        self._file = None
+        self._release = None
+        if budget is None or budget.reserve(self.size):
+            self._keep(data, budget, self.size)
+        else:
+            self._spill(budget).write(data)
+
+    @classmethod
+    def from_stream(cls, stream, length, budget=None):
+        """
+        Read length bytes from stream (e.g. an HTTP request body) into a
+        buffer; when the budget can't take them they are copied to disk in
+        chunks, so a spilled upload is never held in memory whole
+        """
+        buffer = cls(b'')
+        if budget is None or budget.reserve(length):
+            data = stream.read(length)
+            buffer._keep(data, budget, length)
+            buffer.size = len(data)
+            return buffer
+
+        file = buffer._spill(budget)
+        remaining = length
+        while remaining > 0:
+            chunk = stream.read(min(COPY_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            file.write(chunk)
+            remaining -= len(chunk)
+        buffer.size = length - remaining
+        return buffer
+
+    def _keep(self, data, budget, reserved):
+        self._data = data
+        if budget is not None:
+            self._release = weakref.finalize(self, budget.release, reserved)
+
+    def _spill(self, budget):
+        budget.record_spill()
+        self._data = None
+        self._file = tempfile.TemporaryFile(dir=SPILL_DIR)
+        return self._file
+
+    @property
+    def spilled(self):
+        return self._file is not None
+
+    @property
+    def released(self):
+        return self._data is None and self._file is None
+
+    def getvalue(self):
+        """
+        The document bytes (read back from disk if spilled)
+        """
+        if self._data is not None:
+            return self._data
+        if self._file is None:
+            raise ValueError("Buffer has been released")
+        self._file.seek(0)
+        return self._file.read()
+
+    def open(self, name=None):
+        """
+        A file-like view of the bytes, named like the original upload so
+        PDFs are still recognized
+        """
+        file = io.BytesIO(self.getvalue())
+        if name is not None:
+            file.name = name
+        return file
+
+    def release(self):
+        """
+        Free the bytes now rather than whenever the buffer is collected
+        """
+        self._data = None
+        if self._release is not None:
+            self._release()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+class PageMemo:
+    """
+    Per-session memo of prepared (rendered and encoded) pages, so a rerun
+    doesn't render the same upload again
+    Pages are kept under the session budget, least recently used first out;
+    a page that doesn't fit even alone is spilled to disk
+    """
+
+    def __init__(self, budget):
+        self.budget = budget
+        self._pages = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        The memoized DocumentBuffer for key, or None
+        """
+        with self._lock:
+            buffer = self._pages.get(key)
+            if buffer is not None:
+                self._pages.move_to_end(key)
+            return buffer
+
+    def put(self, key, data):
+        """
+        Memoize data under key, evicting older pages to make room
+        Returns the DocumentBuffer holding it
+        """
+        with self._lock:
+            previous = self._pages.pop(key, None)
+            if previous is not None:
+                previous.release()
+            while self._pages and self.budget.used_bytes + len(data) > self.budget.limit_bytes:
+                _, evicted = self._pages.popitem(last=False)
+                evicted.release()
+            buffer = DocumentBuffer(data, self.budget)
+            self._pages[key] = buffer
+            return buffer
+
+    def clear(self):
+        with self._lock:
+            for buffer in self._pages.values():
+                buffer.release()
+            self._pages.clear()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._pages)
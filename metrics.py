@@ -0,0 +1,254 @@
+import math
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+# Pipeline stages in the order a document goes through them
+PIPELINE_STAGES = ['rasterize', 'encode', 'model_call', 'parse', 'geocode']
+
+# Every exported metric name starts with this
+METRIC_PREFIX = 'document_analyzer_'
+
+# Histogram bucket upper bounds
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+BYTES_BUCKETS = (16 * 1024, 64 * 1024, 256 * 1024, 1024 * 1024, 4 * 1024 * 1024, 16 * 1024 * 1024)
+
+class MetricsRegistry:
+    """
+    Thread-safe, process-wide counters, gauges and histograms with labels
+    Metrics are declared once with describe(); render() returns them in the
+    Prometheus text exposition format
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def describe(self, name, kind, help_text, buckets=None):
+        """
+        Declare a metric; kind is 'counter', 'gauge' or 'histogram'
+        """
+        if kind not in ('counter', 'gauge', 'histogram'):
+            raise ValueError(f"Unknown metric kind: {kind}")
+        with self._lock:
+            self._metrics.setdefault(name, {
+                'kind': kind,
+                'help': help_text,
+                'buckets': tuple(buckets or SECONDS_BUCKETS) if kind == 'histogram' else None,
+                'series': {},
+            })
+
+    def _metric(self, name, kind):
+        metric = self._metrics.get(name)
+        if metric is None or metric['kind'] != kind:
+            raise KeyError(f"{name} is not a declared {kind}")
+        return metric
+
+    def inc(self, name, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._metric(name, 'counter')['series']
+            series[key] = series.get(key, 0) + amount
+
+    def set_gauge(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._metric(name, 'gauge')['series'][key] = value
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            metric = self._metric(name, 'histogram')
+            state = metric['series'].get(key)
+            if state is None:
+                state = metric['series'][key] = {'buckets': [0] * len(metric['buckets']), 'sum': 0.0, 'count': 0}
+            for index, bound in enumerate(metric['buckets']):
+                if value <= bound:
+                    state['buckets'][index] += 1
+            state['sum'] += value
+            state['count'] += 1
+
+    def snapshot(self):
+        """
+        Current values as {name: {labels tuple: value}}; histograms give
+        {'buckets', 'sum', 'count'} per label set
+        """
+        with self._lock:
+            return {
+                name: {
+                    key: dict(value, buckets=list(value['buckets'])) if isinstance(value, dict) else value
+                    for key, value in metric['series'].items()
+                }
+                for name, metric in self._metrics.items()
+            }
+
+    def render(self):
+        """
+        All metrics in the Prometheus text exposition format (version 0.0.4)
+        """
+        lines = []
+        with self._lock:
+            for name, metric in sorted(self._metrics.items()):
+                full_name = METRIC_PREFIX + name
+                lines.append(f"# HELP {full_name} {metric['help']}")
+                lines.append(f"# TYPE {full_name} {metric['kind']}")
+                for key, value in sorted(metric['series'].items()):
+                    if metric['kind'] != 'histogram':
+                        lines.append(f"{full_name}{_format_labels(key)} {_format_value(value)}")
+                        continue
+                    for bound, count in zip(metric['buckets'], value['buckets']):
+                        lines.append(f"{full_name}_bucket{_format_labels(key + (('le', _format_value(bound)),))} {count}")
+                    lines.append(f"{full_name}_bucket{_format_labels(key + (('le', '+Inf'),))} {value['count']}")
+                    lines.append(f"{full_name}_sum{_format_labels(key)} {_format_value(value['sum'])}")
+                    lines.append(f"{full_name}_count{_format_labels(key)} {value['count']}")
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        """
+        Drop all recorded values (declarations are kept)
+        """
+        with self._lock:
+            for metric in self._metrics.values():
+                metric['series'].clear()
+
+def _format_labels(key):
+    if not key:
+        return ''
+    escaped = (
+        (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in key
+    )
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(round(value, 6))
+    return str(value)
+
+# Process-wide registry the pipeline records into
+registry = MetricsRegistry()
+registry.describe('stage_seconds', 'histogram', "Duration of each pipeline stage")
+registry.describe('image_payload_bytes', 'histogram', "Size of the base64 image sent to the vision model",
+                  buckets=BYTES_BUCKETS)
+registry.describe('model_request_seconds', 'histogram', "Vision model request latency by model")
+registry.describe('model_requests_total', 'counter', "Vision model requests by model and outcome")
+registry.describe('scheduler_wait_seconds', 'histogram', "Time vision requests waited for their model's rate limit budget")
+registry.describe('scheduler_queue_depth', 'gauge', "Vision requests waiting for rate limit budget, by model and priority")
+registry.describe('model_tokens_total', 'counter', "Tokens used by the vision model, by model and kind")
+registry.describe('model_replies_total', 'counter', "Model replies by parse outcome")
+registry.describe('cache_lookups_total', 'counter', "Result cache lookups by table and result")
+registry.describe('geocode_requests_total', 'counter', "Geoapify lookups by result")
+registry.describe('documents_total', 'counter', "Documents finished, by status")
+registry.describe('jobs_running', 'gauge', "Jobs being analyzed by the HTTP service")
+registry.describe('jobs_queued', 'gauge', "Jobs waiting in the HTTP service queue")
+registry.describe('buffer_memory_bytes', 'gauge', "Document bytes held in memory, by budget")
+registry.describe('buffer_spills_total', 'counter', "Document buffers spilled to disk because a memory budget was full")
+
+_tracer = None
+
+def get_tracer():
+    """
+    OpenTelemetry tracer for the pipeline, or None if opentelemetry isn't
+    installed (spans are then free no-ops)
+    """
+    global _tracer
+    if _tracer is None:
+        try:
+            from opentelemetry import trace
+        except ImportError:
+            _tracer = False
+        else:
+            _tracer = trace.get_tracer("smart-document-analyzer")
+    return _tracer or None
+
+def span(name, **attributes):
+    """
+    Context manager for a tracing span; nests under the current span and
+    does nothing without opentelemetry
+    """
+    tracer = get_tracer()
+    if tracer is None:
+        return nullcontext()
+    return tracer.start_as_current_span(
+        name, attributes={key: value for key, value in attributes.items() if value is not None}
+    )
+
+class StageTimer:
+    """
+    Records wall-clock duration per pipeline stage for one document
+    An optional on_stage(name, seconds) callback fires as each stage ends,
+    which the UI uses to drive its progress bar
+    Stages timed with stage() are also recorded in the stage_seconds
+    histogram and traced as spans
+    """
+
+    def __init__(self, on_stage=None):
+        self.durations = {}
+        self.on_stage = on_stage
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Time the enclosed block as the given stage
+        Repeated stages (e.g. several pages) accumulate
+        """
+        started = time.perf_counter()
+        try:
+            with span(name):
+                yield
+        finally:
+            elapsed = time.perf_counter() - started
+            self.durations[name] = self.durations.get(name, 0.0) + elapsed
+            registry.observe('stage_seconds', elapsed, stage=name)
+            if self.on_stage is not None:
+                self.on_stage(name, elapsed)
+
+    def add(self, name, seconds):
+        """
+        Record time measured elsewhere, e.g. this document's share of a
+        request made for several documents at once (not added to the
+        stage_seconds histogram, which has the measurement already)
+        """
+        self.durations[name] = self.durations.get(name, 0.0) + seconds
+        if self.on_stage is not None:
+            self.on_stage(name, seconds)
+
+    def total(self):
+        return sum(self.durations.values())
+
+    def as_dict(self):
+        """
+        Stage durations in seconds, rounded for serialization
+        """
+        return {name: round(seconds, 4) for name, seconds in self.durations.items()}
+
+def percentile(values, pct):
+    """
+    Nearest-rank percentile of a list of numbers
+    Returns None for an empty list
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, math.ceil(pct / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+def summarize_timings(timings):
+    """
+    Aggregate many StageTimer.as_dict() results
+    Returns {stage: {'count', 'p50', 'p95', 'max'}} in seconds
+    """
+    by_stage = {}
+    for timing in timings:
+        for name, seconds in timing.items():
+            by_stage.setdefault(name, []).append(seconds)
+
+    summary = {}
+    for name, values in by_stage.items():
+        summary[name] = {
+            'count': len(values),
+            'p50': percentile(values, 50),
+            'p95': percentile(values, 95),
+            'max': max(values),
+        }
+    return summary
@@ -1,33 +1,159 @@
 import io
-import tempfile
-import os
-from pdf2image import convert_from_path, convert_from_bytes
-from PIL import Image
+import re
+import subprocess
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
-def convert_pdf_to_image(pdf_file):
+# 300 DPI pages (~2550x3300) are far larger than the vision model needs;
+# printed statements read fine at 150-200 DPI
+DEFAULT_DPI = 200
+
+# Rendering resolution per document type, small print needs more pixels
+DPI_BY_DOCUMENT_TYPE = {
+    'statement': 150,
+    'utility_bill': 150,
+    'receipt': 200,
+    'id_card': 300,
+}
+
+JPEG_QUALITY = 90
+
+PDFTOPPM_TIMEOUT = 120
+
+def read_pdf_bytes(pdf_file):
+    """
+    Get the raw bytes of a PDF given as bytes or a file-like object
+    """
+    if isinstance(pdf_file, (bytes, bytearray)):
+        return bytes(pdf_file)
+    if hasattr(pdf_file, 'getvalue'):
+        return pdf_file.getvalue()
+    data = pdf_file.read()
+    pdf_file.seek(0)
+    return data
+
+def resolve_dpi(dpi=None, document_type=None):
+    """
+    Pick the rendering DPI: an explicit dpi wins, then the document type
+    preset, then DEFAULT_DPI
+    """
+    if dpi:
+        return dpi
+    return DPI_BY_DOCUMENT_TYPE.get(document_type, DEFAULT_DPI)
+
+def render_pdf_page(pdf_bytes, page=1, dpi=DEFAULT_DPI, size=None, grayscale=False, fmt='jpeg',
+                    jpeg_quality=JPEG_QUALITY):
+    """
+    Render a single PDF page with pdftoppm, streaming the PDF over stdin
+    and reading the image from stdout so nothing touches the disk
+    size, if given, is the target length of the longest side in pixels and
+    takes precedence over dpi
+    fmt is 'jpeg', 'png' or None for raw PPM/PGM
+    Returns the encoded image bytes
+    """
+    args = ['pdftoppm', '-f', str(page), '-l', str(page)]
+    if size:
+        args += ['-scale-to', str(size)]
+    else:
+        args += ['-r', str(dpi)]
+    if grayscale:
+        args.append('-gray')
+    if fmt == 'jpeg':
+        args += ['-jpeg', '-jpegopt', f'quality={jpeg_quality}']
+    elif fmt == 'png':
+        args.append('-png')
+    # "-" makes pdftoppm read the PDF from stdin
+    args.append('-')
+
+    try:
+        result = subprocess.run(args, input=pdf_bytes, capture_output=True, timeout=PDFTOPPM_TIMEOUT)
+    except FileNotFoundError:
+        raise Exception("pdftoppm not found, is poppler installed and on PATH?")
+
+    if result.returncode != 0 or not result.stdout:
+        message = result.stderr.decode('utf-8', 'replace').strip() or "No pages found in PDF"
+        raise Exception(message)
+
+    return result.stdout
+
+def get_pdf_page_count(pdf_bytes):
+    """
+    Count the pages of a PDF with pdfinfo, streaming it over stdin
     """
-    Convert the first page of a PDF file to an image
+    try:
+        result = subprocess.run(['pdfinfo', '-'], input=pdf_bytes, capture_output=True, timeout=PDFTOPPM_TIMEOUT)
+    except FileNotFoundError:
+        raise Exception("pdfinfo not found, is poppler installed and on PATH?")
+
+    match = re.search(rb'^Pages:\s+(\d+)', result.stdout, re.MULTILINE)
+    if result.returncode != 0 or not match:
+        raise Exception(result.stderr.decode('utf-8', 'replace').strip() or "Could not read PDF page count")
+    return int(match.group(1))
+
+def iter_pdf_pages(pdf_file, first_page=1, last_page=None, dpi=None, document_type=None, size=None,
+                   grayscale=False, max_workers=4, executor=None):
+    """
+    Lazily render the pages of a PDF to JPEG, several pages in parallel
+    Up to max_workers pages are rendered ahead of the consumer, so stopping
+    early (closing the generator) skips the remaining pages
+    Pass an executor (e.g. a ProcessPoolExecutor) to render in a shared pool
+    Yields (page_number, jpeg_bytes) in page order
+    """
+    try:
+        pdf_bytes = read_pdf_bytes(pdf_file)
+        page_count = get_pdf_page_count(pdf_bytes)
+    except Exception as e:
+        raise Exception(f"Error converting PDF to image: {str(e)}")
+
+    last_page = min(last_page or page_count, page_count)
+    render_dpi = resolve_dpi(dpi, document_type)
+
+    own_executor = executor is None
+    if own_executor:
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    pending = deque()
+    next_page = first_page
+    try:
+        while next_page <= last_page or pending:
+            # Keep up to max_workers pages rendering ahead of the consumer
+            while next_page <= last_page and len(pending) < max_workers:
+                future = executor.submit(render_pdf_page, pdf_bytes, next_page, render_dpi, size, grayscale, 'jpeg')
+                pending.append((next_page, future))
+                next_page += 1
+
+            page_number, future = pending.popleft()
+            try:
+                jpeg_bytes = future.result()
+            except Exception as e:
+                raise Exception(f"Error converting PDF page {page_number} to image: {str(e)}")
+            yield page_number, jpeg_bytes
+    finally:
+        # Consumer stopped early or failed: drop pages that haven't started
+        for _, future in pending:
+            future.cancel()
+        if own_executor:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+def convert_pdf_to_image(pdf_file, page=1, dpi=None, document_type=None, size=None, grayscale=False):
+    """
+    Convert one page (the first by default) of a PDF file to an image
+    Accepts bytes or a file-like object; see render_pdf_page for options
     Returns PIL Image object
     """
     try:
-        # Create a temporary file to save the PDF
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as temp_pdf:
-            # Write the content of the uploaded file to the temp file
-            temp_pdf.write(pdf_file.getvalue())
-            temp_pdf_path = temp_pdf.name
-        
-        # Convert PDF to images
-        pages = convert_from_path(temp_pdf_path, 300, first_page=1, last_page=1)
-        
-        # Clean up the temporary file
-        os.unlink(temp_pdf_path)
-        
-        # Return the first page as PIL Image
-        if pages:
-            return pages[0]
-        else:
-            raise Exception("No pages found in PDF")
-            
+        pdf_bytes = read_pdf_bytes(pdf_file)
+
+        # Raw PPM/PGM output skips an encode/decode round-trip
+        image_bytes = render_pdf_page(
+            pdf_bytes, page=page, dpi=resolve_dpi(dpi, document_type), size=size,
+            grayscale=grayscale, fmt=None
+        )
+        from PIL import Image
+        image = Image.open(io.BytesIO(image_bytes))
+        image.load()
+        return image
+
     except Exception as e:
         raise Exception(f"Error converting PDF to image: {str(e)}")
 
@@ -39,22 +165,24 @@ def is_pdf(file):
         return file.name.lower().endswith('.pdf')
     return False
 
-def prepare_document_image(uploaded_file):
+def prepare_document_image(uploaded_file, dpi=None, document_type=None, size=None, grayscale=False):
     """
     Prepare document image for processing
-    If PDF, convert to image
+    If PDF, render the first page straight to JPEG at the requested
+    resolution (see render_pdf_page)
     Returns a BytesIO object containing the image
     """
     if is_pdf(uploaded_file):
-        # Convert PDF to image
-        image = convert_pdf_to_image(uploaded_file)
-        
-        # Convert PIL Image to BytesIO
-        img_byte_array = io.BytesIO()
-        image.save(img_byte_array, format='JPEG', quality=95)
-        img_byte_array.seek(0)
-        
-        return img_byte_array
+        try:
+            # pdftoppm encodes the JPEG itself, no PIL round-trip needed
+            jpeg_bytes = render_pdf_page(
+                read_pdf_bytes(uploaded_file), page=1, dpi=resolve_dpi(dpi, document_type),
+                size=size, grayscale=grayscale, fmt='jpeg'
+            )
+        except Exception as e:
+            raise Exception(f"Error converting PDF to image: {str(e)}")
+
+        return io.BytesIO(jpeg_bytes)
     else:
         # Return the file as is
-        return uploaded_file
\ No newline at end of file
+        return uploaded_file
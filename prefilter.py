@@ -0,0 +1,220 @@
+import threading
+from collections import OrderedDict
+
+# OpenCV and numpy are imported inside the functions, so importing this
+# module (e.g. for the SKIP_* reasons) doesn't load them
+
+# Images are screened at this size; plenty for page-level statistics
+SCREEN_MAX_SIDE = 1024
+
+# A page is blank if almost no pixels are clearly darker than the paper
+INK_CONTRAST = 60
+BLANK_INK_RATIO = 0.002
+
+# Perceptual hash: 256-bit difference hash; re-scans and recompressed copies
+# differ in a bit or two, different pages of the same template in 8 or more
+HASH_SIZE = 16
+DUPLICATE_MAX_DISTANCE = 4
+
+# How many recently processed documents are remembered for duplicate checks
+RECENT_DOCUMENTS = 1000
+
+# "Looks like a document": several separate text lines, white space between
+# them, and little colour (photos are colourful and textured throughout)
+MIN_TEXT_LINES = 5
+MIN_BLANK_ROW_FRACTION = 0.15
+MAX_COLORFULNESS = 45
+
+# Skip reasons reported to callers
+SKIP_BLANK = 'blank_page'
+SKIP_DUPLICATE = 'near_duplicate'
+SKIP_NOT_DOCUMENT = 'not_a_document'
+SKIP_UNREADABLE = 'unreadable_image'
+
+def load_screen_image(image_data, max_side=SCREEN_MAX_SIDE):
+    """
+    Decode image bytes into a small BGR array for screening
+    Returns None if OpenCV can't decode the data
+    """
+    import cv2
+    import numpy as np
+    buffer = np.frombuffer(image_data, dtype=np.uint8)
+    # JPEG decoding at reduced scale is much cheaper than a full decode
+    image = cv2.imdecode(buffer, cv2.IMREAD_REDUCED_COLOR_2)
+    if image is None:
+        image = cv2.imdecode(buffer, cv2.IMREAD_COLOR)
+    if image is None:
+        return None
+
+    height, width = image.shape[:2]
+    scale = max_side / max(height, width)
+    if scale < 1:
+        image = cv2.resize(image, (max(1, int(width * scale)), max(1, int(height * scale))),
+                           interpolation=cv2.INTER_AREA)
+    return image
+
+def ink_ratio(gray):
+    """
+    Fraction of pixels clearly darker than the page background
+    """
+    import numpy as np
+    background = np.median(gray)
+    return float(np.count_nonzero(gray < background - INK_CONTRAST)) / gray.size
+
+def is_blank(gray):
+    return ink_ratio(gray) < BLANK_INK_RATIO
+
+def difference_hash(gray, hash_size=HASH_SIZE):
+    """
+    Difference hash (dHash) of a grayscale image, hash_size ** 2 bits
+    Robust to rescaling, recompression and small brightness changes, but
+    blind to small edits: two copies of a form differing only in a name
+    hash the same
+    """
+    import cv2
+    resized = cv2.resize(gray, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
+    bits = (resized[:, 1:] > resized[:, :-1]).flatten()
+    return int(''.join('1' if bit else '0' for bit in bits), 2)
+
+def hamming_distance(first_hash, second_hash):
+    return bin(first_hash ^ second_hash).count('1')
+
+def colorfulness(image):
+    """
+    Hasler and Suesstrunk colourfulness metric, roughly 0 for grayscale
+    scans and well above 50 for photos
+    """
+    import cv2
+    import numpy as np
+    blue, green, red = cv2.split(image.astype(np.float32))
+    red_green = red - green
+    yellow_blue = 0.5 * (red + green) - blue
+    std = np.hypot(np.std(red_green), np.std(yellow_blue))
+    mean = np.hypot(np.mean(red_green), np.mean(yellow_blue))
+    return float(std + 0.3 * mean)
+
+def text_layout(gray):
+    """
+    Cheap layout statistics from the horizontal ink profile
+    Returns {'text_lines', 'blank_row_fraction'}
+    """
+    import cv2
+    ink = cv2.adaptiveThreshold(gray, 1, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY_INV, 25, 15)
+    row_ink = ink.mean(axis=1)
+    inked_rows = row_ink > 0.01
+
+    # Each run of inked rows at least a few pixels tall counts as a line
+    text_lines = 0
+    run_length = 0
+    for inked in inked_rows:
+        if inked:
+            run_length += 1
+            continue
+        if run_length >= 3:
+            text_lines += 1
+        run_length = 0
+    if run_length >= 3:
+        text_lines += 1
+
+    return {
+        'text_lines': text_lines,
+        'blank_row_fraction': round(1 - float(inked_rows.mean()), 3),
+    }
+
+def looks_like_document(checks):
+    return (checks['text_lines'] >= MIN_TEXT_LINES
+            and checks['blank_row_fraction'] >= MIN_BLANK_ROW_FRACTION
+            and checks['colorfulness'] <= MAX_COLORFULNESS)
+
+class RecentDocuments:
+    """
+    Thread-safe, bounded memory of recently seen document hashes
+    Oldest entries are forgotten first
+    """
+
+    def __init__(self, max_entries=RECENT_DOCUMENTS, max_distance=DUPLICATE_MAX_DISTANCE):
+        self.max_entries = max_entries
+        self.max_distance = max_distance
+        self._hashes = OrderedDict()
+        self._lock = threading.Lock()
+
+    def check_and_add(self, image_hash, label):
+        """
+        Remember image_hash under label
+        Returns the label of an earlier near-duplicate, or None if there is
+        none (checking and adding is atomic so concurrent copies are caught)
+        """
+        with self._lock:
+            for seen_hash, seen_label in self._hashes.items():
+                if hamming_distance(image_hash, seen_hash) <= self.max_distance:
+                    return seen_label
+            self._hashes[image_hash] = label
+            while len(self._hashes) > self.max_entries:
+                self._hashes.popitem(last=False)
+            return None
+
+    def forget(self, image_hash):
+        """
+        Drop a hash (int or prefilter_document's hex form), e.g. when its
+        document failed and should not make later copies look like duplicates
+        """
+        if isinstance(image_hash, str):
+            image_hash = int(image_hash, 16)
+        with self._lock:
+            self._hashes.pop(image_hash, None)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._hashes)
+
+def prefilter_document(image_data, recent=None, label=None, check_layout=False):
+    """
+    Screen an image locally before it is sent to the vision model
+    Checks for blank pages, near-duplicates of recent documents (if a
+    RecentDocuments is given; meant for re-uploads of the same document,
+    see difference_hash) and, with check_layout, images that don't look
+    like a text document at all (photos, illustrations)
+    Returns a dict with 'skip' (bool), 'reason' (one of the SKIP_* values or
+    None), 'checks' (the measured statistics), 'hash' (hex) and, for
+    duplicates, 'duplicate_of' (the label the earlier document was
+    registered under)
+    """
+    image = load_screen_image(image_data)
+    if image is None:
+        return {'skip': True, 'reason': SKIP_UNREADABLE, 'checks': {}, 'hash': None}
+
+    import cv2
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    checks = {'ink_ratio': round(ink_ratio(gray), 4)}
+    image_hash = difference_hash(gray)
+    result = {'skip': False, 'reason': None, 'checks': checks, 'hash': format(image_hash, 'x')}
+
+    if checks['ink_ratio'] < BLANK_INK_RATIO:
+        result.update(skip=True, reason=SKIP_BLANK)
+        return result
+
+    if check_layout:
+        checks.update(text_layout(gray))
+        checks['colorfulness'] = round(colorfulness(image), 1)
+        if not looks_like_document(checks):
+            result.update(skip=True, reason=SKIP_NOT_DOCUMENT)
+            return result
+
+    # Last, so skipped images never enter the duplicate memory
+    if recent is not None:
+        duplicate_of = recent.check_and_add(image_hash, label)
+        if duplicate_of is not None:
+            result.update(skip=True, reason=SKIP_DUPLICATE, duplicate_of=duplicate_of)
+
+    return result
+
+def blank_page_reason(image_data):
+    """
+    Page filter for process_document_pages: SKIP_BLANK for blank pages,
+    otherwise None
+    """
+    import cv2
+    image = load_screen_image(image_data)
+    if image is not None and is_blank(cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)):
+        return SKIP_BLANK
+    return None
@@ -0,0 +1,563 @@
+import json
+import math
+import inspect
+import time
+import random
+import logging
+import threading
+from image_handler import estimate_image_tokens, image_dimensions, image_media_type
+from metrics import registry, span
+from rate_limit import backoff_delay, parse_retry_after
+from scheduler import get_scheduler
+
+logger = logging.getLogger(__name__)
+
+# Seconds to wait for a vision model before giving up on it
+DEFAULT_PROVIDER_TIMEOUT = 60
+
+# Timeouts, dropped connections and server errors are retried this many
+# times (rate limits are retried by the scheduler instead)
+DEFAULT_MAX_RETRIES = 2
+
+# Models and snapshots that support Structured Outputs (a strict JSON
+# schema), matched exactly: older snapshots such as gpt-4o-2024-05-13
+# reject it with a 400. Other models starting with a JSON_MODE_MODELS
+# prefix only get JSON mode; vision-preview supports neither
+JSON_SCHEMA_MODELS = frozenset({
+    'gpt-4o', 'gpt-4o-2024-08-06', 'gpt-4o-2024-11-20',
+    'gpt-4o-mini', 'gpt-4o-mini-2024-07-18',
+    'gpt-4.1', 'gpt-4.1-2025-04-14',
+    'gpt-4.1-mini', 'gpt-4.1-mini-2025-04-14',
+    'gpt-4.1-nano', 'gpt-4.1-nano-2025-04-14',
+})
+JSON_MODE_MODELS = ('gpt-4o', 'gpt-4.1', 'gpt-4-turbo')
+
+DEFAULT_ANTHROPIC_MODEL = "claude-3-5-sonnet-20241022"
+# Small, fast Claude model for the first tier of a cascade
+FAST_ANTHROPIC_MODEL = "claude-3-haiku-20240307"
+
+# Anthropic rejects images larger than this (base64 payload)
+ANTHROPIC_MAX_IMAGE_BYTES = 5 * 1024 * 1024
+
+# Claude bills about width * height / 750 tokens per image, and scales
+# larger images down to roughly this many
+ANTHROPIC_PIXELS_PER_TOKEN = 750
+ANTHROPIC_MAX_IMAGE_TOKENS = 1600
+
+# Rough characters per token of prompt text, for rate limit estimates
+CHARS_PER_TOKEN = 4
+
+class ModelReply(str):
+    """
+    Reply text; truncated is True if the model stopped at max_tokens, so
+    the reply is not mistaken for a complete one
+    """
+
+    truncated = False
+
+    def __new__(cls, text, truncated=False):
+        reply = super().__new__(cls, text)
+        reply.truncated = truncated
+        return reply
+
+def openai_response_format(model_name, json_schema=None):
+    """
+    Extra chat completion arguments that make an OpenAI model answer with a
+    JSON object: json_schema where Structured Outputs are supported, plain
+    JSON mode where only that is, nothing for other models
+    """
+    if json_schema and model_name in JSON_SCHEMA_MODELS:
+        return {"response_format": {"type": "json_schema", "json_schema": json_schema}}
+    if json_schema and model_name.startswith(JSON_MODE_MODELS):
+        return {"response_format": {"type": "json_object"}}
+    return {}
+
+def is_timeout(error):
+    """
+    True for timeouts raised by either SDK or the standard library
+    Checked by class name, so neither SDK has to be imported for it
+    """
+    return isinstance(error, TimeoutError) or type(error).__name__ == 'APITimeoutError'
+
+def is_rate_limited(error):
+    """
+    True for 429 rate limit errors from either SDK
+    """
+    return type(error).__name__ == 'RateLimitError' or getattr(error, 'status_code', None) == 429
+
+def is_transient(error):
+    """
+    True for failures worth retrying: timeouts, dropped connections and
+    server errors (what the SDKs' own retries cover, minus rate limits)
+    """
+    status_code = getattr(error, 'status_code', None)
+    return (is_timeout(error) or type(error).__name__ == 'APIConnectionError'
+            or status_code in (408, 409) or (status_code or 0) >= 500)
+
+def rate_limit_retry_after(error):
+    """
+    Seconds the API asked us to wait (Retry-After header), or None
+    """
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None) or {}
+    return parse_retry_after(headers.get('retry-after'))
+
+class VisionProvider:
+    """
+    A vision model behind one API
+    complete() sends a prompt plus images and returns the reply text;
+    images is a list of (caption, base64_jpeg, detail) where caption is
+    optional text placed before the image
+    Subclasses implement _complete(); complete() adds request metrics and
+    a tracing span around it, waits for the model's RPM/TPM budget (see
+    scheduler.py) and retries rate-limited calls with jittered backoff;
+    other transient failures are retried up to max_retries times
+    """
+
+    name = 'base'
+
+    def __init__(self, model_name, max_image_bytes=None, max_retries=DEFAULT_MAX_RETRIES):
+        self.model_name = model_name
+        self.max_image_bytes = max_image_bytes
+        self.max_retries = max_retries
+
+    @property
+    def cache_id(self):
+        """
+        Identifies the model in result cache keys
+        """
+        return f"{self.name}:{self.model_name}"
+
+    def accepts(self, images):
+        """
+        False if the provider can't take these images at all
+        """
+        if self.max_image_bytes is None:
+            return True
+        return all(len(base64_image) <= self.max_image_bytes for _, base64_image, _ in images)
+
+    @property
+    def scheduler(self):
+        """
+        The process-wide QuotaScheduler for this model
+        """
+        return get_scheduler(self.cache_id)
+
+    def image_tokens(self, base64_image, detail):
+        """
+        Estimated prompt tokens for one image
+        """
+        width, height = image_dimensions(base64_image)
+        return estimate_image_tokens(width, height, detail)
+
+    def estimate_tokens(self, prompt, images, max_tokens=1024):
+        """
+        Tokens a request counts against the TPM limit: prompt text, images
+        and the max_tokens reserved for the reply
+        """
+        text = len(prompt) + sum(len(caption or '') for caption, _, _ in images)
+        return (text // CHARS_PER_TOKEN + max_tokens
+                + sum(self.image_tokens(base64_image, detail) for _, base64_image, detail in images))
+
+    def complete(self, prompt, images, max_tokens=1024, json_schema=None, on_text=None, on_retry=None):
+        """
+        Returns the reply text (a ModelReply, flagged if the model stopped at
+        max_tokens); on_text(chunk) streams it as it arrives
+        on_retry() is called before the request is sent again (after a rate
+        limit here, or to another provider by a router), so text streamed
+        by the failed attempt can be discarded
+        Raises on API errors and timeouts, and on rate limits that persist
+        through the scheduler's retries
+        """
+        scheduler = self.scheduler
+        cost = self.estimate_tokens(prompt, images, max_tokens)
+        attempt = 0
+        failures = 0
+        while True:
+            scheduler.acquire(cost)
+            started = time.perf_counter()
+            with span('model_request', model=self.cache_id, images=len(images)):
+                try:
+                    text = self._complete(prompt, images, max_tokens=max_tokens, json_schema=json_schema,
+                                          on_text=on_text)
+                except Exception as e:
+                    if is_rate_limited(e) and attempt < scheduler.max_retries:
+                        registry.inc('model_requests_total', model=self.cache_id, outcome='rate_limited')
+                        delay = backoff_delay(attempt, retry_after=rate_limit_retry_after(e))
+                        logger.warning("%r is rate limited, retrying in %.1fs", self, delay)
+                        scheduler.pause(delay)
+                        attempt += 1
+                        if on_retry is not None:
+                            on_retry()
+                        continue
+                    registry.inc('model_requests_total', model=self.cache_id,
+                                 outcome='timeout' if is_timeout(e) else 'error')
+                    if is_transient(e) and failures < self.max_retries:
+                        delay = backoff_delay(failures)
+                        logger.warning("%r failed (%s), retrying in %.1fs", self, e, delay)
+                        time.sleep(delay)
+                        failures += 1
+                        if on_retry is not None:
+                            on_retry()
+                        continue
+                    raise
+            registry.inc('model_requests_total', model=self.cache_id, outcome='ok')
+            registry.observe('model_request_seconds', time.perf_counter() - started, model=self.cache_id)
+            return text
+
+    def _complete(self, prompt, images, max_tokens=1024, json_schema=None, on_text=None):
+        raise NotImplementedError
+
+    def _record_tokens(self, input_tokens, output_tokens):
+        # Usage as reported by the API, for the model_tokens_total counter
+        if input_tokens:
+            registry.inc('model_tokens_total', input_tokens, model=self.cache_id, kind='input')
+        if output_tokens:
+            registry.inc('model_tokens_total', output_tokens, model=self.cache_id, kind='output')
+
+    def __repr__(self):
+        return f"<{type(self).__name__} {self.cache_id}>"
+
+class OpenAIProvider(VisionProvider):
+    name = 'openai'
+
+    def __init__(self, api_key, model_name="gpt-4o", timeout=DEFAULT_PROVIDER_TIMEOUT, max_retries=DEFAULT_MAX_RETRIES):
+        super().__init__(model_name, max_retries=max_retries)
+        # Imported on first use; the SDK takes most of a second to import.
+        # Its own retries are off: complete() retries, and 429s must go
+        # through the scheduler so they pause every request to the model
+        import openai
+        self.client = openai.OpenAI(api_key=api_key, timeout=timeout, max_retries=0)
+
+    @property
+    def streams_usage(self):
+        """
+        True if the installed SDK can report token usage on a stream
+        (stream_options, openai>=1.26)
+        """
+        return 'stream_options' in inspect.signature(self.client.chat.completions.create).parameters
+
+    @property
+    def cache_id(self):
+        # Bare model name, so results cached before providers existed still match
+        return self.model_name
+
+    def _complete(self, prompt, images, max_tokens=1024, json_schema=None, on_text=None):
+        content = [{"type": "text", "text": prompt}]
+        for caption, base64_image, detail in images:
+            if caption:
+                content.append({"type": "text", "text": caption})
+            content.append({
+                "type": "image_url",
+                "image_url": {
+                    "url": f"data:{image_media_type(base64_image)};base64,{base64_image}",
+                    "detail": detail
+                }
+            })
+
+        request = dict(
+            model=self.model_name,
+            messages=[{"role": "user", "content": content}],
+            max_tokens=max_tokens,
+            temperature=0,
+            **openai_response_format(self.model_name, json_schema)
+        )
+        if on_text is None or not self.streams_usage:
+            # Without stream usage an older SDK would leave the token metrics
+            # empty, so it gets the whole reply as one chunk instead
+            response = self.client.chat.completions.create(**request)
+            if response.usage is not None:
+                self._record_tokens(response.usage.prompt_tokens, response.usage.completion_tokens)
+            text = response.choices[0].message.content or ''
+            if on_text is not None and text:
+                on_text(text)
+            return ModelReply(text, truncated=response.choices[0].finish_reason == 'length')
+
+        parts = []
+        finish_reason = None
+        # The last chunk carries the usage (and no choices)
+        for chunk in self.client.chat.completions.create(stream=True, stream_options={"include_usage": True},
+                                                         **request):
+            if getattr(chunk, 'usage', None) is not None:
+                self._record_tokens(chunk.usage.prompt_tokens, chunk.usage.completion_tokens)
+            if not chunk.choices:
+                continue
+            finish_reason = chunk.choices[0].finish_reason or finish_reason
+            delta = chunk.choices[0].delta.content
+            if delta:
+                parts.append(delta)
+                on_text(delta)
+        return ModelReply(''.join(parts), truncated=finish_reason == 'length')
+
+class AnthropicProvider(VisionProvider):
+    name = 'anthropic'
+
+    def __init__(self, api_key, model_name=DEFAULT_ANTHROPIC_MODEL, timeout=DEFAULT_PROVIDER_TIMEOUT,
+                 max_retries=DEFAULT_MAX_RETRIES):
+        super().__init__(model_name, max_image_bytes=ANTHROPIC_MAX_IMAGE_BYTES, max_retries=max_retries)
+        # Imported here so OpenAI-only deployments don't pay for it; retries
+        # are left to complete() as for OpenAI
+        import anthropic
+        self.client = anthropic.Anthropic(api_key=api_key, timeout=timeout, max_retries=0)
+
+    def image_tokens(self, base64_image, detail):
+        width, height = image_dimensions(base64_image)
+        return min(ANTHROPIC_MAX_IMAGE_TOKENS, math.ceil(width * height / ANTHROPIC_PIXELS_PER_TOKEN))
+
+    def _complete(self, prompt, images, max_tokens=1024, json_schema=None, on_text=None):
+        content = []
+        for caption, base64_image, _ in images:
+            if caption:
+                content.append({"type": "text", "text": caption})
+            content.append({
+                "type": "image",
+                "source": {"type": "base64", "media_type": image_media_type(base64_image), "data": base64_image}
+            })
+        content.append({"type": "text", "text": prompt})
+
+        messages = [{"role": "user", "content": content}]
+        prefix = ''
+        if json_schema:
+            # No schema enforcement here; starting the answer with "{" keeps
+            # Claude from wrapping the JSON in prose
+            prefix = '{'
+            messages.append({"role": "assistant", "content": prefix})
+
+        request = dict(model=self.model_name, messages=messages, max_tokens=max_tokens, temperature=0)
+        if on_text is None:
+            response = self.client.messages.create(**request)
+            self._record_tokens(response.usage.input_tokens, response.usage.output_tokens)
+            return ModelReply(prefix + ''.join(block.text for block in response.content if block.type == 'text'),
+                              truncated=response.stop_reason == 'max_tokens')
+
+        if prefix:
+            on_text(prefix)
+        parts = [prefix]
+        with self.client.messages.stream(**request) as stream:
+            for text in stream.text_stream:
+                parts.append(text)
+                on_text(text)
+            final_message = stream.get_final_message()
+        self._record_tokens(final_message.usage.input_tokens, final_message.usage.output_tokens)
+        return ModelReply(''.join(parts), truncated=final_message.stop_reason == 'max_tokens')
+
+class FakeProvider(VisionProvider):
+    """
+    Offline stand-in for tests and benchmarks
+    Answers every request with response (a dict, or a callable taking the
+    images and returning one) after latency seconds; a fraction error_rate
+    of requests raise instead (not retried unless max_retries is given).
+    Packed requests get one answer per image
+    """
+
+    name = 'fake'
+
+    def __init__(self, model_name="fake-vision", response=None, latency=0.0, error_rate=0.0,
+                 max_image_bytes=None, max_retries=0):
+        super().__init__(model_name, max_image_bytes=max_image_bytes, max_retries=max_retries)
+        self.response = response or {
+            'is_bank_statement': True,
+            'name': 'Jane Doe',
+            'address': '1600 Amphitheatre Parkway, Mountain View, CA 94043',
+            'document_date': '2024-01-31'
+        }
+        self.latency = latency
+        self.error_rate = error_rate
+        self.calls = 0
+
+    def _complete(self, prompt, images, max_tokens=1024, json_schema=None, on_text=None):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if self.error_rate and random.random() < self.error_rate:
+            raise TimeoutError("Fake provider timed out")
+
+        answer = self.response(images) if callable(self.response) else dict(self.response)
+        if len(images) > 1:
+            answer = [dict(answer, document_index=index) for index in range(len(images))]
+        text = json.dumps(answer)
+        if on_text is not None:
+            for start in range(0, len(text), 16):
+                on_text(text[start:start + 16])
+        return text
+
+PROVIDER_CLASSES = {
+    OpenAIProvider.name: OpenAIProvider,
+    AnthropicProvider.name: AnthropicProvider,
+    FakeProvider.name: FakeProvider,
+}
+
+_shared_providers = {}
+_shared_providers_lock = threading.Lock()
+
+def get_provider(name, api_key=None, model_name=None, **options):
+    """
+    Process-wide provider for (name, api_key, model_name)
+    Sharing keeps the SDK's connection pool warm across documents
+    """
+    key = (name, api_key, model_name, tuple(sorted(options.items())))
+    with _shared_providers_lock:
+        provider = _shared_providers.get(key)
+        if provider is None:
+            provider_class = PROVIDER_CLASSES[name]
+            kwargs = dict(options)
+            if model_name:
+                kwargs['model_name'] = model_name
+            if provider_class is not FakeProvider:
+                kwargs['api_key'] = api_key
+            provider = _shared_providers[key] = provider_class(**kwargs)
+        return provider
+
+def parse_provider_spec(spec):
+    """
+    Split "anthropic:claude-3-5-sonnet-20241022" into (name, model_name)
+    The model part is optional ("fake")
+    """
+    name, _, model_name = spec.partition(':')
+    if name not in PROVIDER_CLASSES:
+        raise ValueError(f"Unknown provider {name!r}, expected one of {', '.join(sorted(PROVIDER_CLASSES))}")
+    return name, model_name or None
+
+# Payload size buckets (bytes of base64) with separately tracked latency
+SIZE_BUCKETS = (256 * 1024, 1024 * 1024)
+
+# Seconds added to a provider's score per unit of recent error rate
+ERROR_PENALTY_SECONDS = 30.0
+
+# Seconds a provider that timed out is passed over (unless nothing else is left)
+TIMEOUT_COOLDOWN = 30.0
+
+class ProviderRouter(VisionProvider):
+    """
+    Sends each request to the provider expected to answer fastest
+    Latency (per payload size bucket) and error rate are tracked per
+    provider as exponentially weighted moving averages; a provider that
+    times out is passed over for a cooldown period. On any failure the
+    request fails over to the next best provider, so one slow upstream
+    can't stall the whole queue. Untried providers are tried first
+    """
+
+    name = 'router'
+
+    def __init__(self, providers, smoothing=0.2, error_penalty=ERROR_PENALTY_SECONDS,
+                 timeout_cooldown=TIMEOUT_COOLDOWN):
+        if not providers:
+            raise ValueError("ProviderRouter needs at least one provider")
+        super().__init__('+'.join(provider.cache_id for provider in providers))
+        self.providers = list(providers)
+        self.smoothing = smoothing
+        self.error_penalty = error_penalty
+        self.timeout_cooldown = timeout_cooldown
+        self._latency = {}
+        self._error_rate = {provider: 0.0 for provider in self.providers}
+        self._in_flight = {provider: 0 for provider in self.providers}
+        self._cooldown_until = {provider: 0.0 for provider in self.providers}
+        self._lock = threading.Lock()
+
+    def accepts(self, images):
+        return any(provider.accepts(images) for provider in self.providers)
+
+    @staticmethod
+    def size_bucket(images):
+        size = sum(len(base64_image) for _, base64_image, _ in images)
+        for bucket, limit in enumerate(SIZE_BUCKETS):
+            if size <= limit:
+                return bucket
+        return len(SIZE_BUCKETS)
+
+    def _score(self, provider, bucket, now):
+        latency = self._latency.get((provider, bucket))
+        if latency is None:
+            # Fall back to any size the provider was seen at, else explore it
+            seen = [value for (other, _), value in self._latency.items() if other is provider]
+            latency = min(seen) if seen else 0.0
+        # Each request already in flight will be ahead of this one
+        queued = latency * self._in_flight[provider]
+        cooling = self._cooldown_until[provider] > now
+        return (cooling, latency + queued + self.error_penalty * self._error_rate[provider])
+
+    def rank(self, images):
+        """
+        Providers that can take these images, best first
+        """
+        bucket = self.size_bucket(images)
+        now = time.monotonic()
+        with self._lock:
+            candidates = [provider for provider in self.providers if provider.accepts(images)]
+            return sorted(candidates, key=lambda provider: self._score(provider, bucket, now))
+
+    def _record(self, provider, bucket, seconds=None, error=None):
+        with self._lock:
+            self._in_flight[provider] -= 1
+            failed = 1.0 if error is not None else 0.0
+            self._error_rate[provider] += self.smoothing * (failed - self._error_rate[provider])
+            if error is None:
+                previous = self._latency.get((provider, bucket))
+                self._latency[(provider, bucket)] = seconds if previous is None else (
+                    previous + self.smoothing * (seconds - previous))
+            elif is_timeout(error):
+                self._cooldown_until[provider] = time.monotonic() + self.timeout_cooldown
+
+    def complete(self, prompt, images, max_tokens=1024, json_schema=None, on_text=None, on_retry=None):
+        candidates = self.rank(images)
+        if not candidates:
+            raise ValueError("No provider accepts images of this size")
+
+        bucket = self.size_bucket(images)
+        last_error = None
+        for provider in candidates:
+            if last_error is not None and on_retry is not None:
+                on_retry()
+            with self._lock:
+                self._in_flight[provider] += 1
+            started = time.perf_counter()
+            try:
+                text = provider.complete(prompt, images, max_tokens=max_tokens, json_schema=json_schema,
+                                         on_text=on_text, on_retry=on_retry)
+            except Exception as e:
+                self._record(provider, bucket, error=e)
+                logger.warning("%r failed (%s), failing over", provider, e)
+                last_error = e
+                continue
+            self._record(provider, bucket, seconds=time.perf_counter() - started)
+            return text
+        raise last_error
+
+    def stats(self):
+        """
+        Current routing state per provider, for logs and health checks
+        """
+        with self._lock:
+            now = time.monotonic()
+            return {
+                provider.cache_id: {
+                    'latency_by_size': {
+                        bucket: round(seconds, 3)
+                        for (other, bucket), seconds in sorted(self._latency.items(), key=lambda item: item[0][1])
+                        if other is provider
+                    },
+                    'error_rate': round(self._error_rate[provider], 3),
+                    'in_flight': self._in_flight[provider],
+                    'cooling_down': self._cooldown_until[provider] > now,
+                }
+                for provider in self.providers
+            }
+
+def build_provider(specs, api_keys, timeout=DEFAULT_PROVIDER_TIMEOUT):
+    """
+    Provider for a list of "name:model" specs
+    api_keys maps provider name to API key; a single spec gives that
+    provider, several give a ProviderRouter over them (with retries of
+    failed calls turned off so failing over is quick)
+    Raises ValueError for unknown providers or missing keys
+    """
+    parsed = [parse_provider_spec(spec) for spec in specs]
+    providers = []
+    for name, model_name in parsed:
+        if name != FakeProvider.name and not api_keys.get(name):
+            raise ValueError(f"No API key for provider {name!r}")
+        options = {} if name == FakeProvider.name else {
+            'timeout': timeout, 'max_retries': DEFAULT_MAX_RETRIES if len(parsed) == 1 else 0
+        }
+        providers.append(get_provider(name, api_keys.get(name), model_name, **options))
+    return providers[0] if len(providers) == 1 else ProviderRouter(providers)
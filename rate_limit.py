@@ -0,0 +1,80 @@
+import time
+import random
+import threading
+
+class TokenBucket:
+    """
+    Thread-safe token bucket rate limiter
+    Refills at rate tokens per second up to capacity; callers block until
+    enough tokens are available
+    """
+
+    def __init__(self, rate, capacity=None):
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self, tokens=1):
+        """
+        Take tokens if available
+        Returns 0 on success, otherwise the seconds to wait before retrying
+        """
+        # Requests larger than the bucket would never fit; let them drain it
+        tokens = min(tokens, self.capacity)
+        with self._lock:
+            self._refill(time.monotonic())
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return 0.0
+            return (tokens - self._tokens) / self.rate
+
+    def delay(self, tokens=1):
+        """
+        Seconds until tokens will be available, without taking them
+        """
+        tokens = min(tokens, self.capacity)
+        with self._lock:
+            self._refill(time.monotonic())
+            return max(0.0, (tokens - self._tokens) / self.rate)
+
+    def acquire(self, tokens=1):
+        """
+        Block until tokens are available
+        Returns the seconds spent waiting
+        """
+        waited = 0.0
+        while True:
+            delay = self.try_acquire(tokens)
+            if not delay:
+                return waited
+            time.sleep(delay)
+            waited += delay
+
+def backoff_delay(attempt, base=0.5, cap=30.0, retry_after=None):
+    """
+    Seconds to wait before retry number attempt (0-based)
+    Exponential with full jitter, but never shorter than a server-supplied
+    Retry-After value
+    """
+    delay = random.uniform(0, min(cap, base * (2 ** attempt)))
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
+
+def parse_retry_after(value):
+    """
+    Parse a Retry-After header given in seconds
+    Returns None if missing or not a number (HTTP-date form is ignored)
+    """
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,244 @@
+import re
+import json
+import threading
+from metrics import registry
+
+# Parse outcomes counted by ParseStats
+PARSE_CLEAN = 'clean'
+PARSE_REPAIRED = 'repaired'
+PARSE_RETRIED = 'retried'
+PARSE_FAILED = 'failed'
+
+_LITERALS = ('true', 'false', 'null')
+
+class TruncatedReplyError(ValueError):
+    """
+    The reply was cut off (e.g. at max_tokens) before its JSON was complete
+    """
+
+# A bare word, or a number cut off after its sign, point or exponent, at the
+# very end of the text
+_TRUNCATED_TOKEN = re.compile(r'[\s:,\[{]([A-Za-z]+|-|-?[0-9]+\.|-?[0-9.]+[eE][+-]?)$')
+
+def strip_code_fences(text):
+    """
+    Drop markdown code fences and any prose before the first { or [
+    """
+    text = text.strip()
+    if text.startswith("```"):
+        # ```json, ```JSON or a bare ```
+        text = text.split('\n', 1)[1] if '\n' in text else ''
+    if text.rstrip().endswith("```"):
+        text = text.rstrip()[:-3]
+
+    starts = [index for index in (text.find('{'), text.find('[')) if index != -1]
+    return text[min(starts):] if starts else text
+
+def _close_json(text):
+    # Scan the text, remembering open brackets and whether we end inside a
+    # string, then cut off whatever can't be completed and close the rest
+    # Returns (text, truncated): truncated if the top-level value was never
+    # closed and had to be completed here
+    stack = []
+    in_string = False
+    escaped = False
+    for index, char in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char in '{[':
+            stack.append('}' if char == '{' else ']')
+        elif char in '}]' and stack:
+            stack.pop()
+            if not stack:
+                # One complete top-level value, ignore anything after it
+                return text[:index + 1], False
+
+    repaired = text
+    if in_string:
+        if escaped:
+            repaired = repaired[:-1]
+        repaired += '"'
+
+    while True:
+        repaired = repaired.rstrip()
+        truncated = _TRUNCATED_TOKEN.search(repaired)
+        if repaired.endswith(','):
+            repaired = repaired[:-1]
+        elif repaired.endswith(':'):
+            # Key without a value: drop the key too
+            repaired = _drop_last_key(repaired[:-1])
+        elif truncated and truncated.group(1) not in _LITERALS:
+            repaired = repaired[:truncated.start(1)]
+        elif stack and stack[-1] == '}' and _ends_with_dangling_key(repaired):
+            repaired = _drop_last_key(repaired)
+        else:
+            break
+
+    return repaired + ''.join(reversed(stack)), True
+
+def _last_string_start(text):
+    # Index of the opening quote of the string that ends text
+    index = len(text) - 2
+    while index >= 0:
+        if text[index] == '"':
+            backslashes = 0
+            probe = index - 1
+            while probe >= 0 and text[probe] == '\\':
+                backslashes += 1
+                probe -= 1
+            if backslashes % 2 == 0:
+                return index
+        index -= 1
+    return -1
+
+def _ends_with_dangling_key(text):
+    # True if text ends with "key" directly after { or , (a key with no colon)
+    if not text.endswith('"'):
+        return False
+    start = _last_string_start(text)
+    return start > 0 and text[:start].rstrip()[-1:] in ('{', ',')
+
+def _drop_last_key(text):
+    text = text.rstrip()
+    if text.endswith('"'):
+        text = text[:_last_string_start(text)]
+    return text.rstrip()
+
+def repair_json(text, allow_truncated=True):
+    """
+    Parse JSON the model produced, tolerating the usual damage: code fences,
+    prose around the JSON, trailing commas and output cut off mid-value
+    (open strings, arrays and objects are closed, dangling keys dropped)
+    Completing cut-off output only makes sense for previews of a reply that
+    is still streaming; with allow_truncated=False it raises
+    TruncatedReplyError instead
+    Returns the parsed value; raises ValueError if nothing can be recovered
+    """
+    cleaned = strip_code_fences(text)
+    if not cleaned or cleaned[0] not in '{[':
+        raise ValueError("No JSON object or array in response")
+
+    candidate, truncated = _close_json(cleaned)
+    if truncated and not allow_truncated:
+        raise TruncatedReplyError("Response ends before its JSON is complete")
+    try:
+        return json.loads(candidate)
+    except json.JSONDecodeError:
+        pass
+
+    # Trailing commas before a closing bracket (outside strings)
+    try:
+        return json.loads(_remove_trailing_commas(candidate))
+    except json.JSONDecodeError as e:
+        raise ValueError(f"Could not repair JSON: {e}") from e
+
+def _remove_trailing_commas(text):
+    output = []
+    in_string = False
+    escaped = False
+    for char in text:
+        if in_string:
+            output.append(char)
+            if escaped:
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            elif char == '"':
+                in_string = False
+            continue
+        if char == '"':
+            in_string = True
+        elif char in '}]':
+            # Drop a comma (and whitespace) right before the bracket
+            while output and output[-1].isspace():
+                output.pop()
+            if output and output[-1] == ',':
+                output.pop()
+        output.append(char)
+    return ''.join(output)
+
+def parse_json_response(text):
+    """
+    Parse a complete model reply
+    Returns (value, outcome) where outcome is PARSE_CLEAN if the reply was
+    valid JSON as-is (fences aside) or PARSE_REPAIRED if it needed fixing;
+    raises ValueError if it could not be recovered, TruncatedReplyError if
+    it was cut off (a finished reply is never completed by guessing)
+    """
+    if getattr(text, 'truncated', False):
+        raise TruncatedReplyError("Model stopped at max_tokens")
+    try:
+        return json.loads(strip_code_fences(text)), PARSE_CLEAN
+    except json.JSONDecodeError:
+        return repair_json(text, allow_truncated=False), PARSE_REPAIRED
+
+class IncrementalJSONParser:
+    """
+    Parse a JSON object while its tokens are still streaming in
+    feed() each chunk; after every chunk, value holds the best partial
+    object so far (string fields may still be growing)
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """
+        Start over, e.g. when the reply is requested again
+        """
+        self.text = ''
+        self.value = None
+
+    def feed(self, chunk):
+        """
+        Add a chunk of streamed text
+        Returns the fields that appeared or changed with this chunk
+        """
+        self.text += chunk or ''
+        try:
+            value = repair_json(self.text)
+        except ValueError:
+            return {}
+        if not isinstance(value, dict):
+            return {}
+
+        previous = self.value or {}
+        changed = {key: field for key, field in value.items() if previous.get(key) != field}
+        self.value = value
+        return changed
+
+class ParseStats:
+    """
+    Thread-safe counts of how model replies were parsed
+    """
+
+    def __init__(self):
+        self._counts = {PARSE_CLEAN: 0, PARSE_REPAIRED: 0, PARSE_RETRIED: 0, PARSE_FAILED: 0}
+        self._lock = threading.Lock()
+
+    def record(self, outcome):
+        with self._lock:
+            self._counts[outcome] = self._counts.get(outcome, 0) + 1
+        registry.inc('model_replies_total', outcome=outcome)
+
+    def snapshot(self):
+        """
+        Counts per outcome plus the repair and failure rates
+        """
+        with self._lock:
+            counts = dict(self._counts)
+        # Retries are extra calls, not extra documents
+        total = counts[PARSE_CLEAN] + counts[PARSE_REPAIRED] + counts[PARSE_FAILED]
+        counts['repair_rate'] = round(counts[PARSE_REPAIRED] / total, 4) if total else 0.0
+        counts['failure_rate'] = round(counts[PARSE_FAILED] / total, 4) if total else 0.0
+        return counts
+
+# Process-wide counts for every reply parsed by document_processor
+parse_stats = ParseStats()
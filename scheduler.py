@@ -0,0 +1,196 @@
+import os
+import heapq
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from metrics import registry
+from rate_limit import TokenBucket
+
+# Request priorities, lower is served first: a user waiting in the UI (or
+# on a synchronous API call) goes ahead of batch and background work
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BATCH = 1
+PRIORITY_NAMES = {PRIORITY_INTERACTIVE: 'interactive', PRIORITY_BATCH: 'batch'}
+
+# Budgets per model and process; unset means unlimited. Split the account's
+# limits between processes that share an API key
+DEFAULT_RPM_LIMIT = int(os.environ["VISION_RPM_LIMIT"]) if os.environ.get("VISION_RPM_LIMIT") else None
+DEFAULT_TPM_LIMIT = int(os.environ["VISION_TPM_LIMIT"]) if os.environ.get("VISION_TPM_LIMIT") else None
+
+# Rate-limited (429) calls are retried this many times, with jittered backoff
+DEFAULT_MAX_RETRIES = 4
+
+# Wait times kept per priority for the stats
+WAIT_SAMPLES = 200
+
+_priority = ContextVar('request_priority', default=PRIORITY_BATCH)
+
+@contextmanager
+def request_priority(priority):
+    """
+    Run the block's vision requests (in this thread or task) at priority
+    """
+    token = _priority.set(priority)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+def current_priority():
+    return _priority.get()
+
+class QuotaScheduler:
+    """
+    Admits vision model requests under a requests-per-minute and a
+    tokens-per-minute budget, each a token bucket refilled continuously
+    Waiting requests form one queue ordered by priority, then arrival; the
+    head is admitted as soon as both buckets can pay for it, so a large
+    batch request can't be overtaken forever and interactive requests
+    never wait behind batch ones. pause() holds the whole queue after the
+    API reports a rate limit, so a burst doesn't turn into a wave of 429s
+    """
+
+    def __init__(self, model_id, rpm=None, tpm=None, max_retries=DEFAULT_MAX_RETRIES):
+        self.model_id = model_id
+        self.max_retries = max_retries
+        self._condition = threading.Condition()
+        self._queue = []
+        self._sequence = itertools.count()
+        self._paused_until = 0.0
+        self._admitted = {priority: 0 for priority in PRIORITY_NAMES}
+        self._waits = {priority: [] for priority in PRIORITY_NAMES}
+        self._rate_limited = 0
+        self.set_limits(rpm, tpm)
+
+    def set_limits(self, rpm=None, tpm=None):
+        """
+        Change the budgets; None removes a limit
+        """
+        with self._condition:
+            self.rpm = rpm
+            self.tpm = tpm
+            # A full minute's budget may be spent at once, as the API allows
+            self._requests = TokenBucket(rpm / 60, capacity=rpm) if rpm else None
+            self._tokens = TokenBucket(tpm / 60, capacity=tpm) if tpm else None
+            self._condition.notify_all()
+
+    def _delay(self, cost):
+        # Seconds until the head request may go; takes its budget if now
+        delay = self._paused_until - time.monotonic()
+        for bucket, amount in ((self._requests, 1), (self._tokens, cost)):
+            if bucket is not None:
+                delay = max(delay, bucket.delay(amount))
+        if delay > 0:
+            return delay
+        for bucket, amount in ((self._requests, 1), (self._tokens, cost)):
+            if bucket is not None:
+                bucket.try_acquire(amount)
+        return 0.0
+
+    def acquire(self, cost, priority=None):
+        """
+        Wait for budget for one request estimated at cost tokens
+        priority defaults to the one set with request_priority()
+        Returns the seconds spent waiting
+        """
+        priority = current_priority() if priority is None else priority
+        started = time.monotonic()
+        entry = (priority, next(self._sequence))
+        with self._condition:
+            heapq.heappush(self._queue, entry)
+            self._update_gauges()
+            try:
+                while True:
+                    if self._queue[0] == entry:
+                        delay = self._delay(cost)
+                        if not delay:
+                            break
+                        self._condition.wait(delay)
+                    else:
+                        self._condition.wait()
+            finally:
+                self._queue.remove(entry)
+                heapq.heapify(self._queue)
+                self._condition.notify_all()
+
+            waited = time.monotonic() - started
+            self._admitted[priority] = self._admitted.get(priority, 0) + 1
+            samples = self._waits.setdefault(priority, [])
+            samples.append(waited)
+            del samples[:-WAIT_SAMPLES]
+            self._update_gauges()
+
+        priority_name = PRIORITY_NAMES.get(priority, str(priority))
+        registry.observe('scheduler_wait_seconds', waited, model=self.model_id, priority=priority_name)
+        return waited
+
+    def pause(self, seconds):
+        """
+        Hold all requests for seconds, e.g. after a 429
+        """
+        with self._condition:
+            self._rate_limited += 1
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._condition.notify_all()
+
+    def _update_gauges(self):
+        for priority, name in PRIORITY_NAMES.items():
+            depth = sum(1 for queued_priority, _ in self._queue if queued_priority == priority)
+            registry.set_gauge('scheduler_queue_depth', depth, model=self.model_id, priority=name)
+
+    def stats(self):
+        """
+        Limits, queue depth and recent wait times per priority
+        """
+        with self._condition:
+            by_priority = {}
+            for priority, name in PRIORITY_NAMES.items():
+                samples = sorted(self._waits.get(priority, []))
+                by_priority[name] = {
+                    'queued': sum(1 for queued_priority, _ in self._queue if queued_priority == priority),
+                    'admitted': self._admitted.get(priority, 0),
+                    'wait_p50': round(samples[len(samples) // 2], 3) if samples else 0.0,
+                    'wait_max': round(samples[-1], 3) if samples else 0.0,
+                }
+            return {
+                'rpm': self.rpm,
+                'tpm': self.tpm,
+                'rate_limited': self._rate_limited,
+                'paused_for': round(max(0.0, self._paused_until - time.monotonic()), 3),
+                'priorities': by_priority,
+            }
+
+_schedulers = {}
+_schedulers_lock = threading.Lock()
+_default_limits = {'rpm': DEFAULT_RPM_LIMIT, 'tpm': DEFAULT_TPM_LIMIT}
+
+def get_scheduler(model_id):
+    """
+    Process-wide scheduler for a model (rate limits apply per model), so
+    every provider object for it shares one budget
+    """
+    with _schedulers_lock:
+        scheduler = _schedulers.get(model_id)
+        if scheduler is None:
+            scheduler = _schedulers[model_id] = QuotaScheduler(model_id, **_default_limits)
+        return scheduler
+
+def configure_limits(rpm=None, tpm=None):
+    """
+    Set the RPM/TPM budgets of every model's scheduler, existing and future
+    """
+    with _schedulers_lock:
+        _default_limits.update(rpm=rpm, tpm=tpm)
+        schedulers = list(_schedulers.values())
+    for scheduler in schedulers:
+        scheduler.set_limits(rpm, tpm)
+
+def scheduler_stats():
+    """
+    stats() of every model's scheduler, keyed by model
+    """
+    with _schedulers_lock:
+        schedulers = dict(_schedulers)
+    return {model_id: scheduler.stats() for model_id, scheduler in schedulers.items()}
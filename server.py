@@ -0,0 +1,467 @@
+"""
+JSON HTTP API for Smart Document Analyzer
+
+Endpoints:
+    POST /analyze          Upload a document (raw request body) and wait for
+                           the result. Falls back to 202 + job id if it takes
+                           longer than --sync-timeout seconds.
+    POST /jobs             Upload a document and return 202 + job id at once
+    GET  /jobs/<id>        Job status, and the result once it is done
+    GET  /health           Queue depth and worker status
+    GET  /metrics          Pipeline metrics in the Prometheus text format
+
+Upload options are query parameters: filename (used to detect PDFs),
+all_pages, validate, document_type, dpi, grayscale, token_budget, cascade,
+crop_header.
+
+Identical uploads (same content and options) are analyzed once: the job
+store serves finished ones and makes concurrent duplicates wait for the
+first, and a document whose analysis failed resumes after its last
+finished stage (unless --no-job-store).
+
+Model calls for /analyze (someone is waiting) go ahead of /jobs uploads
+when the vision model's --rpm/--tpm budget is the bottleneck.
+
+When the job queue is full the server answers 429 with Retry-After; while
+shutting down it answers 503. Both are decided before the upload is read,
+so rejected clients don't get to send (and we don't buffer) the body. Uploads waiting in the queue are held in
+memory up to --memory-limit-mb in total and spilled to temporary files
+beyond that.
+
+Usage:
+    python server.py --port 8080 --workers 8 --queue-size 64
+    curl --data-binary @statement.pdf "localhost:8080/analyze?filename=statement.pdf"
+"""
+import argparse
+import json
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from dotenv import load_dotenv
+
+from cache import ResultCache
+from document_processor import CASCADE_MODEL, analyze_document
+from job_store import JobStore
+from memory import DEFAULT_GLOBAL_MEMORY_BYTES, DocumentBuffer, MemoryBudget
+from metrics import registry
+from pdf_handler import DPI_BY_DOCUMENT_TYPE
+from providers import DEFAULT_PROVIDER_TIMEOUT, ProviderRouter, build_provider
+from response_parser import parse_stats
+from scheduler import (
+    DEFAULT_RPM_LIMIT, DEFAULT_TPM_LIMIT, PRIORITY_BATCH, PRIORITY_INTERACTIVE, PRIORITY_NAMES, configure_limits,
+    request_priority, scheduler_stats
+)
+
+logger = logging.getLogger(__name__)
+
+# Seconds a finished job's result stays available for polling
+JOB_RESULT_TTL = 15 * 60
+
+# Longest a worker waits for a duplicate upload another worker or process
+# is analyzing before giving up on it
+DEFAULT_JOB_WAIT_TIMEOUT = 300
+
+class QueueFull(Exception):
+    """
+    The job queue is at capacity, the client should retry later
+    """
+
+class ServiceUnavailable(Exception):
+    """
+    The service is shutting down and not accepting work
+    """
+
+class AnalysisService:
+    """
+    Bounded job queue served by a fixed pool of worker threads
+    Submitting never blocks: a full queue raises QueueFull so the HTTP layer
+    can push back on callers instead of piling up work; reserve() claims a
+    queue slot up front, before an upload is read
+    Documents are held as DocumentBuffers under memory_budget (a
+    MemoryBudget), so queued uploads beyond it wait on disk, and each one
+    is released as soon as its job finishes
+    A worker given a document that is being analyzed elsewhere waits at
+    most job_wait_timeout seconds for it rather than tying up its thread
+    """
+
+    def __init__(self, openai_api_key, geoapify_api_key, model_name="gpt-4o", workers=4, queue_size=32,
+                 cache=None, geocode_cache=None, provider=None, cheap_provider=None, job_store=None,
+                 memory_budget=None, job_wait_timeout=DEFAULT_JOB_WAIT_TIMEOUT):
+        self.openai_api_key = openai_api_key
+        self.geoapify_api_key = geoapify_api_key
+        self.model_name = model_name
+        self.cache = cache
+        self.geocode_cache = geocode_cache
+        self.provider = provider
+        self.cheap_provider = cheap_provider
+        self.job_store = job_store
+        self.job_wait_timeout = job_wait_timeout
+        self.memory_budget = memory_budget or MemoryBudget(DEFAULT_GLOBAL_MEMORY_BYTES)
+        # Slots of the queue are claimed before a job is put on it, and
+        # freed when a worker takes it off
+        self.queue_size = queue_size
+        self._slots = threading.Semaphore(queue_size)
+        self._queue = queue.Queue()
+        self._jobs = {}
+        self._jobs_lock = threading.Lock()
+        self._accepting = True
+        self._workers = [
+            threading.Thread(target=self._work, name=f"analysis-worker-{index}", daemon=True)
+            for index in range(workers)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def reserve(self):
+        """
+        Claim a queue slot for a document that is yet to be read
+        Pass reserved=True to the submit() that uses it, or hand it back
+        with release_slot()
+        Raises QueueFull or ServiceUnavailable
+        """
+        if not self._accepting:
+            raise ServiceUnavailable("Service is shutting down")
+        if not self._slots.acquire(blocking=False):
+            raise QueueFull("Job queue is full")
+
+    def release_slot(self):
+        self._slots.release()
+
+    def submit(self, document, filename, options, priority=PRIORITY_BATCH, reserved=False):
+        """
+        Queue a document (bytes or a DocumentBuffer) for analysis; its model
+        calls run at priority (see scheduler.py)
+        reserved says a slot was already claimed with reserve()
+        Returns the job dict; raises QueueFull or ServiceUnavailable, having
+        released the document (and the slot)
+        """
+        if not isinstance(document, DocumentBuffer):
+            document = DocumentBuffer(document, self.memory_budget)
+        try:
+            if not reserved:
+                self.reserve()
+            elif not self._accepting:
+                self.release_slot()
+                raise ServiceUnavailable("Service is shutting down")
+        except (QueueFull, ServiceUnavailable):
+            document.release()
+            raise
+
+        job = {
+            'id': uuid.uuid4().hex,
+            'status': 'queued',
+            'filename': filename,
+            'priority': PRIORITY_NAMES[priority],
+            'submitted_at': time.time(),
+            'done': threading.Event(),
+        }
+        with self._jobs_lock:
+            self._purge_expired()
+            self._jobs[job['id']] = job
+        self._queue.put((job, document, options, priority))
+        return job
+
+    def get(self, job_id):
+        """
+        A snapshot of the job (see snapshot()), or None
+        """
+        with self._jobs_lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def snapshot(self, job):
+        """
+        Copy of a job dict taken while no worker is updating it, safe to
+        serialize while the job keeps running
+        """
+        with self._jobs_lock:
+            return dict(job)
+
+    def _update_job(self, job, **fields):
+        # Jobs are read by request threads; only change them under the lock
+        with self._jobs_lock:
+            job.update(fields)
+
+    def stats(self):
+        with self._jobs_lock:
+            running = sum(1 for job in self._jobs.values() if job['status'] == 'running')
+        return {
+            'accepting': self._accepting,
+            'workers': len(self._workers),
+            'running': running,
+            'queued': self._queue.qsize(),
+            'queue_capacity': self.queue_size,
+            'parsing': parse_stats.snapshot(),
+            'providers': self.provider.stats() if isinstance(self.provider, ProviderRouter) else None,
+            'job_store': self.job_store.stats() if self.job_store is not None else None,
+            'memory': self.memory_budget.stats(),
+            'scheduler': scheduler_stats(),
+        }
+
+    def update_gauges(self):
+        """
+        Refresh the queue gauges in the metrics registry
+        """
+        with self._jobs_lock:
+            running = sum(1 for job in self._jobs.values() if job['status'] == 'running')
+        registry.set_gauge('jobs_running', running)
+        registry.set_gauge('jobs_queued', self._queue.qsize())
+
+    def shutdown(self):
+        """
+        Stop accepting jobs and let workers finish what is queued
+        """
+        self._accepting = False
+        for _ in self._workers:
+            self._queue.put((None, None, None, None))
+        for worker in self._workers:
+            worker.join()
+
+    def _work(self):
+        while True:
+            job, document, options, priority = self._queue.get()
+            if job is None:
+                return
+            self.release_slot()
+
+            self._update_job(job, status='running', started_at=time.time())
+            try:
+                document_file = document.open(job['filename'])
+                with request_priority(priority):
+                    result = analyze_document(
+                        document_file, self.openai_api_key, self.geoapify_api_key, self.model_name,
+                        cache=self.cache, geocode_cache=self.geocode_cache, provider=self.provider,
+                        cheap_provider=self.cheap_provider, job_store=self.job_store,
+                        job_wait_timeout=self.job_wait_timeout, **options
+                    )
+                status = 'failed' if result['extracted'].get('error') else 'done'
+            except Exception as e:
+                logger.exception("Job %s failed", job['id'])
+                result, status = {'error': str(e)}, 'failed'
+            finally:
+                # Don't keep the bytes alive while waiting for the next job
+                document.release()
+                document_file = None
+            self._update_job(job, result=result, status=status, finished_at=time.time())
+            registry.inc('documents_total', status=status)
+            job['done'].set()
+
+    def _purge_expired(self):
+        cutoff = time.time() - JOB_RESULT_TTL
+        expired = [
+            job_id for job_id, job in self._jobs.items()
+            if job.get('finished_at') and job['finished_at'] < cutoff
+        ]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+def job_to_json(job):
+    """
+    Public view of a job (drops the internal completion event); pass a
+    snapshot, not a job a worker may still be updating
+    """
+    return {key: value for key, value in job.items() if key != 'done'}
+
+def parse_options(query):
+    """
+    Turn upload query parameters into analyze_document keyword arguments
+    Raises ValueError for invalid values
+    """
+    def flag(name, default):
+        value = query.get(name, [None])[0]
+        return default if value is None else value.lower() in ('1', 'true', 'yes')
+
+    document_type = query.get('document_type', [None])[0]
+    if document_type and document_type not in DPI_BY_DOCUMENT_TYPE:
+        raise ValueError(f"Unknown document_type: {document_type}")
+
+    dpi = query.get('dpi', [None])[0]
+    token_budget = query.get('token_budget', [None])[0]
+    return {
+        'all_pages': flag('all_pages', False),
+        'validate': flag('validate', True),
+        'cascade': flag('cascade', False),
+        'crop_header': flag('crop_header', False),
+        'token_budget': int(token_budget) if token_budget else None,
+        'render_options': {
+            'document_type': document_type,
+            'dpi': int(dpi) if dpi else None,
+            'grayscale': flag('grayscale', False),
+        },
+    }
+
+class AnalysisRequestHandler(BaseHTTPRequestHandler):
+    # Set by make_server
+    service = None
+    sync_timeout = 60
+    max_upload_bytes = 20 * 1024 * 1024
+    retry_after = 5
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == '/health':
+            return self._send_json(200, self.service.stats())
+        if path == '/metrics':
+            self.service.update_gauges()
+            return self._send_text(200, registry.render(), 'text/plain; version=0.0.4')
+        if path.startswith('/jobs/'):
+            job = self.service.get(path[len('/jobs/'):])
+            if job is None:
+                return self._send_json(404, {'error': 'Unknown job'})
+            return self._send_json(200, job_to_json(job))
+        self._send_json(404, {'error': 'Not found'})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path not in ('/analyze', '/jobs'):
+            return self._send_json(404, {'error': 'Not found'})
+
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+        except ValueError:
+            return self._send_json(400, {'error': 'Invalid Content-Length header'})
+        if length <= 0:
+            return self._send_json(400, {'error': 'Request body must contain the document'})
+        if length > self.max_upload_bytes:
+            return self._send_json(413, {'error': f'Document larger than {self.max_upload_bytes} bytes'})
+
+        query = parse_qs(url.query)
+        filename = query.get('filename', ['document.jpg'])[0]
+        try:
+            options = parse_options(query)
+        except ValueError as e:
+            return self._send_json(400, {'error': str(e)})
+
+        # Turn the upload away before reading it if it can't be queued
+        try:
+            self.service.reserve()
+        except QueueFull as e:
+            return self._reject(429, e)
+        except ServiceUnavailable as e:
+            return self._reject(503, e)
+
+        try:
+            document = DocumentBuffer.from_stream(self.rfile, length, self.service.memory_budget)
+        except BaseException:
+            self.service.release_slot()
+            raise
+        try:
+            priority = PRIORITY_INTERACTIVE if url.path == '/analyze' else PRIORITY_BATCH
+            job = self.service.submit(document, filename, options, priority, reserved=True)
+        except ServiceUnavailable as e:
+            return self._send_json(503, {'error': str(e)}, {'Retry-After': str(self.retry_after)})
+
+        # Sync mode waits for the result, but hands out the job id rather
+        # than holding the connection forever
+        if url.path == '/analyze' and job['done'].wait(self.sync_timeout):
+            return self._send_json(200, job_to_json(self.service.snapshot(job)))
+        self._send_json(202, job_to_json(self.service.snapshot(job)), {'Location': f"/jobs/{job['id']}"})
+
+    def _reject(self, status, error):
+        # The body was never read, so the connection can't be reused
+        self.close_connection = True
+        self._send_json(status, {'error': str(error)}, {'Retry-After': str(self.retry_after), 'Connection': 'close'})
+
+    def _send_json(self, status, payload, headers=None):
+        self._send_text(status, json.dumps(payload), 'application/json', headers)
+
+    def _send_text(self, status, text, content_type, headers=None):
+        body = text.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.info("%s %s", self.address_string(), format % args)
+
+def make_server(service, host="127.0.0.1", port=8080, sync_timeout=60, max_upload_mb=20):
+    """
+    Build a ThreadingHTTPServer bound to the given AnalysisService
+    """
+    handler = type('BoundAnalysisRequestHandler', (AnalysisRequestHandler,), {
+        'service': service,
+        'sync_timeout': sync_timeout,
+        'max_upload_bytes': int(max_upload_mb * 1024 * 1024),
+    })
+    return ThreadingHTTPServer((host, port), handler)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Serve the document analysis pipeline over HTTP")
+    parser.add_argument("--host", default="127.0.0.1", help="Interface to bind")
+    parser.add_argument("--port", type=int, default=8080, help="Port to listen on")
+    parser.add_argument("--model", default="gpt-4o", help="OpenAI vision model to use")
+    parser.add_argument("--providers", default=None, help="Comma-separated vision providers, e.g. openai:gpt-4o,anthropic:claude-3-5-sonnet-20241022 (overrides --model)")
+    parser.add_argument("--provider-timeout", type=float, default=DEFAULT_PROVIDER_TIMEOUT, help="Seconds before a provider call times out and fails over")
+    parser.add_argument("--cascade-model", default=None, help=f"Provider spec for the first tier of cascade=1 requests (default openai:{CASCADE_MODEL})")
+    parser.add_argument("--rpm", type=int, default=DEFAULT_RPM_LIMIT, help="Requests per minute allowed per vision model (default VISION_RPM_LIMIT, unlimited)")
+    parser.add_argument("--tpm", type=int, default=DEFAULT_TPM_LIMIT, help="Tokens per minute allowed per vision model, with image tokens estimated from image size (default VISION_TPM_LIMIT, unlimited)")
+    parser.add_argument("--workers", type=int, default=4, help="Documents analyzed concurrently")
+    parser.add_argument("--queue-size", type=int, default=32, help="Jobs allowed to wait before answering 429")
+    parser.add_argument("--sync-timeout", type=float, default=60, help="Seconds /analyze waits before returning a job id")
+    parser.add_argument("--max-upload-mb", type=float, default=20, help="Largest accepted document")
+    parser.add_argument("--memory-limit-mb", type=float, default=DEFAULT_GLOBAL_MEMORY_BYTES / (1024 * 1024), help="Uploads held in memory across all queued jobs; the rest wait in temporary files")
+    parser.add_argument("--job-wait-timeout", type=float, default=DEFAULT_JOB_WAIT_TIMEOUT, help="Seconds a worker waits for a duplicate upload being analyzed elsewhere before failing it")
+    parser.add_argument("--no-job-store", action="store_true", help="Do not record jobs, deduplicate identical uploads or resume failed ones")
+    parser.add_argument("--no-cache", action="store_true", help="Do not use the on-disk result and geocoding caches")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    args = parse_args(argv)
+    configure_limits(args.rpm, args.tpm)
+
+    openai_api_key = os.environ.get("OPENAI_API_KEY")
+    geoapify_api_key = os.environ.get("GEOAPIFY_API_KEY")
+    api_keys = {'openai': openai_api_key, 'anthropic': os.environ.get("ANTHROPIC_API_KEY")}
+    provider = None
+    cheap_provider = None
+    try:
+        if args.providers:
+            provider = build_provider(args.providers.split(','), api_keys, timeout=args.provider_timeout)
+        if args.cascade_model:
+            cheap_provider = build_provider([args.cascade_model], api_keys, timeout=args.provider_timeout)
+    except ValueError as e:
+        sys.exit(str(e))
+    if not args.providers and not openai_api_key:
+        sys.exit("OPENAI_API_KEY must be set")
+    if not geoapify_api_key:
+        sys.exit("GEOAPIFY_API_KEY must be set")
+
+    service = AnalysisService(
+        openai_api_key,
+        geoapify_api_key,
+        model_name=args.model,
+        workers=args.workers,
+        queue_size=args.queue_size,
+        cache=None if args.no_cache else ResultCache(table="document_results"),
+        geocode_cache=None if args.no_cache else ResultCache(table="geocode_results", max_entries=50000),
+        provider=provider,
+        cheap_provider=cheap_provider,
+        job_store=None if args.no_job_store else JobStore(),
+        memory_budget=MemoryBudget(int(args.memory_limit_mb * 1024 * 1024)),
+        job_wait_timeout=args.job_wait_timeout,
+    )
+    server = make_server(service, args.host, args.port, args.sync_timeout, args.max_upload_mb)
+    logger.info("Listening on http://%s:%d", args.host, args.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""
+The asyncio API runs the shared pipeline: providers, job store, metrics and
+PDF detection by filename
+
+Run with: python -m unittest discover tests
+"""
+import asyncio
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import document_processor
+from document_processor import analyze_documents_async, process_document_async
+from job_store import JobStore
+from metrics import registry
+from providers import FakeProvider
+from scheduler import PRIORITY_INTERACTIVE, current_priority, request_priority
+
+DOCUMENT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'documents', 'scan_2.jpg')
+
+def counter(name, **labels):
+    return registry.snapshot().get(name, {}).get(tuple(sorted(labels.items())), 0)
+
+class PriorityProvider(FakeProvider):
+    # Records the request priority its calls run at
+
+    def _complete(self, prompt, images, max_tokens=1024, json_schema=None, on_text=None):
+        self.priority = current_priority()
+        return super()._complete(prompt, images, max_tokens, json_schema, on_text)
+
+class AsyncPipelineTest(unittest.TestCase):
+
+    def setUp(self):
+        with open(DOCUMENT, 'rb') as document:
+            self.document = document.read()
+
+    def test_documents_go_through_provider_and_job_store(self):
+        provider = FakeProvider(model_name='async-fake')
+        store = JobStore(":memory:")
+        before = counter('model_requests_total', model=provider.cache_id, outcome='ok')
+
+        results = asyncio.run(analyze_documents_async(
+            [self.document, self.document], None, None, provider=provider, validate=False, job_store=store,
+            max_concurrency=2
+        ))
+        self.assertEqual([result['extracted']['name'] for result in results], ['Jane Doe', 'Jane Doe'])
+        # The duplicate is served by the job store instead of the model
+        self.assertEqual(sorted(result['job']['deduplicated'] for result in results), [False, True])
+        self.assertEqual(counter('model_requests_total', model=provider.cache_id, outcome='ok') - before, 1)
+
+    def test_request_priority_reaches_the_provider(self):
+        provider = PriorityProvider(model_name='async-priority')
+
+        async def run():
+            with request_priority(PRIORITY_INTERACTIVE):
+                return await process_document_async(self.document, None, provider=provider)
+
+        self.assertEqual(asyncio.run(run())['name'], 'Jane Doe')
+        self.assertEqual(provider.priority, PRIORITY_INTERACTIVE)
+
+    def test_filenames_reach_the_pipeline(self):
+        names = []
+
+        def analyze(document_file, *args, **kwargs):
+            names.append(getattr(document_file, 'name', None))
+            return {'extracted': {}, 'validation': None, 'timings': {}}
+
+        with mock.patch.object(document_processor, 'analyze_document', side_effect=analyze):
+            asyncio.run(analyze_documents_async([b'%PDF-1.4', self.document], None, None,
+                                                filenames=['statement.pdf', 'scan_2.jpg'], max_concurrency=1))
+        self.assertEqual(names, ['statement.pdf', 'scan_2.jpg'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+"""
+Batch CLI: resuming from an existing output file and reporting failures
+in the exit status
+
+Run with: python -m unittest discover tests
+"""
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import batch
+from batch import load_completed
+
+DOCUMENTS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'documents')
+
+class BatchCliTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.inputs = os.path.join(directory, 'scans')
+        os.mkdir(self.inputs)
+        self.output = os.path.join(directory, 'results.jsonl')
+        shutil.copy(os.path.join(DOCUMENTS, 'scan_2.jpg'), os.path.join(self.inputs, 'a.jpg'))
+        self.broken = os.path.join(self.inputs, 'b.jpg')
+        with open(self.broken, 'wb') as document:
+            document.write(b'not an image')
+
+    def run_batch(self):
+        with self.assertLogs('batch', 'INFO') as logs:
+            status = batch.main([self.inputs, '--output', self.output, '--providers', 'fake:fake-vision',
+                                 '--no-validate', '--no-cache', '--render-workers', '1'])
+        return status, logs.output
+
+    def records(self):
+        with open(self.output, encoding='utf-8') as output:
+            return [json.loads(line) for line in output if line.strip()]
+
+    def test_failures_set_the_exit_status(self):
+        status, logs = self.run_batch()
+        self.assertEqual(status, 1)
+        self.assertIn('2 processed, 1 failed, 0 skipped', ' '.join(logs))
+        self.assertEqual(sorted((os.path.basename(record['path']), record['status']) for record in self.records()),
+                         [('a.jpg', 'ok'), ('b.jpg', 'error')])
+
+    def test_rerun_retries_only_what_failed(self):
+        self.assertEqual(self.run_batch()[0], 1)
+        shutil.copy(os.path.join(DOCUMENTS, 'scan_2.jpg'), self.broken)
+        # A crash left a truncated line behind
+        with open(self.output, 'a', encoding='utf-8') as output:
+            output.write('{"path": "')
+
+        status, logs = self.run_batch()
+        self.assertEqual(status, 0)
+        self.assertIn('2 documents found, 1 already done, 1 to process', ' '.join(logs))
+        with open(self.output, encoding='utf-8') as output:
+            last = output.read().splitlines()[-1]
+        self.assertEqual(json.loads(last)['path'], self.broken)
+        self.assertEqual(json.loads(last)['status'], 'ok')
+
+        # Nothing left to do
+        status, logs = self.run_batch()
+        self.assertEqual(status, 0)
+        self.assertIn('0 to process', ' '.join(logs))
+
+    def test_load_completed(self):
+        with open(self.output, 'w', encoding='utf-8') as output:
+            for path, status in (('/a.jpg', 'ok'), ('/b.jpg', 'error'), ('/c.jpg', 'skipped')):
+                output.write(json.dumps({'path': path, 'status': status}) + '\n')
+            output.write('{"path": "/d.jp')
+        self.assertEqual(load_completed(self.output), {'/a.jpg', '/c.jpg'})
+        self.assertEqual(load_completed(self.output + '.missing'), set())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,137 @@
+"""
+ResultCache: hits and misses, keys that change with the model and prompt
+version, expiry and LRU eviction, and use from many threads
+
+Run with: python -m unittest discover tests
+"""
+import io
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cache as cache_module
+import document_processor
+from cache import ResultCache, make_cache_key
+from document_processor import process_document
+from providers import FakeProvider
+
+DOCUMENT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'documents', 'scan_2.jpg')
+
+def open_document():
+    with open(DOCUMENT, 'rb') as source:
+        return io.BytesIO(source.read())
+
+class ResultCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = ResultCache(":memory:")
+
+    def test_hit_and_miss(self):
+        self.assertIsNone(self.cache.get('missing'))
+        self.assertEqual(self.cache.get('missing', 'default'), 'default')
+        self.cache.set('key', {'name': 'Jane Doe'})
+        self.assertEqual(self.cache.get('key'), {'name': 'Jane Doe'})
+        self.cache.delete('key')
+        self.assertIsNone(self.cache.get('key'))
+
+    def test_entries_expire(self):
+        with mock.patch.object(cache_module.time, 'time', return_value=1000.0):
+            self.cache.set('short', 1, ttl_seconds=10)
+            self.cache.set('default', 2)
+            self.cache.set('forever', 3, ttl_seconds=0)
+        with mock.patch.object(cache_module.time, 'time', return_value=1011.0):
+            self.assertIsNone(self.cache.get('short'))
+            self.assertEqual(self.cache.get('default'), 2)
+        with mock.patch.object(cache_module.time, 'time', return_value=1000.0 + self.cache.ttl_seconds + 1):
+            self.assertIsNone(self.cache.get('default'))
+            self.assertEqual(self.cache.get('forever'), 3)
+
+    def test_least_recently_used_is_evicted(self):
+        cache = ResultCache(":memory:", max_entries=2)
+        # Each call a second later, so access order is unambiguous
+        clock = iter(range(10))
+        now = time.time() - 60
+        with mock.patch.object(cache_module.time, 'time', side_effect=lambda: now + next(clock)):
+            cache.set('a', 1)
+            cache.set('b', 2)
+            cache.get('a')
+            cache.set('c', 3)
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual((cache.get('a'), cache.get('c')), (1, 3))
+
+    def test_keys_are_unambiguous(self):
+        self.assertNotEqual(make_cache_key('ab', 'c'), make_cache_key('a', 'bc'))
+        self.assertEqual(make_cache_key('a', b'b'), make_cache_key(b'a', 'b'))
+
+    def test_invalid_table_name(self):
+        with self.assertRaises(ValueError):
+            ResultCache(":memory:", table="results; DROP TABLE results")
+
+    def test_concurrent_access(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = ResultCache(os.path.join(directory, 'cache.sqlite3'), max_entries=50)
+            errors = []
+
+            def worker(index):
+                try:
+                    for item in range(100):
+                        key = f"{index}-{item % 20}"
+                        cache.set(key, {'index': index, 'item': item})
+                        value = cache.get(key)
+                        if value is not None and value['index'] != index:
+                            errors.append(value)
+                except Exception as e:
+                    errors.append(e)
+
+            threads = [threading.Thread(target=worker, args=(index,)) for index in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(errors, [])
+            self.assertEqual(len(cache), 50)
+
+            # Entries survive reopening the file
+            self.assertEqual(len(ResultCache(cache.path, max_entries=50)), 50)
+
+class ExtractionCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = ResultCache(":memory:")
+
+    def extract(self, provider):
+        return process_document(open_document(), None, cache=self.cache, provider=provider)
+
+    def test_repeated_document_is_served_from_the_cache(self):
+        provider = FakeProvider()
+        first, second = self.extract(provider), self.extract(provider)
+        self.assertEqual(first, second)
+        self.assertEqual(provider.calls, 1)
+
+    def test_model_change_misses(self):
+        self.extract(FakeProvider())
+        other = FakeProvider(model_name='fake-vision-2')
+        self.extract(other)
+        self.assertEqual(other.calls, 1)
+
+    def test_prompt_version_change_misses(self):
+        provider = FakeProvider()
+        self.extract(provider)
+        with mock.patch.object(document_processor, 'PROMPT_VERSION', 'next'):
+            self.extract(provider)
+        self.assertEqual(provider.calls, 2)
+
+    def test_failures_are_not_cached(self):
+        provider = FakeProvider(error_rate=1.0)
+        self.assertTrue(self.extract(provider).get('error'))
+        self.assertEqual(len(self.cache), 0)
+
+if __name__ == '__main__':
+    unittest.main()
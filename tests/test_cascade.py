@@ -0,0 +1,56 @@
+"""
+Model cascade: when the full model is worth paying for
+
+Run with: python -m unittest discover tests
+"""
+import io
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import document_processor
+from document_processor import process_document_cascade
+from providers import FakeProvider
+
+DOCUMENT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'documents', 'scan_2.jpg')
+
+def geocoded(confidence):
+    return {'features': [{'properties': {'formatted': '1600 Amphitheatre Pkwy', 'rank': {'confidence': confidence}}}]}
+
+class CascadeEscalationTest(unittest.TestCase):
+
+    def setUp(self):
+        with open(DOCUMENT, 'rb') as source:
+            self.document = source.read()
+        self.cheap = FakeProvider(model_name='fake-cheap')
+        self.full = FakeProvider(model_name='fake-full')
+
+    def run_cascade(self, geocode_result):
+        with mock.patch.object(document_processor, 'geocode_address', return_value=geocode_result):
+            return process_document_cascade(io.BytesIO(self.document), None, geoapify_api_key='geoapify-key',
+                                            provider=self.full, cheap_provider=self.cheap)
+
+    def test_confident_address_stays_on_the_cheap_tier(self):
+        extracted_info, validation_result = self.run_cascade(geocoded(0.95))
+        self.assertEqual(extracted_info['cascade']['tier'], 'cheap')
+        self.assertTrue(validation_result['is_valid'])
+        self.assertEqual(self.full.calls, 0)
+
+    def test_low_confidence_escalates(self):
+        extracted_info, _ = self.run_cascade(geocoded(0.3))
+        self.assertEqual(extracted_info['cascade']['tier'], 'full')
+        self.assertEqual(extracted_info['cascade']['escalation_reason'], 'low_address_confidence')
+        self.assertEqual(self.full.calls, 1)
+
+    def test_geocoding_outage_does_not_escalate(self):
+        # geocode_address returns None when Geoapify errors or can't be reached
+        extracted_info, validation_result = self.run_cascade(None)
+        self.assertEqual(extracted_info['cascade']['tier'], 'cheap')
+        self.assertEqual(validation_result['error'], 'Could not geocode address')
+        self.assertEqual(self.full.calls, 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,280 @@
+"""
+Geoapify client: address normalization for cache keys, retries, backoff
+and rate limiting through a stub transport, and against a local stub
+server batch jobs and falling back to single lookups when batch geocoding
+is unavailable
+
+Run with: python -m unittest discover tests
+"""
+import json
+import os
+import sys
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import geoapify
+from document_processor import validate_addresses
+from geoapify import BATCH_GEOCODE_PATH, GEOCODE_PATH, BatchGeocodingUnavailable, GeoapifyClient, normalize_address
+from rate_limit import TokenBucket
+
+def geocoded(address):
+    return {'formatted': address, 'rank': {'confidence': 0.95}}
+
+class StubTransport(HTTPAdapter):
+    """
+    Answers requests from a list of replies instead of the network
+    A reply is a status code, (status, headers), or an exception to raise
+    """
+
+    def __init__(self, replies):
+        super().__init__()
+        self.replies = list(replies)
+        self.sent = []
+
+    def send(self, request, **kwargs):
+        self.sent.append(request)
+        reply = self.replies.pop(0)
+        if isinstance(reply, Exception):
+            raise reply
+        status, headers = reply if isinstance(reply, tuple) else (reply, {})
+        response = requests.Response()
+        response.status_code = status
+        response.headers.update(headers)
+        response._content = b'{"features": []}'
+        response.request = request
+        response.url = request.url
+        return response
+
+def stub_client(replies, **options):
+    client = GeoapifyClient('geoapify-test', base_url='http://geoapify.test', **options)
+    transport = StubTransport(replies)
+    client.session.mount('http://', transport)
+    return client, transport
+
+class RequestTest(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(geoapify.time, 'sleep')
+        self.sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_retries_server_errors_and_connection_failures(self):
+        client, transport = stub_client([503, requests.ConnectionError('reset'), 200], rate_limit=None)
+        self.assertEqual(client.geocode('1 Main St').status_code, 200)
+        self.assertEqual(len(transport.sent), 3)
+        self.assertEqual(self.sleep.call_count, 2)
+        self.assertIn('apiKey=geoapify-test', transport.sent[0].url)
+
+    def test_gives_up_after_max_retries(self):
+        client, transport = stub_client([500] * 3, rate_limit=None, max_retries=2)
+        self.assertEqual(client.geocode('1 Main St').status_code, 500)
+        self.assertEqual(len(transport.sent), 3)
+
+        client, _ = stub_client([requests.Timeout('slow')] * 3, rate_limit=None, max_retries=2)
+        with self.assertRaises(requests.Timeout):
+            client.geocode('1 Main St')
+
+    def test_client_errors_are_not_retried(self):
+        client, transport = stub_client([401], rate_limit=None)
+        self.assertEqual(client.geocode('1 Main St').status_code, 401)
+        self.assertEqual(len(transport.sent), 1)
+        self.sleep.assert_not_called()
+
+    def test_429_waits_for_retry_after(self):
+        client, transport = stub_client([(429, {'Retry-After': '3'}), (429, {'Retry-After': 'soon'}), 200],
+                                        rate_limit=None)
+        self.assertEqual(client.geocode('1 Main St').status_code, 200)
+        first, second = (call.args[0] for call in self.sleep.call_args_list)
+        self.assertEqual(first, 3.0)
+        # Unparseable Retry-After falls back to jittered backoff
+        self.assertLessEqual(second, 1.0)
+
+    def test_requests_share_the_rate_limit(self):
+        client, transport = stub_client([200] * 6, rate_limit=None)
+        client.rate_limiter = TokenBucket(50, capacity=1)
+        started = time.monotonic()
+        for _ in range(6):
+            client.geocode('1 Main St')
+        # One token up front, then one every 20ms
+        self.assertGreaterEqual(time.monotonic() - started, 0.09)
+        self.assertEqual(len(transport.sent), 6)
+
+    def test_retries_take_rate_limit_tokens(self):
+        client, _ = stub_client([503, 503, 200])
+        client.rate_limiter = mock.Mock(wraps=TokenBucket(100))
+        client.geocode('1 Main St')
+        self.assertEqual(client.rate_limiter.acquire.call_count, 3)
+
+class NormalizeAddressTest(unittest.TestCase):
+
+    def test_case_and_whitespace(self):
+        self.assertEqual(normalize_address('  1600 AMPHITHEATRE\tPkwy\n Mountain   View '),
+                         '1600 amphitheatre pkwy mountain view')
+        self.assertEqual(normalize_address(None), '')
+        self.assertEqual(normalize_address(' \n '), '')
+
+    def test_punctuation_and_accents(self):
+        self.assertEqual(normalize_address('123 Main St., Apt. #4, Springfield; IL'),
+                         '123 main st apt 4 springfield il')
+        self.assertEqual(normalize_address('12 Rue de l\'Église, Besançon'),
+                         normalize_address('12 rue de l eglise besancon'))
+
+    def test_unit_and_street_abbreviations(self):
+        self.assertEqual(normalize_address('123 Main Street, Apartment 4'), normalize_address('123 main st apt 4'))
+        self.assertEqual(normalize_address('9 North Avenue, Suite 200, Floor 3'), '9 n ave ste 200 fl 3')
+        self.assertEqual(normalize_address('P.O. Box 17'), 'po box 17')
+        self.assertEqual(normalize_address('Post Office Box 17'), 'po box 17')
+
+    def test_abbreviations_only_replace_whole_words(self):
+        # "street" inside another word and "st" already short stay as they are
+        self.assertEqual(normalize_address('1 Streetside Drive'), '1 streetside dr')
+        self.assertEqual(normalize_address('5 Westminster Road'), '5 westminster rd')
+        self.assertNotEqual(normalize_address('1 Main St Apt 4'), normalize_address('1 Main St Apt 5'))
+
+class TokenBucketTest(unittest.TestCase):
+
+    def test_waits_in_proportion_to_the_shortfall(self):
+        bucket = TokenBucket(10, capacity=2)
+        self.assertEqual(bucket.try_acquire(), 0.0)
+        self.assertEqual(bucket.try_acquire(), 0.0)
+        self.assertAlmostEqual(bucket.try_acquire(), 0.1, delta=0.01)
+        self.assertAlmostEqual(bucket.delay(2), 0.2, delta=0.01)
+
+    def test_rejects_non_positive_rates(self):
+        with self.assertRaises(ValueError):
+            TokenBucket(0)
+
+class StubGeoapify(ThreadingHTTPServer):
+    """
+    Geoapify endpoints answering from canned statuses
+    create_statuses are used in turn for batch job POSTs (the last one
+    repeats); a job answers 202 to its first pending_polls polls
+    """
+    daemon_threads = True
+
+    def __init__(self, create_statuses=(202,), pending_polls=2):
+        super().__init__(('127.0.0.1', 0), StubHandler)
+        self.create_statuses = list(create_statuses)
+        self.pending_polls = pending_polls
+        self.requests = []
+        self.jobs = {}
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def count(self, method, path):
+        return self.requests.count((method, path))
+
+class StubHandler(BaseHTTPRequestHandler):
+
+    def reply(self, status, payload):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        self.server.requests.append(('POST', url.path))
+        addresses = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        statuses = self.server.create_statuses
+        status = statuses.pop(0) if len(statuses) > 1 else statuses[0]
+        if status not in (200, 202):
+            self.reply(status, {'message': 'unavailable'})
+            return
+        job_id = f"job-{len(self.server.jobs)}"
+        self.server.jobs[job_id] = {'addresses': addresses, 'polls': 0}
+        self.reply(status, {'id': job_id, 'status': 'pending'})
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        self.server.requests.append(('GET', url.path))
+        query = parse_qs(url.query)
+        if url.path == GEOCODE_PATH:
+            address = query['text'][0]
+            self.reply(200, {'features': [{'properties': geocoded(address)}]})
+            return
+        job = self.server.jobs[query['id'][0]]
+        job['polls'] += 1
+        if job['polls'] <= self.server.pending_polls:
+            self.reply(202, {'status': 'pending'})
+            return
+        self.reply(200, [geocoded(address) for address in job['addresses']])
+
+    def log_message(self, format, *args):
+        pass
+
+class GeoapifyStubTest(unittest.TestCase):
+
+    def start_stub(self, **options):
+        stub = StubGeoapify(**options)
+        threading.Thread(target=stub.serve_forever, daemon=True).start()
+        self.addCleanup(stub.server_close)
+        self.addCleanup(stub.shutdown)
+        client = GeoapifyClient('geoapify-test', base_url=stub.base_url, rate_limit=None)
+        self.addCleanup(client.close)
+        return stub, client
+
+class BatchGeocodeTest(GeoapifyStubTest):
+
+    def setUp(self):
+        # No real waiting between polls or retries
+        patcher = mock.patch.object(geoapify.time, 'sleep')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_polls_until_the_job_finishes(self):
+        stub, client = self.start_stub(pending_polls=2)
+        results = client.batch_geocode(['1 Main St', '2 Oak Ave'], poll_interval=0)
+        self.assertEqual([result['features'][0]['properties']['formatted'] for result in results],
+                         ['1 Main St', '2 Oak Ave'])
+        self.assertEqual(stub.count('POST', BATCH_GEOCODE_PATH), 1)
+        self.assertEqual(stub.count('GET', BATCH_GEOCODE_PATH), 3)
+
+    def test_job_create_is_not_retried_on_server_errors(self):
+        # A 5xx may come after the job was created (and billed)
+        stub, client = self.start_stub(create_statuses=(503, 202))
+        with self.assertRaises(BatchGeocodingUnavailable):
+            client.batch_geocode(['1 Main St', '2 Oak Ave'], poll_interval=0)
+        self.assertEqual(stub.count('POST', BATCH_GEOCODE_PATH), 1)
+
+    def test_job_create_is_retried_when_rate_limited(self):
+        stub, client = self.start_stub(create_statuses=(429, 202), pending_polls=0)
+        self.assertEqual(len(client.batch_geocode(['1 Main St', '2 Oak Ave'], poll_interval=0)), 2)
+        self.assertEqual(stub.count('POST', BATCH_GEOCODE_PATH), 2)
+
+    def test_unfinished_job_times_out(self):
+        _, client = self.start_stub(pending_polls=1000)
+        with self.assertRaises(BatchGeocodingUnavailable):
+            client.batch_geocode(['1 Main St', '2 Oak Ave'], poll_interval=0, timeout=0)
+
+class BatchFallbackTest(GeoapifyStubTest):
+
+    def test_falls_back_to_single_lookups(self):
+        stub, client = self.start_stub(create_statuses=(403,))
+        results = validate_addresses(['1 Main St', '2 Oak Ave', '1 main street'], 'geoapify-test', client=client)
+        self.assertEqual([result['is_valid'] for result in results], [True, True, True])
+        self.assertEqual(stub.count('POST', BATCH_GEOCODE_PATH), 1)
+        # The normalized duplicate is looked up once
+        self.assertEqual(stub.count('GET', GEOCODE_PATH), 2)
+
+    def test_uses_the_batch_job_when_available(self):
+        stub, client = self.start_stub(pending_polls=0)
+        results = validate_addresses(['1 Main St', '2 Oak Ave'], 'geoapify-test', client=client)
+        self.assertEqual([result['is_valid'] for result in results], [True, True])
+        self.assertEqual(stub.count('GET', GEOCODE_PATH), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+"""
+Image payloads: never re-encode an upload into something bigger
+
+Run with: python -m unittest discover tests
+"""
+import base64
+import io
+import os
+import sys
+import unittest
+from unittest import mock
+
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import image_handler
+from image_handler import JPEG_QUALITY, MIN_JPEG_QUALITY, image_media_type, prepare_image_payload
+
+encode_jpeg = image_handler._encode_jpeg
+
+DOCUMENTS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'documents')
+
+def read_document(name):
+    with open(os.path.join(DOCUMENTS, name), 'rb') as document:
+        return document.read()
+
+def payload_bytes(base64_image):
+    return base64.b64decode(base64_image)
+
+class PayloadSizeTest(unittest.TestCase):
+
+    def test_compact_upload_is_sent_as_is(self):
+        # scan_1.jpg is an 800x1035 WebP; as a 768px JPEG it would be ~93 KB
+        data = read_document('scan_1.jpg')
+        base64_image, detail, size = prepare_image_payload(data)
+        self.assertEqual(payload_bytes(base64_image), data)
+        self.assertEqual((detail, size), ('high', (800, 1035)))
+        self.assertEqual(image_media_type(base64_image), 'image/webp')
+
+    def test_resize_is_not_bigger_than_the_upload(self):
+        data = read_document('scan_1.jpg')
+        base64_image, detail, size = prepare_image_payload(data, token_budget=100)
+        self.assertEqual((detail, size), ('low', (395, 512)))
+        self.assertLessEqual(len(payload_bytes(base64_image)), len(data))
+        self.assertEqual(image_media_type(base64_image), 'image/jpeg')
+
+    def test_oversized_png_is_reencoded(self):
+        buffer = io.BytesIO()
+        Image.new('RGB', (3000, 2000), 'white').save(buffer, format='PNG')
+        base64_image, _, size = prepare_image_payload(buffer.getvalue())
+        self.assertEqual(size, (1152, 768))
+        self.assertEqual(image_media_type(base64_image), 'image/jpeg')
+
+    def test_quality_drops_to_fit_the_upload(self):
+        # A noisy JPEG saved at low quality grows when re-encoded at JPEG_QUALITY
+        buffer = io.BytesIO()
+        Image.effect_noise((800, 1100), 64).convert('RGB').save(buffer, format='JPEG', quality=30)
+        data = buffer.getvalue()
+        qualities = []
+
+        def encode(img, quality):
+            qualities.append(quality)
+            return encode_jpeg(img, quality)
+
+        with mock.patch.object(image_handler, '_encode_jpeg', side_effect=encode):
+            base64_image, _, size = prepare_image_payload(data, token_budget=85 + 170 * 4)
+        self.assertLess(size, (800, 1100))
+        self.assertEqual(qualities[0], JPEG_QUALITY)
+        self.assertGreater(len(qualities), 1)
+        self.assertTrue(len(payload_bytes(base64_image)) <= len(data) or qualities[-1] == MIN_JPEG_QUALITY)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+"""
+JobStore leases, resuming failed documents, and one job per document
+across entry points
+
+Run with: python -m unittest discover tests
+"""
+import io
+import os
+import sys
+import time
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import document_processor
+from batch import BatchProcessor
+from document_processor import acquire_document_job, analyze_document
+from job_store import BUSY, CLAIMED, STAGE_EXTRACTED, JobStore
+from providers import FakeProvider
+
+DOCUMENT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'documents', 'scan_2.jpg')
+
+GEOCODED = {'features': [{'properties': {'formatted': '1600 Amphitheatre Pkwy', 'rank': {'confidence': 0.95}}}]}
+
+def open_document():
+    with open(DOCUMENT, 'rb') as source:
+        document = io.BytesIO(source.read())
+    document.name = 'scan_2.jpg'
+    return document
+
+class SlowProvider(FakeProvider):
+
+    def __init__(self, store, **kwargs):
+        super().__init__(**kwargs)
+        self.store = store
+        self.claims = []
+
+    def _complete(self, prompt, images, max_tokens=1024, json_schema=None, on_text=None):
+        # Outlast the lease, then see whether another worker could take the job
+        time.sleep(self.store.lease_seconds * 2)
+        with self.store._lock:
+            key = self.store._conn.execute("SELECT job_key, content_hash FROM jobs").fetchone()
+        self.claims.append(self.store.claim(key['job_key'], key['content_hash'])[0])
+        return super()._complete(prompt, images, max_tokens, json_schema, on_text)
+
+class LeaseTest(unittest.TestCase):
+
+    def setUp(self):
+        self.store = JobStore(":memory:", lease_seconds=0.3)
+
+    def test_heartbeat_renews_the_lease(self):
+        self.assertEqual(self.store.claim('key', 'hash')[0], CLAIMED)
+        owner = self.store.get('key')['owner']
+        with self.store.heartbeat('key', owner):
+            time.sleep(0.7)
+            self.assertEqual(self.store.claim('key', 'hash')[0], BUSY)
+        time.sleep(0.4)
+        self.assertEqual(self.store.claim('key', 'hash')[0], CLAIMED)
+
+    def test_slow_extraction_keeps_its_job(self):
+        provider = SlowProvider(self.store)
+        result = analyze_document(open_document(), None, None, provider=provider, validate=False,
+                                  job_store=self.store)
+        self.assertEqual(provider.claims, [BUSY])
+        self.assertEqual(result['extracted']['name'], 'Jane Doe')
+        self.assertEqual(result['job']['attempt'], 1)
+
+class ResumeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.store = JobStore(":memory:")
+
+    def test_failed_geocoding_is_retried_on_resume(self):
+        # Geoapify is down for the first lookup only
+        geocode = mock.patch.object(document_processor, 'geocode_address', side_effect=[None, GEOCODED])
+        with geocode as lookups:
+            results = [
+                analyze_document(open_document(), None, 'geoapify-key', provider=FakeProvider(), cascade=True,
+                                 cheap_provider=FakeProvider(model_name='fake-cheap'), job_store=self.store)
+                for _ in range(3)
+            ]
+
+        self.assertEqual(results[0]['validation']['error'], 'Could not geocode address')
+        self.assertTrue(results[1]['validation']['is_valid'])
+        self.assertEqual(results[1]['job']['resumed_from'], STAGE_EXTRACTED)
+        self.assertTrue(results[2]['job']['deduplicated'])
+        self.assertEqual(lookups.call_count, 2)
+
+    def test_errored_validation_in_store_is_ignored(self):
+        # Written by versions that stored failed validations with the extraction
+        job, _ = acquire_document_job(self.store, open_document(), 'fake-vision', provider=FakeProvider())
+        self.store.save_stage(job['job_key'], job['owner'], STAGE_EXTRACTED, extracted=FakeProvider().response,
+                              validation={'is_valid': False, 'confidence': 0.0, 'error': 'Geoapify down'})
+        self.store.fail(job['job_key'], job['owner'], 'Geoapify down', 'validate')
+
+        with mock.patch.object(document_processor, 'geocode_address', return_value=GEOCODED):
+            result = analyze_document(open_document(), None, 'geoapify-key', provider=FakeProvider(),
+                                      job_store=self.store)
+        self.assertTrue(result['validation']['is_valid'])
+
+class SharedKeyTest(unittest.TestCase):
+
+    def test_ui_batch_and_http_share_jobs(self):
+        store = JobStore(":memory:")
+        provider = FakeProvider()
+        # How the UI, the batch CLI and the HTTP service describe the same settings
+        ui_options = {'document_type': 'statement', 'grayscale': False}
+        batch_options = {'dpi': None, 'document_type': None, 'size': None, 'grayscale': False}
+        http_options = {'document_type': None, 'dpi': None, 'grayscale': False}
+
+        with mock.patch.object(document_processor, 'geocode_address', return_value=GEOCODED):
+            processor = BatchProcessor(None, 'geoapify-key', provider=provider, render_options=batch_options,
+                                       job_store=store, render_workers=1)
+            record, = processor.run([DOCUMENT])
+            self.assertEqual(record['status'], 'ok')
+            self.assertFalse(record['job']['deduplicated'])
+
+            for options in (ui_options, http_options):
+                result = analyze_document(open_document(), None, 'geoapify-key', provider=provider,
+                                          render_options=options, job_store=store)
+                self.assertTrue(result['job']['deduplicated'])
+                self.assertEqual(result['job']['key'], record['job']['key'])
+        self.assertEqual(provider.calls, 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+"""
+Header cropping on synthetic pages: locating text blocks, cutting the
+header from the full-resolution page, and falling back to the full page
+(skipped without OpenCV)
+
+Run with: python -m unittest discover tests
+"""
+import base64
+import io
+import os
+import sys
+import unittest
+
+from PIL import Image
+
+try:
+    import cv2
+    import numpy as np
+except ImportError:
+    cv2 = None
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from document_processor import process_document
+from layout import crop_header, find_text_blocks, header_region
+from prefilter import load_screen_image
+from providers import FakeProvider
+
+WIDTH, HEIGHT = 1700, 2200
+
+# Address block near the top left, then a table of transactions; each
+# line is (left, baseline, text)
+HEADER_LINES = [
+    (150, 220, 'JANE DOE'),
+    (150, 262, '1600 Amphitheatre Parkway'),
+    (150, 304, 'Mountain View, CA 94043'),
+    (150, 346, 'Statement date 2024-01-31'),
+]
+BODY_LINES = [(150, 1200 + 42 * row, f'2024-01-{row + 1:02d}   Card payment   Coffee shop   {row * 3 + 2}.50')
+              for row in range(10)]
+
+def page(lines):
+    # White page at about twice the screening size
+    image = np.full((HEIGHT, WIDTH, 3), 250, np.uint8)
+    for left, baseline, text in lines:
+        cv2.putText(image, text, (left, baseline), cv2.FONT_HERSHEY_SIMPLEX, 1.1, (20, 20, 20), 2)
+    return cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, 90])[1].tobytes()
+
+@unittest.skipIf(cv2 is None, "OpenCV is not installed")
+class CropHeaderTest(unittest.TestCase):
+
+    def test_header_is_cut_from_the_full_page(self):
+        data, box = crop_header(page(HEADER_LINES + BODY_LINES))
+        left, top, right, bottom = box
+        # Around the address block, in original pixels, and none of the table
+        self.assertTrue(50 <= left < 150 and 100 <= top < 190)
+        self.assertTrue(600 < right < 800 and 350 < bottom < 600)
+        cropped = Image.open(io.BytesIO(data))
+        self.assertEqual(cropped.size, (right - left, bottom - top))
+        # Text from the first and last header line made it into the crop
+        gray = cropped.convert('L')
+        for _, baseline, _ in (HEADER_LINES[0], HEADER_LINES[-1]):
+            row = [gray.getpixel((x, baseline - top - 8)) for x in range(150 - left, 450 - left)]
+            self.assertLess(min(row), 100)
+
+    def test_blocks_are_found_top_to_bottom(self):
+        # At the screening size lines merge into blocks
+        screen = load_screen_image(page(BODY_LINES + HEADER_LINES))
+        blocks = find_text_blocks(cv2.cvtColor(screen, cv2.COLOR_BGR2GRAY))
+        self.assertEqual(len(blocks), 2)
+        self.assertLess(blocks[0][1] + blocks[0][3], blocks[1][1])
+
+    def test_nothing_to_crop(self):
+        self.assertEqual(crop_header(page([])), (None, None))
+        # Only text far down the page
+        self.assertEqual(crop_header(page(BODY_LINES)), (None, None))
+        self.assertEqual(crop_header(b'not an image'), (None, None))
+
+    def test_region_covering_most_of_the_page_is_not_cropped(self):
+        boxes = [(10, 10, 980, 200), (10, 300, 980, 990)]
+        self.assertIsNone(header_region(boxes, 1000, 1000))
+        self.assertEqual(header_region(boxes[:1], 1000, 1000), (0, 0, 1000, 230))
+
+    def test_process_document_falls_back_to_the_full_page(self):
+        sizes = []
+
+        def answer(images):
+            # The crop has no date on it; the full page does
+            sizes.append(Image.open(io.BytesIO(base64.b64decode(images[0][1]))).size)
+            return dict(FakeProvider().response, document_date='' if len(sizes) == 1 else '2024-01-31')
+
+        provider = FakeProvider(response=answer)
+        result = process_document(io.BytesIO(page(HEADER_LINES + BODY_LINES)), None, provider=provider,
+                                  crop_header=True)
+        self.assertEqual(result['document_date'], '2024-01-31')
+        self.assertTrue(result['roi']['fallback'])
+        self.assertEqual(provider.calls, 2)
+        self.assertLess(sizes[0][1], sizes[1][1])
+
+if __name__ == '__main__':
+    unittest.main()
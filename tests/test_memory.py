@@ -0,0 +1,150 @@
+"""
+Memory budgets: accounting, spilling to disk, the page memo, and buffers
+given back on error paths
+
+Run with: python -m unittest discover tests
+"""
+import gc
+import io
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server
+from memory import DocumentBuffer, MemoryBudget, PageMemo
+
+class MemoryBudgetTest(unittest.TestCase):
+
+    def test_reserve_and_release(self):
+        budget = MemoryBudget(100)
+        self.assertTrue(budget.reserve(60))
+        self.assertFalse(budget.reserve(50))
+        self.assertTrue(budget.reserve(40))
+        budget.release(100)
+        self.assertEqual(budget.stats()['used_bytes'], 0)
+        # Releasing more than was reserved never goes negative
+        budget.release(10)
+        self.assertEqual(budget.used_bytes, 0)
+
+    def test_parent_limits_its_children(self):
+        process = MemoryBudget(100)
+        first = MemoryBudget(80, parent=process, name='session')
+        second = MemoryBudget(80, parent=process, name='session')
+        self.assertTrue(first.reserve(70))
+        # Fits the session but not the process: nothing stays reserved
+        self.assertFalse(second.reserve(40))
+        self.assertEqual((second.used_bytes, process.used_bytes), (0, 70))
+        first.release(70)
+        self.assertEqual(process.used_bytes, 0)
+
+class DocumentBufferTest(unittest.TestCase):
+
+    def test_buffer_within_budget_stays_in_memory(self):
+        budget = MemoryBudget(100)
+        buffer = DocumentBuffer(b'x' * 60, budget)
+        self.assertFalse(buffer.spilled)
+        self.assertEqual(budget.used_bytes, 60)
+        self.assertEqual(buffer.open('statement.pdf').name, 'statement.pdf')
+        buffer.release()
+        buffer.release()
+        self.assertTrue(buffer.released)
+        self.assertEqual(budget.used_bytes, 0)
+        with self.assertRaises(ValueError):
+            buffer.getvalue()
+
+    def test_buffer_over_budget_spills_to_disk(self):
+        budget = MemoryBudget(100)
+        kept = DocumentBuffer(b'a' * 60, budget)
+        spilled = DocumentBuffer(b'b' * 60, budget)
+        self.assertTrue(spilled.spilled)
+        self.assertEqual(spilled.getvalue(), b'b' * 60)
+        self.assertEqual(budget.stats(), {'used_bytes': 60, 'limit_bytes': 100, 'spills': 1})
+        spilled.release()
+        self.assertEqual(budget.used_bytes, 60)
+        kept.release()
+
+    def test_stream_is_copied_to_disk_in_chunks(self):
+        budget = MemoryBudget(10)
+        stream = mock.Mock(wraps=io.BytesIO(b'z' * 100))
+        with mock.patch('memory.COPY_CHUNK_SIZE', 16):
+            buffer = DocumentBuffer.from_stream(stream, 100, budget)
+        self.assertTrue(buffer.spilled)
+        self.assertEqual((buffer.size, buffer.getvalue()), (100, b'z' * 100))
+        self.assertTrue(all(call.args[0] <= 16 for call in stream.read.call_args_list))
+
+        # A client that stops early leaves a shorter buffer
+        truncated = DocumentBuffer.from_stream(io.BytesIO(b'z' * 30), 100, budget)
+        self.assertEqual(truncated.size, 30)
+
+        in_memory = DocumentBuffer.from_stream(io.BytesIO(b'z' * 8), 8, budget)
+        self.assertFalse(in_memory.spilled)
+        self.assertEqual(budget.used_bytes, 8)
+        in_memory.release()
+        self.assertEqual(budget.used_bytes, 0)
+
+    def test_released_on_errors_and_collection(self):
+        budget = MemoryBudget(100)
+        with self.assertRaises(RuntimeError):
+            with DocumentBuffer(b'x' * 50, budget):
+                raise RuntimeError("analysis failed")
+        self.assertEqual(budget.used_bytes, 0)
+
+        # Dropped without release()
+        DocumentBuffer(b'x' * 50, budget)
+        gc.collect()
+        self.assertEqual(budget.used_bytes, 0)
+
+class PageMemoTest(unittest.TestCase):
+
+    def test_least_recently_used_pages_are_evicted(self):
+        budget = MemoryBudget(100)
+        memo = PageMemo(budget)
+        first = memo.put('first', b'1' * 40)
+        memo.put('second', b'2' * 40)
+        memo.get('first')
+        memo.put('third', b'3' * 40)
+        self.assertIsNone(memo.get('second'))
+        self.assertEqual(memo.get('first').getvalue(), b'1' * 40)
+        self.assertIs(memo.get('first'), first)
+        self.assertEqual((len(memo), budget.used_bytes), (2, 80))
+
+    def test_replacing_and_clearing_release_pages(self):
+        budget = MemoryBudget(100)
+        memo = PageMemo(budget)
+        old = memo.put('page', b'1' * 40)
+        memo.put('page', b'2' * 30)
+        self.assertTrue(old.released)
+        self.assertEqual(budget.used_bytes, 30)
+        memo.clear()
+        self.assertEqual((len(memo), budget.used_bytes), (0, 0))
+
+    def test_page_larger_than_the_budget_is_spilled(self):
+        budget = MemoryBudget(100)
+        memo = PageMemo(budget)
+        buffer = memo.put('huge', b'h' * 500)
+        self.assertTrue(buffer.spilled)
+        self.assertEqual(memo.get('huge').getvalue(), b'h' * 500)
+        self.assertEqual(budget.used_bytes, 0)
+
+class ServiceMemoryTest(unittest.TestCase):
+
+    def test_failed_and_rejected_jobs_release_their_documents(self):
+        budget = MemoryBudget(1000)
+        service = server.AnalysisService('sk-test', 'geoapify-test', workers=1, queue_size=4, memory_budget=budget)
+        with mock.patch.object(server, 'analyze_document', side_effect=RuntimeError("provider down")), \
+                self.assertLogs('server', 'ERROR'):
+            job = service.submit(b'x' * 100, 'scan.jpg', {})
+            self.assertTrue(job['done'].wait(5))
+        self.assertEqual(service.get(job['id'])['status'], 'failed')
+        self.assertEqual(budget.used_bytes, 0)
+
+        service.shutdown()
+        with self.assertRaises(server.ServiceUnavailable):
+            service.submit(b'x' * 100, 'scan.jpg', {})
+        self.assertEqual(budget.used_bytes, 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+"""
+Packed requests: one vision call for several documents, split back per
+document, and re-sent in smaller groups when the reply doesn't fit
+
+Run with: python -m unittest discover tests
+"""
+import base64
+import io
+import json
+import os
+import sys
+import unittest
+
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cache import ResultCache
+from document_processor import process_documents_packed
+from providers import FakeProvider
+
+COLORS = {'red': (255, 0, 0), 'green': (0, 160, 0), 'blue': (0, 0, 255)}
+
+def document(color):
+    buffer = io.BytesIO()
+    Image.new('RGB', (320, 200), COLORS[color]).save(buffer, format='JPEG')
+    return buffer.getvalue()
+
+def color_of(base64_image):
+    pixel = Image.open(io.BytesIO(base64.b64decode(base64_image))).convert('RGB').getpixel((10, 10))
+    return min(COLORS, key=lambda name: sum(abs(a - b) for a, b in zip(COLORS[name], pixel)))
+
+class ColorProvider(FakeProvider):
+    """
+    Names each document after its color; drop_entries makes the first
+    packed reply of that many documents lose its last entry, and
+    prose_for_packed answers every packed request with prose
+    """
+
+    def __init__(self, drop_entries=None, prose_for_packed=False):
+        super().__init__()
+        self.drop_entries = drop_entries
+        self.prose_for_packed = prose_for_packed
+        self.requests = []
+
+    def _complete(self, prompt, images, max_tokens=1024, json_schema=None, on_text=None):
+        self.calls += 1
+        names = [color_of(base64_image) for _, base64_image, _ in images]
+        self.requests.append(names)
+        answers = [dict(self.response, name=name) for name in names]
+        if len(images) == 1:
+            return json.dumps(answers[0])
+        if self.prose_for_packed:
+            return "Sorry, I can only read one document at a time."
+
+        # Answer out of order; the indexes say which is which
+        entries = [dict(answer, document_index=index) for index, answer in enumerate(answers)][::-1]
+        if len(images) == self.drop_entries:
+            self.drop_entries = None
+            entries = entries[1:]
+        return json.dumps(entries)
+
+class PackedTest(unittest.TestCase):
+
+    def setUp(self):
+        self.documents = [document(color) for color in ('red', 'green', 'blue')]
+
+    def test_reply_is_split_back_per_document(self):
+        provider = ColorProvider()
+        results = process_documents_packed(self.documents, None, provider=provider)
+        self.assertEqual([result['name'] for result in results], ['red', 'green', 'blue'])
+        self.assertTrue(all('document_index' not in result for result in results))
+        self.assertEqual(provider.requests, [['red', 'green', 'blue']])
+
+    def test_wrong_number_of_entries_is_resent_in_halves(self):
+        provider = ColorProvider(drop_entries=3)
+        results = process_documents_packed(self.documents, None, provider=provider)
+        self.assertEqual([result['name'] for result in results], ['red', 'green', 'blue'])
+        self.assertEqual(provider.requests, [['red', 'green', 'blue'], ['red'], ['green', 'blue']])
+
+    def test_unparseable_reply_falls_back_to_single_documents(self):
+        provider = ColorProvider(prose_for_packed=True)
+        results = process_documents_packed(self.documents[:2], None, provider=provider)
+        self.assertEqual([result['name'] for result in results], ['red', 'green'])
+        self.assertEqual(provider.requests, [['red', 'green'], ['red'], ['green']])
+
+    def test_cached_documents_are_not_resent(self):
+        cache = ResultCache(":memory:")
+        process_documents_packed(self.documents[:1], None, cache=cache, provider=ColorProvider())
+        provider = ColorProvider()
+        results = process_documents_packed(self.documents, None, cache=cache, provider=provider)
+        self.assertEqual([result['name'] for result in results], ['red', 'green', 'blue'])
+        self.assertEqual(provider.requests, [['green', 'blue']])
+
+    def test_unreadable_document_gets_an_error(self):
+        provider = ColorProvider()
+        results = process_documents_packed([self.documents[0], b'not an image'], None, provider=provider)
+        self.assertEqual(results[0]['name'], 'red')
+        self.assertTrue(results[1]['error'])
+        self.assertEqual(provider.requests, [['red']])
+
+if __name__ == '__main__':
+    unittest.main()
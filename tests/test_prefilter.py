@@ -0,0 +1,104 @@
+"""
+Pre-filter on synthetic pages: blank pages, near-duplicates and images
+that don't look like documents (skipped without OpenCV)
+
+Run with: python -m unittest discover tests
+"""
+import os
+import random
+import sys
+import unittest
+
+try:
+    import cv2
+    import numpy as np
+except ImportError:
+    cv2 = None
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from prefilter import (
+    SKIP_BLANK, SKIP_DUPLICATE, SKIP_NOT_DOCUMENT, SKIP_UNREADABLE, RecentDocuments, blank_page_reason,
+    prefilter_document
+)
+
+def encode(image, quality=90):
+    return cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, quality])[1].tobytes()
+
+def text_page(seed, width=850, height=1100):
+    # Letter-size page with ragged lines of "text" in a few blocks
+    rng = random.Random(seed)
+    page = np.full((height, width, 3), 245, np.uint8)
+    y = 80
+    while y < height - 80:
+        for _ in range(rng.randint(3, 8)):
+            line_width = rng.randint(width // 3, width - 160)
+            cv2.rectangle(page, (80, y), (80 + line_width, y + 10), (30, 30, 30), -1)
+            y += 24
+        y += rng.randint(40, 120)
+    return page
+
+@unittest.skipIf(cv2 is None, "OpenCV is not installed")
+class PrefilterTest(unittest.TestCase):
+
+    def test_blank_page(self):
+        blank = encode(np.full((1100, 850, 3), 240, np.uint8))
+        recent = RecentDocuments()
+        result = prefilter_document(blank, recent, label='blank.jpg')
+        self.assertEqual((result['skip'], result['reason']), (True, SKIP_BLANK))
+        # Skipped pages don't enter the duplicate memory
+        self.assertEqual(len(recent), 0)
+        self.assertEqual(blank_page_reason(blank), SKIP_BLANK)
+        self.assertIsNone(blank_page_reason(encode(text_page(1))))
+
+    def test_rescanned_copy_is_a_duplicate(self):
+        recent = RecentDocuments()
+        page = text_page(1)
+        self.assertFalse(prefilter_document(encode(page), recent, label='first.jpg')['skip'])
+
+        # Smaller, more compressed and a little darker
+        copy = cv2.convertScaleAbs(cv2.resize(page, (600, 776)), alpha=0.95)
+        result = prefilter_document(encode(copy, quality=60), recent, label='copy.jpg')
+        self.assertEqual((result['reason'], result['duplicate_of']), (SKIP_DUPLICATE, 'first.jpg'))
+
+        self.assertFalse(prefilter_document(encode(text_page(2)), recent, label='other.jpg')['skip'])
+        self.assertEqual(len(recent), 2)
+
+    def test_forgotten_document_is_not_a_duplicate(self):
+        recent = RecentDocuments()
+        data = encode(text_page(1))
+        result = prefilter_document(data, recent, label='failed.jpg')
+        recent.forget(result['hash'])
+        self.assertFalse(prefilter_document(data, recent, label='retry.jpg')['skip'])
+
+    def test_recent_documents_are_bounded(self):
+        recent = RecentDocuments(max_entries=2, max_distance=0)
+        for image_hash in (1, 2, 4):
+            self.assertIsNone(recent.check_and_add(image_hash, str(image_hash)))
+        self.assertEqual(len(recent), 2)
+        # The oldest was forgotten
+        self.assertIsNone(recent.check_and_add(1, 'again'))
+        self.assertEqual(recent.check_and_add(4, 'copy'), '4')
+
+    def test_photo_is_not_a_document(self):
+        # Saturated shapes over a colour gradient
+        photo = np.zeros((800, 1200, 3), np.uint8)
+        photo[:, :, 0] = np.linspace(40, 255, 1200, dtype=np.uint8)
+        photo[:, :, 1] = np.linspace(200, 60, 800, dtype=np.uint8)[:, None]
+        rng = random.Random(0)
+        for _ in range(25):
+            color = (rng.randint(0, 255), rng.randint(0, 255), rng.randint(0, 255))
+            cv2.circle(photo, (rng.randint(0, 1200), rng.randint(0, 800)), rng.randint(30, 150), color, -1)
+        result = prefilter_document(encode(photo), check_layout=True)
+        self.assertEqual((result['skip'], result['reason']), (True, SKIP_NOT_DOCUMENT))
+
+        result = prefilter_document(encode(text_page(3)), check_layout=True)
+        self.assertFalse(result['skip'])
+        self.assertGreaterEqual(result['checks']['text_lines'], 5)
+
+    def test_unreadable_image(self):
+        result = prefilter_document(b'not an image')
+        self.assertEqual((result['skip'], result['reason']), (True, SKIP_UNREADABLE))
+
+if __name__ == '__main__':
+    unittest.main()
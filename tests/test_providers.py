@@ -0,0 +1,136 @@
+"""
+OpenAIProvider against the installed openai SDK (pinned in requirements.txt),
+with a mock HTTP transport in place of the API
+
+Run with: python -m unittest discover tests
+"""
+import base64
+import io
+import json
+import os
+import sys
+import unittest
+from unittest import mock
+
+import httpx
+import openai
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from metrics import registry
+from document_processor import process_document
+from providers import FakeProvider, OpenAIProvider, ProviderRouter, openai_response_format
+
+REPLY = '{"name": "Jane Doe"}'
+
+def tiny_image():
+    buffer = io.BytesIO()
+    Image.new('RGB', (64, 64), 'white').save(buffer, format='JPEG')
+    return [(None, base64.b64encode(buffer.getvalue()).decode('ascii'), 'low')]
+
+def stream_body(include_usage):
+    chunks = [
+        {'choices': [{'index': 0, 'delta': {'content': REPLY[:9]}, 'finish_reason': None}]},
+        {'choices': [{'index': 0, 'delta': {'content': REPLY[9:]}, 'finish_reason': 'stop'}]},
+    ]
+    if include_usage:
+        chunks.append({'choices': [], 'usage': {'prompt_tokens': 100, 'completion_tokens': 7, 'total_tokens': 107}})
+    lines = []
+    for chunk in chunks:
+        chunk.update(id='chatcmpl-1', object='chat.completion.chunk', created=0, model='gpt-4o')
+        lines.append(f"data: {json.dumps(chunk)}\n\n")
+    lines.append("data: [DONE]\n\n")
+    return ''.join(lines).encode('utf-8')
+
+def completion_body():
+    return json.dumps({
+        'id': 'chatcmpl-1', 'object': 'chat.completion', 'created': 0, 'model': 'gpt-4o',
+        'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': REPLY}, 'finish_reason': 'stop'}],
+        'usage': {'prompt_tokens': 100, 'completion_tokens': 7, 'total_tokens': 107},
+    }).encode('utf-8')
+
+class OpenAIStreamingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.requests = []
+
+        def handler(request):
+            body = json.loads(request.content)
+            self.requests.append(body)
+            if body.get('stream'):
+                return httpx.Response(200, headers={'content-type': 'text/event-stream'},
+                                      content=stream_body('stream_options' in body))
+            return httpx.Response(200, headers={'content-type': 'application/json'}, content=completion_body())
+
+        self.provider = OpenAIProvider('sk-test', model_name='gpt-4o-stream-test')
+        self.provider.client = openai.OpenAI(
+            api_key='sk-test', max_retries=0, http_client=httpx.Client(transport=httpx.MockTransport(handler))
+        )
+
+    def output_tokens(self):
+        series = registry.snapshot()['model_tokens_total']
+        return series.get((('kind', 'output'), ('model', 'gpt-4o-stream-test')), 0)
+
+    def test_streamed_reply_and_usage(self):
+        chunks = []
+        before = self.output_tokens()
+        text = self.provider.complete('prompt', tiny_image(), on_text=chunks.append)
+
+        self.assertEqual(text, REPLY)
+        self.assertEqual(''.join(chunks), REPLY)
+        self.assertEqual(self.output_tokens() - before, 7)
+        if self.provider.streams_usage:
+            self.assertTrue(self.requests[-1]['stream'])
+            self.assertEqual(self.requests[-1]['stream_options'], {'include_usage': True})
+        else:
+            self.assertNotIn('stream', self.requests[-1])
+
+    def test_sdk_without_stream_options(self):
+        # What an SDK older than 1.26 gets: one non-streamed request
+        chunks = []
+        with mock.patch.object(OpenAIProvider, 'streams_usage', new=False):
+            text = self.provider.complete('prompt', tiny_image(), on_text=chunks.append)
+        self.assertEqual(text, REPLY)
+        self.assertEqual(chunks, [REPLY])
+        self.assertNotIn('stream_options', self.requests[-1])
+
+class BrokenStreamProvider(FakeProvider):
+    # Streams the start of a different answer, then fails
+
+    def _complete(self, prompt, images, max_tokens=1024, json_schema=None, on_text=None):
+        if on_text is not None:
+            on_text('{"name": "Wrong Person", "address": "9 Elsewhere')
+        raise TimeoutError("stream dropped")
+
+class FailoverPreviewTest(unittest.TestCase):
+
+    def test_previews_start_over_on_failover(self):
+        router = ProviderRouter([BrokenStreamProvider(model_name='broken'), FakeProvider(model_name='backup')])
+        previews = []
+        with open(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'documents',
+                               'scan_2.jpg'), 'rb') as document:
+            result = process_document(document, None, provider=router, on_partial=previews.append)
+
+        self.assertEqual(result['name'], 'Jane Doe')
+        # The backup's preview is built from its own reply only
+        self.assertEqual(previews[-1], {key: result[key] for key in previews[-1]})
+        self.assertEqual(previews[-1]['name'], 'Jane Doe')
+
+class ResponseFormatTest(unittest.TestCase):
+
+    def format_type(self, model_name):
+        response_format = openai_response_format(model_name, {'name': 'document', 'schema': {}})
+        return response_format.get('response_format', {}).get('type')
+
+    def test_schema_only_for_snapshots_that_support_it(self):
+        for model_name in ('gpt-4o', 'gpt-4o-2024-08-06', 'gpt-4o-mini', 'gpt-4.1-mini'):
+            self.assertEqual(self.format_type(model_name), 'json_schema', model_name)
+        # Older snapshots reject a schema with a 400; they get JSON mode
+        for model_name in ('gpt-4o-2024-05-13', 'gpt-4-turbo', 'gpt-4-turbo-2024-04-09'):
+            self.assertEqual(self.format_type(model_name), 'json_object', model_name)
+        self.assertIsNone(self.format_type('gpt-4-vision-preview'))
+        self.assertEqual(openai_response_format('gpt-4o'), {})
+
+if __name__ == '__main__':
+    unittest.main()
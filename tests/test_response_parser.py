@@ -0,0 +1,48 @@
+"""
+Repair of model replies: finished replies vs streaming previews
+
+Run with: python -m unittest discover tests
+"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from document_processor import parse_response
+from providers import ModelReply
+from response_parser import (
+    PARSE_CLEAN, PARSE_REPAIRED, IncrementalJSONParser, TruncatedReplyError, parse_json_response, repair_json
+)
+
+class FinishedReplyTest(unittest.TestCase):
+
+    def test_fences_and_trailing_commas_are_repaired(self):
+        self.assertEqual(parse_json_response('```json\n{"name": "Jo"}\n```'), ({'name': 'Jo'}, PARSE_CLEAN))
+        self.assertEqual(parse_json_response('Here: {"name": "Jo",}'), ({'name': 'Jo'}, PARSE_REPAIRED))
+
+    def test_cut_off_replies_are_not_completed(self):
+        for text in ('{"name": "Jo', '{"a": tr', '{"name": "Jo", "address": "1 Main St"', '{"name": "Jo",'):
+            with self.subTest(text=text):
+                with self.assertRaises(TruncatedReplyError):
+                    parse_json_response(text)
+
+    def test_max_tokens_stop_is_a_failure(self):
+        with self.assertRaises(TruncatedReplyError):
+            parse_json_response(ModelReply('{"name": "Jo"}', truncated=True))
+
+    def test_parse_response_reports_truncation(self):
+        extracted = parse_response('{"name": "Jo')
+        self.assertEqual(extracted['error'], 'Response was truncated')
+        self.assertEqual(extracted['name'], '')
+
+class PreviewTest(unittest.TestCase):
+
+    def test_preview_completes_cut_off_output(self):
+        self.assertEqual(repair_json('{"name": "Jo'), {'name': 'Jo'})
+        parser = IncrementalJSONParser()
+        parser.feed('{"name": "Ja')
+        self.assertEqual(parser.feed('ne", "addr'), {'name': 'Jane'})
+
+if __name__ == '__main__':
+    unittest.main()
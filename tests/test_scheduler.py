@@ -0,0 +1,136 @@
+"""
+QuotaScheduler budgets, priorities and 429 pauses, and providers leaving
+retries to it instead of the SDKs
+
+Run with: python -m unittest discover tests
+"""
+import base64
+import io
+import os
+import sys
+import threading
+import time
+import unittest
+from unittest import mock
+
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import providers
+from providers import AnthropicProvider, FakeProvider, OpenAIProvider
+from scheduler import PRIORITY_BATCH, PRIORITY_INTERACTIVE, QuotaScheduler, get_scheduler
+
+def tiny_image():
+    buffer = io.BytesIO()
+    Image.new('RGB', (64, 64), 'white').save(buffer, format='JPEG')
+    return [(None, base64.b64encode(buffer.getvalue()).decode('ascii'), 'low')]
+
+class APIError(Exception):
+
+    def __init__(self, status_code, retry_after=None):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+        self.response = mock.Mock(headers={'retry-after': retry_after} if retry_after else {})
+
+class FlakyProvider(FakeProvider):
+    # Raises the given errors, in turn, before answering
+
+    def __init__(self, model_name, errors, **kwargs):
+        super().__init__(model_name, **kwargs)
+        self.errors = list(errors)
+
+    def _complete(self, prompt, images, max_tokens=1024, json_schema=None, on_text=None):
+        if self.errors:
+            self.calls += 1
+            raise self.errors.pop(0)
+        return super()._complete(prompt, images, max_tokens, json_schema, on_text)
+
+class BudgetTest(unittest.TestCase):
+
+    def test_requests_per_minute(self):
+        # A minute's budget can be spent at once, then 10 requests a second
+        scheduler = QuotaScheduler('rpm-test', rpm=600)
+        for _ in range(600):
+            self.assertLess(scheduler.acquire(1, PRIORITY_BATCH), 0.05)
+        self.assertGreater(scheduler.acquire(1, PRIORITY_BATCH), 0.05)
+
+    def test_tokens_per_minute(self):
+        scheduler = QuotaScheduler('tpm-test', tpm=6000)
+        self.assertLess(scheduler.acquire(6000, PRIORITY_BATCH), 0.05)
+        # 100 tokens a second: 20 more take about 0.2s
+        self.assertGreater(scheduler.acquire(20, PRIORITY_BATCH), 0.15)
+
+    def test_limits_can_be_lifted(self):
+        scheduler = QuotaScheduler('lift-test', rpm=1)
+        scheduler.acquire(1, PRIORITY_BATCH)
+        scheduler.set_limits(None, None)
+        self.assertLess(scheduler.acquire(1, PRIORITY_BATCH), 0.05)
+
+class PriorityTest(unittest.TestCase):
+
+    def test_interactive_requests_go_first(self):
+        scheduler = QuotaScheduler('priority-test')
+        scheduler.pause(0.3)
+        admitted = []
+
+        def request(name, priority):
+            scheduler.acquire(1, priority)
+            admitted.append(name)
+
+        threads = []
+        for name, priority in (('batch-1', PRIORITY_BATCH), ('batch-2', PRIORITY_BATCH),
+                               ('interactive', PRIORITY_INTERACTIVE)):
+            thread = threading.Thread(target=request, args=(name, priority))
+            thread.start()
+            threads.append(thread)
+            time.sleep(0.05)
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(admitted, ['interactive', 'batch-1', 'batch-2'])
+        stats = scheduler.stats()
+        self.assertEqual(stats['priorities']['interactive']['admitted'], 1)
+        self.assertEqual(stats['priorities']['batch']['admitted'], 2)
+        self.assertEqual(stats['rate_limited'], 1)
+
+class RateLimitTest(unittest.TestCase):
+
+    def test_429_pauses_the_model_for_retry_after(self):
+        provider = FlakyProvider('pause-test', [APIError(429, retry_after='0.3')])
+        retries = []
+        started = time.monotonic()
+        reply = provider.complete('prompt', tiny_image(), on_retry=lambda: retries.append(True))
+        self.assertIn('Jane Doe', reply)
+        self.assertGreaterEqual(time.monotonic() - started, 0.3)
+        self.assertEqual(retries, [True])
+        self.assertEqual(get_scheduler(provider.cache_id).stats()['rate_limited'], 1)
+
+    def test_persistent_429_gives_up(self):
+        provider = FlakyProvider('give-up-test', [APIError(429)] * 10)
+        get_scheduler(provider.cache_id).max_retries = 2
+        with mock.patch.object(providers, 'backoff_delay', return_value=0.0):
+            with self.assertRaises(APIError):
+                provider.complete('prompt', tiny_image())
+        self.assertEqual(provider.calls, 3)
+
+    def test_server_errors_are_retried_without_pausing(self):
+        provider = FlakyProvider('server-error-test', [APIError(500), APIError(502)], max_retries=2)
+        with mock.patch.object(providers.time, 'sleep') as sleep:
+            self.assertIn('Jane Doe', provider.complete('prompt', tiny_image()))
+        self.assertEqual(sleep.call_count, 2)
+        self.assertEqual(get_scheduler(provider.cache_id).stats()['rate_limited'], 0)
+
+        provider = FlakyProvider('client-error-test', [APIError(400)])
+        with self.assertRaises(APIError):
+            provider.complete('prompt', tiny_image())
+        self.assertEqual(provider.calls, 1)
+
+    def test_sdk_retries_are_off(self):
+        # Otherwise the SDKs would retry 429s behind the scheduler's back
+        self.assertEqual(OpenAIProvider('sk-test').client.max_retries, 0)
+        self.assertEqual(AnthropicProvider('sk-ant-test').client.max_retries, 0)
+        self.assertEqual(OpenAIProvider('sk-test', max_retries=3).max_retries, 3)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+"""
+HTTP service: request validation, polling jobs while they run, and
+turning uploads away before reading them when the queue is full
+
+Run with: python -m unittest discover tests
+"""
+import http.client
+import json
+import os
+import sys
+import threading
+import time
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server
+
+def slow_analysis(document_file, *args, **kwargs):
+    time.sleep(0.2)
+    return {'extracted': {'name': 'Jane Doe'}, 'validation': None, 'timings': {}}
+
+class ServiceTestCase(unittest.TestCase):
+    # A running server around an AnalysisService with analysis patched out
+    analysis = staticmethod(slow_analysis)
+    service_options = {'workers': 2}
+
+    def setUp(self):
+        patcher = mock.patch.object(server, 'analyze_document', side_effect=self.analysis)
+        self.analyze = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.service = server.AnalysisService('sk-test', 'geoapify-test', **self.service_options)
+        self.httpd = server.make_server(self.service, port=0, sync_timeout=5)
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        self.addCleanup(self.service.shutdown)
+        self.addCleanup(self.httpd.server_close)
+        self.addCleanup(self.httpd.shutdown)
+
+    def request(self, method, path, body=None, headers=None):
+        connection = http.client.HTTPConnection('127.0.0.1', self.httpd.server_address[1], timeout=10)
+        connection.putrequest(method, path)
+        for name, value in (headers or {}).items():
+            connection.putheader(name, value)
+        connection.endheaders(body)
+        response = connection.getresponse()
+        payload = json.loads(response.read())
+        connection.close()
+        return response.status, payload
+
+class ServerTest(ServiceTestCase):
+
+    def test_invalid_content_length(self):
+        status, payload = self.request('POST', '/jobs', b'abc', {'Content-Length': 'three'})
+        self.assertEqual(status, 400)
+        self.assertIn('Content-Length', payload['error'])
+
+    def test_polling_while_jobs_finish(self):
+        job_ids = []
+        for _ in range(4):
+            status, payload = self.request('POST', '/jobs', b'abc', {'Content-Length': '3'})
+            self.assertEqual(status, 202)
+            job_ids.append(payload['id'])
+
+        deadline = time.monotonic() + 10
+        statuses = {}
+        while time.monotonic() < deadline and set(statuses.values()) != {'done'}:
+            for job_id in job_ids:
+                status, payload = self.request('GET', f'/jobs/{job_id}')
+                self.assertEqual(status, 200)
+                statuses[job_id] = payload['status']
+        self.assertEqual(set(statuses.values()), {'done'})
+        self.assertEqual(payload['result']['extracted']['name'], 'Jane Doe')
+
+release_analysis = threading.Event()
+
+def blocked_analysis(document_file, *args, **kwargs):
+    release_analysis.wait(10)
+    return {'extracted': {'name': 'Jane Doe'}, 'validation': None, 'timings': {}}
+
+class BackpressureTest(ServiceTestCase):
+    analysis = staticmethod(blocked_analysis)
+    service_options = {'workers': 1, 'queue_size': 1}
+
+    def setUp(self):
+        release_analysis.clear()
+        super().setUp()
+        # Runs after the service has been shut down
+        self.addCleanup(release_analysis.set)
+
+    def post_headers_only(self, length):
+        # Announce a large upload but send none of it
+        return self.request('POST', '/jobs', None, {'Content-Length': str(length)})
+
+    def test_full_queue_is_refused_before_the_body_is_read(self):
+        # One job running, one waiting: the queue is full
+        for _ in range(2):
+            self.assertEqual(self.request('POST', '/jobs', b'abc', {'Content-Length': '3'})[0], 202)
+        deadline = time.monotonic() + 5
+        while self.service.stats()['running'] != 1 and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        with mock.patch.object(server.DocumentBuffer, 'from_stream') as from_stream:
+            status, _ = self.post_headers_only(10 * 1024 * 1024)
+        self.assertEqual(status, 429)
+        from_stream.assert_not_called()
+
+        # The slot comes back once the queue drains
+        release_analysis.set()
+        deadline = time.monotonic() + 5
+        while self.service.stats()['queued'] and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.request('POST', '/jobs', b'abc', {'Content-Length': '3'})[0], 202)
+
+    def test_shutting_down_is_refused_before_the_body_is_read(self):
+        self.service._accepting = False
+        with mock.patch.object(server.DocumentBuffer, 'from_stream') as from_stream:
+            status, _ = self.post_headers_only(10 * 1024 * 1024)
+        self.assertEqual(status, 503)
+        from_stream.assert_not_called()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+"""
+Watch mode on a temporary directory: settling, content hashes, and failed
+files retried with backoff
+
+Run with: python -m unittest discover tests
+"""
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import watcher
+from watcher import FolderWatcher, process_ready
+
+class ScriptedProcessor:
+    # Answers each path with the statuses given for it, in turn, then 'ok'
+
+    def __init__(self, statuses=None):
+        self.statuses = {name: list(answers) for name, answers in (statuses or {}).items()}
+        self.runs = []
+
+    def run(self, paths):
+        self.runs.append(sorted(os.path.basename(path) for path in paths))
+        for path in paths:
+            answers = self.statuses.get(os.path.basename(path))
+            status = answers.pop(0) if answers else 'ok'
+            yield {'path': path, 'status': status, 'error': 'provider down' if status == 'failed' else None}
+
+class MemoryResults:
+
+    def __init__(self):
+        self.records = []
+
+    def write(self, record):
+        self.records.append(record)
+
+class WatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.clock = 1000.0
+        patcher = mock.patch.object(watcher.time, 'monotonic', side_effect=lambda: self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.results = MemoryResults()
+
+    def write(self, name, data=b'scan'):
+        with open(os.path.join(self.directory, name), 'wb') as scan:
+            scan.write(data)
+
+    def poll(self, folder, processor, seconds=0):
+        self.clock += seconds
+        ready = folder.scan()
+        if ready:
+            process_ready(processor, ready, folder, self.results)
+        return sorted(os.path.basename(path) for path, _ in ready)
+
+    def test_file_is_processed_once_settled(self):
+        folder = FolderWatcher(self.directory, settle_seconds=2)
+        processor = ScriptedProcessor()
+        self.write('scan.jpg')
+        self.assertEqual(self.poll(folder, processor), [])
+        self.assertTrue(folder.has_settling())
+        self.assertEqual(self.poll(folder, processor, 2), ['scan.jpg'])
+        self.assertEqual(self.poll(folder, processor, 60), [])
+
+        # Same content again is not processed; new content is
+        self.write('scan.jpg')
+        os.utime(os.path.join(self.directory, 'scan.jpg'), (0, 0))
+        self.assertEqual(self.poll(folder, processor, 1) + self.poll(folder, processor, 2), [])
+        self.write('scan.jpg', b'rescan')
+        os.utime(os.path.join(self.directory, 'scan.jpg'), (1, 1))
+        self.assertEqual(self.poll(folder, processor, 1) + self.poll(folder, processor, 2), ['scan.jpg'])
+
+    def test_failed_file_is_retried_with_backoff(self):
+        folder = FolderWatcher(self.directory, settle_seconds=0, retry_delay=30, max_attempts=5)
+        processor = ScriptedProcessor({'scan.jpg': ['failed', 'failed']})
+        self.write('scan.jpg')
+        self.write('other.jpg')
+        self.poll(folder, processor)
+        self.assertEqual(self.poll(folder, processor), ['other.jpg', 'scan.jpg'])
+
+        # Not before the delay, which doubles after the second failure
+        self.assertEqual(self.poll(folder, processor, 29), [])
+        self.assertEqual(self.poll(folder, processor, 1), ['scan.jpg'])
+        self.assertEqual(self.poll(folder, processor, 59), [])
+        self.assertEqual(self.poll(folder, processor, 1), ['scan.jpg'])
+        self.assertEqual(self.poll(folder, processor, 3600), [])
+        self.assertEqual([record['status'] for record in self.results.records
+                          if record['path'].endswith('scan.jpg')], ['failed', 'failed', 'ok'])
+
+    def test_gives_up_until_the_content_changes(self):
+        folder = FolderWatcher(self.directory, settle_seconds=0, retry_delay=10, max_attempts=2)
+        processor = ScriptedProcessor({'scan.jpg': ['failed'] * 3})
+        self.write('scan.jpg')
+        self.poll(folder, processor)
+        self.assertEqual(self.poll(folder, processor), ['scan.jpg'])
+        with self.assertLogs('watcher', 'WARNING'):
+            self.assertEqual(self.poll(folder, processor, 10), ['scan.jpg'])
+        self.assertEqual(self.poll(folder, processor, 3600), [])
+
+        self.write('scan.jpg', b'rescan')
+        os.utime(os.path.join(self.directory, 'scan.jpg'), (1, 1))
+        self.poll(folder, processor)
+        self.assertEqual(self.poll(folder, processor), ['scan.jpg'])
+
+    def test_changed_file_is_not_retried_with_old_content(self):
+        folder = FolderWatcher(self.directory, settle_seconds=5, retry_delay=10)
+        processor = ScriptedProcessor({'scan.jpg': ['failed']})
+        self.write('scan.jpg')
+        self.poll(folder, processor)
+        self.assertEqual(self.poll(folder, processor, 5), ['scan.jpg'])
+
+        # Rewritten before the retry is due: wait for it to settle instead
+        self.write('scan.jpg', b'rescan')
+        os.utime(os.path.join(self.directory, 'scan.jpg'), (1, 1))
+        self.assertEqual(self.poll(folder, processor, 10), [])
+        self.assertEqual(self.poll(folder, processor, 5), ['scan.jpg'])
+        self.assertEqual(processor.runs[-1], ['scan.jpg'])
+        self.assertEqual(self.results.records[-1]['status'], 'ok')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,323 @@
+"""
+Watch mode for Smart Document Analyzer
+
+Watches a directory (e.g. a scanner drop folder) and runs every new or
+changed JPG/PNG/PDF through the batch pipeline (prepare_document_image ->
+process_document -> validate_address) with the same bounded per-stage
+concurrency as batch.py.
+
+The directory is polled: one stat per file per poll, and a file is only
+read once its size and modification time have stayed the same for
+--settle seconds, so files the scanner is still writing are left alone.
+Files are tracked by content hash; touching or re-copying a file without
+changing it does not process it again, across restarts too. A file that
+fails is retried with exponential backoff (--retry-delay, doubling up to
+an hour) at most --max-attempts times, then left until it changes or the
+watcher restarts; --once does not wait for retries.
+
+Results are appended to a JSONL file (--output) or written next to each
+input as <name>.result.json (--sidecar). Every record has the file's
+content_hash.
+
+Usage:
+    python watcher.py /srv/scans --output results.jsonl
+    python watcher.py /srv/scans --sidecar --prefilter --job-store
+    python watcher.py /srv/scans --once     # process what is there and exit
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+from dotenv import load_dotenv
+
+from batch import (
+    SUPPORTED_EXTENSIONS, add_pipeline_arguments, build_processor, ends_with_newline, file_sha256,
+    write_metrics_file
+)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_POLL_INTERVAL = 2.0
+
+# Seconds a file's size and mtime must stay unchanged before it is read
+DEFAULT_SETTLE_SECONDS = 5.0
+
+SIDECAR_SUFFIX = '.result.json'
+
+# A failed file is retried after this many seconds, doubling each time up
+# to MAX_RETRY_DELAY, until it has been tried DEFAULT_MAX_ATTEMPTS times
+DEFAULT_RETRY_DELAY = 30.0
+MAX_RETRY_DELAY = 3600.0
+DEFAULT_MAX_ATTEMPTS = 5
+
+class FolderWatcher:
+    """
+    Finds documents under directory that are new or have changed
+    scan() hands out (path, content_hash) for files that have settled and
+    whose content hash is neither the one they were last processed with nor
+    one is_known(path, content_hash) recognizes, and again for files marked
+    failed once their retry is due
+    """
+
+    def __init__(self, directory, settle_seconds=DEFAULT_SETTLE_SECONDS, is_known=None,
+                 retry_delay=DEFAULT_RETRY_DELAY, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        self.directory = os.path.abspath(directory)
+        self.settle_seconds = settle_seconds
+        self.is_known = is_known
+        self.retry_delay = retry_delay
+        self.max_attempts = max_attempts
+        # path -> ((size, mtime_ns), first seen with it) while settling
+        self._settling = {}
+        # path -> (size, mtime_ns) it was last hashed at
+        self._checked = {}
+        # path -> content hash it was last processed with
+        self._processed = {}
+        # path -> (content hash, failed attempts, monotonic time of the next)
+        self._failed = {}
+
+    def _list_files(self, directory):
+        try:
+            entries = list(os.scandir(directory))
+        except OSError as e:
+            logger.warning("Cannot list %s: %s", directory, e)
+            return
+        for entry in entries:
+            # Hidden files are usually partial uploads or editor temp files
+            if entry.name.startswith('.'):
+                continue
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    yield from self._list_files(entry.path)
+                elif entry.name.lower().endswith(SUPPORTED_EXTENSIONS):
+                    stat = entry.stat()
+                    yield entry.path, (stat.st_size, stat.st_mtime_ns)
+            except OSError:
+                # Deleted while we were looking
+                continue
+
+    def scan(self):
+        """
+        Look for new and changed files
+        Returns a list of (path, content_hash) ready to be processed
+        """
+        now = time.monotonic()
+        current = dict(self._list_files(self.directory))
+
+        ready = []
+        for path, signature in current.items():
+            if self._checked.get(path) == signature or signature[0] == 0:
+                continue
+            settling = self._settling.get(path)
+            if settling is None or settling[0] != signature:
+                self._settling[path] = (signature, now)
+                continue
+            if now - settling[1] < self.settle_seconds:
+                continue
+
+            del self._settling[path]
+            self._checked[path] = signature
+            try:
+                content_hash = file_sha256(path)
+            except OSError as e:
+                logger.warning("Cannot read %s: %s", path, e)
+                continue
+            if self._processed.get(path) == content_hash:
+                continue
+            failed = self._failed.get(path)
+            if failed is not None:
+                if failed[0] == content_hash:
+                    # Touched but unchanged: its retry is already scheduled
+                    continue
+                del self._failed[path]
+            if self.is_known is not None and self.is_known(path, content_hash):
+                self._processed[path] = content_hash
+                continue
+            ready.append((path, content_hash))
+
+        # Failed files are due again, unless they have changed since
+        for path, (content_hash, attempts, retry_at) in self._failed.items():
+            if now >= retry_at and path in current and self._checked.get(path) == current[path]:
+                ready.append((path, content_hash))
+
+        # Forget deleted files, so one put back is looked at again
+        for tracked in (self._settling, self._checked, self._processed, self._failed):
+            for path in [path for path in tracked if path not in current]:
+                del tracked[path]
+        return ready
+
+    def mark_processed(self, path, content_hash):
+        """
+        Remember the content a file was processed with; it is only handed
+        out again once its content changes
+        """
+        self._failed.pop(path, None)
+        self._processed[path] = content_hash
+
+    def mark_failed(self, path, content_hash):
+        """
+        Schedule a retry of a file whose processing failed, backing off
+        exponentially; after max_attempts it waits for its content to change
+        Returns the seconds until the retry, or None if there won't be one
+        """
+        failed = self._failed.get(path)
+        attempts = failed[1] + 1 if failed is not None and failed[0] == content_hash else 1
+        if attempts >= self.max_attempts:
+            self._failed.pop(path, None)
+            self._processed[path] = content_hash
+            return None
+        delay = min(MAX_RETRY_DELAY, self.retry_delay * 2 ** (attempts - 1))
+        self._failed[path] = (content_hash, attempts, time.monotonic() + delay)
+        return delay
+
+    def has_settling(self):
+        """
+        True if some files are still waiting to settle
+        """
+        return bool(self._settling)
+
+class JsonlResults:
+    """
+    Results appended to one JSONL file, as batch.py writes them
+    A file whose latest successful (or skipped) record has its current
+    content hash counts as known
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._known = {}
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as output:
+                for line in output:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    if record.get('status') in ('ok', 'skipped') and record.get('content_hash'):
+                        self._known[record['path']] = record['content_hash']
+        self._output = open(path, 'a', encoding='utf-8')
+        # Terminate a truncated last line left behind by a crash
+        if not ends_with_newline(path):
+            self._output.write('\n')
+
+    def is_known(self, path, content_hash):
+        return self._known.get(path) == content_hash
+
+    def write(self, record):
+        self._output.write(json.dumps(record) + '\n')
+        self._output.flush()
+        if record['status'] in ('ok', 'skipped'):
+            self._known[record['path']] = record['content_hash']
+
+    def close(self):
+        self._output.close()
+
+class SidecarResults:
+    """
+    Results written next to each input as <name>.result.json
+    A file whose sidecar records a successful (or skipped) run on its
+    current content hash counts as known
+    """
+
+    def is_known(self, path, content_hash):
+        try:
+            with open(path + SIDECAR_SUFFIX, encoding='utf-8') as sidecar:
+                record = json.load(sidecar)
+        except (OSError, ValueError):
+            return False
+        return record.get('status') in ('ok', 'skipped') and record.get('content_hash') == content_hash
+
+    def write(self, record):
+        # Write and rename, so readers never see half a result
+        sidecar_path = record['path'] + SIDECAR_SUFFIX
+        temporary_path = f"{sidecar_path}.tmp"
+        with open(temporary_path, 'w', encoding='utf-8') as sidecar:
+            json.dump(record, sidecar, indent=2)
+        os.replace(temporary_path, sidecar_path)
+
+    def close(self):
+        pass
+
+def process_ready(processor, ready, watcher, results):
+    """
+    Run one scan's files through the processor, recording each result
+    Returns the number of documents that failed
+    """
+    content_hashes = dict(ready)
+    failures = 0
+    for record in processor.run(list(content_hashes)):
+        record['content_hash'] = content_hashes[record['path']]
+        results.write(record)
+        logger.info("%s: %s%s", record['path'], record['status'],
+                    f" ({record['error']})" if record.get('error') else '')
+        if record['status'] in ('ok', 'skipped'):
+            watcher.mark_processed(record['path'], record['content_hash'])
+            continue
+        failures += 1
+        delay = watcher.mark_failed(record['path'], record['content_hash'])
+        if delay is None:
+            logger.warning("%s: giving up after %d attempts", record['path'], watcher.max_attempts)
+        else:
+            logger.info("%s: retrying in %.0fs", record['path'], delay)
+    return failures
+
+def watch(watcher, processor, results, poll_interval=DEFAULT_POLL_INTERVAL, once=False, stop_event=None,
+          metrics_file=None):
+    """
+    Poll until stop_event is set (or, with once, until every file present
+    at the start has settled and been processed)
+    Returns the number of documents that failed
+    """
+    stop_event = stop_event or threading.Event()
+    failures = 0
+    while not stop_event.is_set():
+        ready = watcher.scan()
+        if ready:
+            logger.info("%d new or changed documents", len(ready))
+            failures += process_ready(processor, ready, watcher, results)
+            if metrics_file:
+                write_metrics_file(metrics_file)
+        if once and not watcher.has_settling():
+            break
+        stop_event.wait(poll_interval)
+    return failures
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Watch a directory and analyze new or changed documents")
+    parser.add_argument("directory", help="Directory to watch (recursively)")
+    parser.add_argument("-o", "--output", default="results.jsonl", help="JSONL file results are appended to")
+    parser.add_argument("--sidecar", action="store_true", help=f"Write each result next to its input as <name>{SIDECAR_SUFFIX} instead of --output")
+    parser.add_argument("--poll-interval", type=float, default=DEFAULT_POLL_INTERVAL, help="Seconds between directory scans")
+    parser.add_argument("--settle", type=float, default=DEFAULT_SETTLE_SECONDS, help="Seconds a file must stay unchanged before it is processed")
+    parser.add_argument("--once", action="store_true", help="Process the files present now, then exit")
+    parser.add_argument("--retry-delay", type=float, default=DEFAULT_RETRY_DELAY, help="Seconds before a failed file is retried; doubles with every failure")
+    parser.add_argument("--max-attempts", type=int, default=DEFAULT_MAX_ATTEMPTS, help="Times a file is tried before waiting for it to change")
+    add_pipeline_arguments(parser)
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    args = parse_args(argv)
+    if not os.path.isdir(args.directory):
+        sys.exit(f"{args.directory} is not a directory")
+
+    processor = build_processor(args)
+    results = SidecarResults() if args.sidecar else JsonlResults(args.output)
+    watcher = FolderWatcher(args.directory, settle_seconds=args.settle, is_known=results.is_known,
+                            retry_delay=args.retry_delay, max_attempts=args.max_attempts)
+    logger.info("Watching %s", watcher.directory)
+    try:
+        failures = watch(watcher, processor, results, args.poll_interval, once=args.once,
+                         metrics_file=args.metrics_file)
+    except KeyboardInterrupt:
+        failures = 0
+    finally:
+        results.close()
+    return 1 if args.once and failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())